@@ -1,27 +1,64 @@
 from __future__ import annotations
 
 import argparse
+import hashlib
+import hmac
 import json
 import logging
 import os
+import secrets
+import threading
+import time
+from datetime import datetime
 from functools import wraps
 from pathlib import Path
 from signal import SIGKILL, SIGTERM
 from typing import Any, overload
 
 import msgpack
-from flask import Flask, jsonify, render_template, request
+import zmq
+from flask import Flask, Response, g, jsonify, render_template, request, stream_with_context
 
-from cybershuttle_gateway.api import SlurmAPI
-from cybershuttle_gateway.config import TEMPLATE_DIR
-from cybershuttle_gateway.exceptions import NoUserConfigException
-from cybershuttle_gateway.typing import JobConfig, JobState, KernelSpec, ProvisionRequest, UserConfig
-from cybershuttle_gateway.util import generate_kernel_spec, generate_port_map, sanitize
+from cybershuttle_gateway.admission import Admission
+from cybershuttle_gateway.api import APIBase, get_class_by_name
+from cybershuttle_gateway.api.local import parse_time_s
+from cybershuttle_gateway.breaker import Breakers
+from cybershuttle_gateway.capture import BODY_MODES, CaptureWriter
+from cybershuttle_gateway.config import ANY_CLUSTER, TEMPLATE_DIR
+from cybershuttle_gateway.culling import ActivityTracker, Culler
+from cybershuttle_gateway.exceptions import AdmissionException, ClusterUnreachableException, NoEligibleClusterException, NoUserConfigException, SnapshotException
+from cybershuttle_gateway.metrics import Metrics
+from cybershuttle_gateway.placement import Placement
+from cybershuttle_gateway.routing import Router
+from cybershuttle_gateway.snapshot import restore, snapshot, snapshot_name
+from cybershuttle_gateway.startup import StartupStats, durations, probe_heartbeat, probe_kernel_info
+from cybershuttle_gateway.tracing import Tracer, current_span
+from cybershuttle_gateway.transport import ZMQTransport
+from cybershuttle_gateway.typing import ClusterConfig, JobConfig, JobState, KernelSpec, ProvisionRequest, UserConfig
+from cybershuttle_gateway.util import generate_kernel_spec, generate_port_map, generate_tunnel_map, sanitize
 
 app = Flask(__name__)
 app.logger.setLevel(logging.DEBUG)
 state_var: dict[str, JobState] = {}
 fwd_ports = ["shell_port", "iopub_port", "stdin_port", "hb_port", "control_port"]
+capture_dir: Path | None = None
+capture_bodies = "none"
+# seconds between keepalive comments on the kernel spec feed
+feed_heartbeat = 15.0
+placement = Placement(app.logger)
+# snapshots taken by the gateway, per user
+snapshots: dict[str, list[dict[str, Any]]] = {}
+# startup timelines of recent kernels
+startup_stats = StartupStats()
+forwarding_lock = threading.Lock()
+router = Router(app.logger, placement)
+# one circuit breaker per cluster login, the deadlines of remote commands and of job submissions,
+# and how long the last known status of a job is served while its cluster cannot be reached
+breakers = Breakers()
+command_timeout = 10.0
+submit_timeout = 120.0
+stale_limit = 600.0
+tracer = Tracer(app.logger, "cybershuttle-gateway")
 
 
 def get_gateway_url():
@@ -68,6 +105,8 @@ def get_available_kernels(
         u = get_user_config(user)
         for cluster_name, c in u.clusters.items():
             userdata[cluster_name] = generate_kernel_spec(cluster_name, user, c.workdir, get_gateway_url())
+        if routable(u.clusters):
+            userdata[ANY_CLUSTER] = generate_kernel_spec(ANY_CLUSTER, user, "", get_gateway_url())
         return userdata
     else:
         alldata: dict[tuple[str, str], KernelSpec] = {}
@@ -75,9 +114,342 @@ def get_available_kernels(
         for user, u in user_config.items():
             for cluster_name, c in u.clusters.items():
                 alldata[(user, cluster_name)] = generate_kernel_spec(cluster_name, user, c.workdir, get_gateway_url())
+            if routable(u.clusters):
+                alldata[(user, ANY_CLUSTER)] = generate_kernel_spec(ANY_CLUSTER, user, "", get_gateway_url())
         return alldata
 
 
+def routable(clusters: dict[str, ClusterConfig]) -> bool:
+    """
+    Whether a user gets the virtual "any" cluster (unless a real cluster has that name)
+
+    """
+    return len(clusters) > 1 and ANY_CLUSTER not in clusters
+
+
+def make_api(cluster_cfg: ClusterConfig) -> APIBase:
+    """
+    Create the scheduler backend of a cluster
+
+    """
+    api = get_class_by_name(cluster_cfg.scheduler or "slurm")(app.logger)
+    # the local scheduler runs kernels on the gateway host itself unless a login node is given
+    if cluster_cfg.scheduler != "local" or cluster_cfg.loginnode:
+        api.ssh_prefix = api.build_ssh_command(cluster_cfg.username, cluster_cfg.loginnode, cluster_cfg.proxyjump)
+    api.timeout = command_timeout
+    api.submit_timeout = submit_timeout
+    api.breaker = breakers.get(api.ssh_prefix)
+    api.tracer = tracer
+    return api
+
+
+def start_proxy(
+    job_id: str,
+    port_map: list[tuple[int, int]],
+    tunnel_map: list[tuple[int, int]],
+    activity: ActivityTracker | None = None,
+) -> tuple[ZMQTransport, CaptureWriter | None]:
+    """
+    Put a channel proxy in front of the SSH tunnel of a job
+
+    The proxy binds the public ports in port_map and connects to the
+    loopback ports in tunnel_map, where the SSH tunnel will listen.
+
+    """
+    channels = {}
+    for name, (_, public_port), (_, tunnel_port) in zip(fwd_ports, port_map, tunnel_map):
+        channels[name.removesuffix("_port")] = (public_port, tunnel_port)
+    proxy = ZMQTransport(app.logger, channels)
+    if activity is not None:
+        proxy.listeners.append(activity.record)
+    capture = None
+    if capture_dir is not None:
+        capture = CaptureWriter(capture_dir / f"{job_id}.cslog", job_id=job_id, bodies=capture_bodies)
+        proxy.listeners.append(capture.record)
+        app.logger.info(f"capturing channels of job {job_id} to {capture.path}")
+    proxy.start()
+    return proxy, capture
+
+
+def release_job(job_id: str) -> JobState | None:
+    """
+    Drop the state of a job and stop its proxy and capture, if any
+
+    """
+    culler.untrack(job_id)
+    state = state_var.pop(job_id, None)
+    if state is None:
+        return None
+    if state.proxy is not None:
+        state.proxy.stop()
+    if state.capture is not None:
+        state.capture.close()
+    return state
+
+
+# states of jobs that are over (UNKNOWN: no longer known to the scheduler)
+ENDED_STATES = ["UNKNOWN", "COMPLETED", "FAILED", "CANCELLED", "TIMEOUT", "NODE_FAIL", "OUT_OF_MEMORY", "PREEMPTED", "BOOT_FAIL", "DEADLINE"]
+
+
+def outstanding_jobs(username: str) -> int:
+    """
+    Jobs of a user that are not known to be over, for the quota of admission
+
+    """
+    states = [state for state in list(state_var.values()) if state.username == username]
+    return sum(1 for state in states if state.last_status is None or state.last_status["state"] not in ENDED_STATES)
+
+
+def apply_job_status(job_id: str, job_state: str, job_node: str, job_eta: str) -> dict[str, Any]:
+    """
+    Act on a polled job state (start forwarding once running, release it once over) and build its status response
+
+    """
+    state = state_var[job_id]
+    assert state.api is not None
+    if job_state == "UNREACHABLE":
+        if state.last_status is not None and state.last_status_at is not None and time.time() - state.last_status_at < stale_limit:
+            # keep reporting what was last known for a while, rather than an error that ends the kernel
+            since = datetime.fromtimestamp(state.last_status_at).isoformat(timespec="seconds")
+            circuit = state.api.breaker.state if state.api.breaker is not None else None
+            warning = f"cluster {state.cluster_name} is not responding, showing the job status from {since}"
+            return dict(state.last_status, stale=True, stale_since=state.last_status_at, circuit=circuit, warning=warning)
+        job_state = "ERROR"
+    if job_state in ["PENDING", "RUNNING"]:
+        state.timeline.setdefault(job_state.lower(), time.time())
+    if job_state == "RUNNING" and state.forwarding == False:
+        start_job_forwarding(job_id, job_node)
+    # the job reported its kernel listening, and squeue has not seen it end
+    if state.ready is not None and job_state in ["PENDING", "CONFIGURING", "RUNNING"]:
+        job_state, job_node = "READY", job_node or state.ready["node"]
+    status: dict[str, Any] = dict(state=job_state, node=job_node, eta=job_eta, ports=state.port_map)
+    if state.activity is not None:
+        status["activity"] = state.activity.summary()
+        if (warning := state.activity.warning_message()) is not None:
+            status["warning"] = warning
+    if job_state != "ERROR":
+        state.last_status = status
+        state.last_status_at = time.time()
+    # a job that ended by itself (walltime, node failure, crash) cannot be scancel-ed, so release it here;
+    # jobs not seen yet may just not be in squeue yet
+    if job_state in ENDED_STATES and ("pending" in state.timeline or "running" in state.timeline):
+        app.logger.info(f"job {job_id} is over ({job_state}), releasing it")
+        state.api.close_forwarding()
+        release_job(job_id)
+    return status
+
+
+def start_job_forwarding(job_id: str, job_node: str) -> None:
+    """
+    Forward the ports of a job that started running on job_node, and start what waits for it
+
+    """
+    state = state_var[job_id]
+    # a poll and the job's ready callback may both get here
+    with forwarding_lock:
+        if state.forwarding:
+            return
+        # on the launch timeline of the job, whichever request got here
+        with tracer.span("tunnel start", state.traceparent or None, node=job_node):
+            state.api.start_forwarding(
+                username=state.cluster.username,
+                compute_username=state.cluster.compute_username,
+                execnode=job_node,
+                port_map=state.tunnel_map,
+                proxyjump=state.cluster.proxyjump,
+                loginnode=state.cluster.loginnode,
+                bind_address="*" if state.proxy is None else "127.0.0.1",
+            )
+        state.forwarding = True
+    state.started_at = state.timeline["tunnel"] = time.time()
+    threading.Thread(target=probe_startup, args=(job_id,), name=f"startup-{job_id}", daemon=True).start()
+    if state.activity is not None:
+        state.activity.mark_running()
+    if state.restore:
+        threading.Thread(target=restore_when_ready, args=(job_id,), name=f"restore-{job_id}", daemon=True).start()
+
+
+def probe_startup(job_id: str, timeout: float = 600.0) -> None:
+    """
+    Time the first heartbeat and kernel_info_reply of a new kernel through its tunnel, and record its startup timeline
+
+    """
+    state = state_var.get(job_id)
+    if state is None:
+        return
+    host, shell_port, key = kernel_address(state)
+    hb_port = state.tunnel_map[fwd_ports.index("hb_port")][1]
+    deadline = time.monotonic() + timeout
+    try:
+        # the tunnel is up before the kernel listens, so keep asking until it answers
+        while "heartbeat" not in state.timeline and job_id in state_var and time.monotonic() < deadline:
+            if probe_heartbeat(host, hb_port, 1.0):
+                state.timeline["heartbeat"] = time.time()
+        while "kernel_info" not in state.timeline and job_id in state_var and time.monotonic() < deadline:
+            if probe_kernel_info(host, shell_port, key, 5.0) is not None:
+                state.timeline["kernel_info"] = time.time()
+    except (zmq.ZMQError, ValueError) as e:
+        app.logger.error(f"could not probe the startup of job {job_id}: {e}")
+    startup_stats.record(job_id, state.cluster_name, state.spec, state.timeline)
+    app.logger.info(f"startup of job {job_id} on {state.cluster_name}: {durations(state.timeline)}")
+
+
+def kernel_address(state: JobState) -> tuple[str, int, bytes]:
+    """
+    Where the gateway reaches the shell channel of a job (its tunnel, behind any proxy), and the signing key
+
+    """
+    shell_port = state.tunnel_map[fwd_ports.index("shell_port")][1]
+    key = state.connection_info.get("key", b"")
+    return "127.0.0.1", shell_port, key.encode() if isinstance(key, str) else key
+
+
+def take_snapshot(job_id: str, reason: str, timeout: float = 300.0) -> dict[str, Any]:
+    """
+    Snapshot the user namespace of a running kernel to its workdir
+
+    """
+    state = state_var[job_id]
+    if not state.forwarding:
+        raise SnapshotException("kernel is not running")
+    try:
+        result = snapshot(*kernel_address(state), snapshot_name(state.cluster_name, job_id, reason), timeout)
+    except SnapshotException:
+        metrics.inc("snapshot_failures_total", cluster=state.cluster_name, reason=reason)
+        raise
+    state.snapshotted = True
+    result.update(job_id=job_id, cluster=state.cluster_name, reason=reason, time=time.time())
+    snapshots.setdefault(state.username, []).append(result)
+    metrics.inc("snapshots_total", cluster=state.cluster_name, reason=reason)
+    app.logger.info(f"snapshot of job {job_id} ({reason}): {result['path']}, {len(result['saved'])} saved, {len(result['skipped'])} skipped")
+    return result
+
+
+def restore_when_ready(job_id: str, timeout: float = 600.0) -> None:
+    """
+    Load the requested snapshot into a new kernel, once, as soon as it answers
+
+    """
+    state = state_var.get(job_id)
+    if state is None:
+        return
+    host, shell_port, key = kernel_address(state)
+    deadline = time.monotonic() + timeout
+    try:
+        # the kernel may still be starting, and drop requests sent before it listens, so wait for
+        # it to answer (a restore sent again on every timeout would be queued up, and run, again)
+        while "kernel_info" not in state.timeline and probe_kernel_info(host, shell_port, key, 5.0) is None:
+            if job_id not in state_var or time.monotonic() >= deadline:
+                app.logger.error(f"could not restore {state.restore} into job {job_id}: kernel did not answer within {timeout:g}s")
+                return
+        result = restore(host, shell_port, key, state.restore, max(1.0, deadline - time.monotonic()))
+    except (SnapshotException, OSError, ValueError, zmq.ZMQError) as e:
+        app.logger.error(f"could not restore {state.restore} into job {job_id}: {e}")
+        return
+    app.logger.info(f"restored {result['path']} into job {job_id}: {len(result['restored'])} restored, {len(result['failed'])} failed")
+
+
+def snapshot_expiring_jobs() -> None:
+    """
+    Snapshot kernels that are about to reach their time limit (once per job)
+
+    """
+    now = time.time()
+    for job_id, state in list(state_var.items()):
+        before = state.cluster.snapshot_before_limit
+        if before <= 0 or state.started_at is None or state.snapshotted:
+            continue
+        limit = parse_time_s(str(state.spec.get("time", "")))
+        if limit > 0 and now >= state.started_at + limit - before:
+            state.snapshotted = True
+            threading.Thread(target=snapshot_quietly, args=(job_id, "limit"), name=f"snapshot-{job_id}", daemon=True).start()
+
+
+def snapshot_quietly(job_id: str, reason: str) -> None:
+    """
+    Take a snapshot, logging failures instead of raising them
+
+    """
+    try:
+        take_snapshot(job_id, reason)
+    except (SnapshotException, KeyError, OSError, ValueError) as e:
+        app.logger.error(f"could not snapshot job {job_id} ({reason}): {e}")
+
+
+def warn_idle_job(tracker: ActivityTracker) -> None:
+    state = state_var.get(tracker.job_id)
+    metrics.inc("cull_warnings_total", cluster=state.cluster_name if state else "")
+
+
+def cull_job(tracker: ActivityTracker) -> None:
+    """
+    Cancel an idle job, and release its ports, tunnel and state
+
+    """
+    state = state_var.get(tracker.job_id)
+    if state is None:
+        culler.untrack(tracker.job_id)
+        return
+    idle = tracker.idle_seconds()
+    # keep the namespace of the kernel, so it can be restored into a new one
+    if state.cluster.snapshot_on_cull and not state.snapshotted:
+        snapshot_quietly(tracker.job_id, "culled")
+    if state.api.signal_job(int(tracker.job_id), SIGTERM):
+        release_job(tracker.job_id)
+        metrics.inc("culled_total", cluster=state.cluster_name)
+        metrics.inc("culled_idle_seconds_total", idle, cluster=state.cluster_name)
+    else:
+        # retried on the next sweep
+        metrics.inc("cull_failures_total", cluster=state.cluster_name)
+
+
+def count_jobs() -> dict[tuple[tuple[str, str], ...], float]:
+    counts: dict[tuple[tuple[str, str], ...], float] = {}
+    for state in list(state_var.values()):
+        idle = state.activity is not None and state.activity.warned_at is not None
+        key = (("cluster", state.cluster_name), ("idle", str(idle).lower()))
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+metrics = Metrics()
+metrics.describe("jobs", "gauge", "Kernel jobs held by the gateway (idle = warned about culling)")
+metrics.describe("cull_warnings_total", "counter", "Idle kernels warned about culling")
+metrics.describe("culled_total", "counter", "Idle kernels culled")
+metrics.describe("culled_idle_seconds_total", "counter", "Seconds culled kernels had been idle")
+metrics.describe("cull_failures_total", "counter", "Failed attempts to cancel idle kernels")
+metrics.describe("snapshots_total", "counter", "Kernel snapshots taken")
+metrics.describe("snapshot_failures_total", "counter", "Kernel snapshots that failed")
+metrics.describe("circuit_state", "gauge", "Circuit breaker of each cluster login (0 = closed, 1 = half-open, 2 = open)")
+metrics.describe("circuit_opened_total", "counter", "Times the circuit breaker of a cluster login opened")
+metrics.collect("jobs", count_jobs)
+metrics.collect("circuit_state", breakers.states)
+metrics.collect("circuit_opened_total", breakers.opened)
+culler = Culler(app.logger, on_warn=warn_idle_job, on_cull=cull_job)
+culler.tasks.append(snapshot_expiring_jobs)
+admission = Admission(app.logger, metrics, outstanding=outstanding_jobs)
+
+
+def group_jobs(job_ids: list) -> tuple[dict[str, dict], dict[tuple[str, ...], list[str]]]:
+    """
+    Group known jobs by their scheduler and the login they run under, so each group takes one remote command
+
+    Return:
+        results (dict) {job_id: {error}} for unknown jobs
+        groups (dict) {(scheduler, *ssh prefix): [job_id]} for known jobs
+
+    """
+    results: dict[str, dict] = {}
+    groups: dict[tuple[str, ...], list[str]] = {}
+    for job_id in dict.fromkeys(str(j) for j in job_ids):
+        state = state_var.get(job_id)
+        if state is None or state.api is None:
+            results[job_id] = dict(error="Job Not Found")
+            continue
+        groups.setdefault((type(state.api).__name__, *state.api.ssh_prefix), []).append(job_id)
+    return results, groups
+
+
 def validate_auth(f):
     @wraps(f)
     def wrapper(*args, **kw):
@@ -90,12 +462,44 @@ def validate_auth(f):
 
     return wrapper
 
+
+def owns_job(job_id: str) -> bool:
+    """
+    Whether a known job belongs to the user of the request
+
+    """
+    return state_var[job_id].username == request.args.get("user", type=str, default="")
+
+
 @app.after_request
 def add_header(response):
     response.headers['Access-Control-Allow-Origin'] = '*'
     return response
 
 
+@app.before_request
+def start_request_span():
+    # requests that carry a trace context (e.g. from the provisioner) are traced
+    traceparent = request.headers.get("traceparent")
+    if not tracer.enabled or traceparent is None or request.endpoint == "record_trace":
+        return
+    rule = request.url_rule.rule if request.url_rule is not None else request.path
+    g.span = tracer.start(f"{request.method} {rule}", traceparent, user=request.args.get("user", ""), path=request.path)
+    current_span.set(g.span)
+
+
+@app.after_request
+def end_request_span(response):
+    span = g.pop("span", None)
+    if span is not None:
+        span.set(status_code=response.status_code)
+        if response.status_code >= 500:
+            span.fail(response.status)
+        span.end()
+        current_span.set(None)
+    return response
+
+
 @app.route("/")
 def admin_panel():
     # generate params
@@ -111,12 +515,76 @@ def admin_panel():
     )
 
 
+def get_kernelspecs(username: str) -> tuple[dict[str, Any], str]:
+    """
+    Get the kernel specs of a user, and a version that changes whenever they do
+
+    """
+    kernels = get_available_kernels(username)
+    specs = sanitize({k: v.dict() for k, v in kernels.items()})
+    version = hashlib.sha256(json.dumps(specs, sort_keys=True).encode()).hexdigest()[:16]
+    return specs, version
+
+
+@app.route("/metrics")
+def get_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/kernelspecs")
 @validate_auth
 def get_kernels():
     username = request.args.get("user", type=str, default="")
-    kernels = get_available_kernels(username)
-    return jsonify(sanitize({k: v.dict() for k, v in kernels.items()}))
+    specs, version = get_kernelspecs(username)
+    # let pollers skip the body when nothing changed
+    if request.headers.get("If-None-Match") == f'"{version}"':
+        return "", 304
+    response = jsonify(specs)
+    response.headers["ETag"] = f'"{version}"'
+    return response
+
+
+@app.route("/kernelspecs/events")
+@validate_auth
+def get_kernels_events():
+    """
+    Stream the kernel specs of a user as server-sent events
+
+    A "kernelspecs" event (id = version, data = specs) is sent on connect and
+    whenever the specs change; a client resuming with Last-Event-ID only gets
+    an event once they differ from that version. Keepalive comments are sent
+    every feed_heartbeat seconds, so clients can tell a quiet feed from a dead one.
+
+    """
+    username = request.args.get("user", type=str, default="")
+    last_id = request.headers.get("Last-Event-ID", "")
+
+    def stream():
+        version = last_id
+        mtime = None
+        last_sent = time.monotonic()
+        while True:
+            # specs only change with the config file, so only rebuild them when it does
+            current = os.stat(config_file).st_mtime_ns
+            if current != mtime:
+                mtime = current
+                try:
+                    specs, new_version = get_kernelspecs(username)
+                except NoUserConfigException:
+                    specs, new_version = {}, "removed"
+                if new_version != version:
+                    version = new_version
+                    yield f"event: kernelspecs\nid: {version}\ndata: {json.dumps(specs)}\n\n"
+                    last_sent = time.monotonic()
+                if version == "removed":
+                    return
+            if time.monotonic() - last_sent >= feed_heartbeat:
+                yield ": keepalive\n\n"
+                last_sent = time.monotonic()
+            time.sleep(1.0)
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(stream()), mimetype="text/event-stream", headers=headers)
 
 
 @app.route("/status/<job_id>", methods=["GET"])
@@ -128,23 +596,72 @@ def get_kernel_status(job_id: str):
     Args:
         job_id (str): ID of provisioned kernel
 
+    While the cluster cannot be reached, the last known status is returned, with stale=True.
+
     """
     if job_id not in state_var:
         return "Job Not Found", 404
     state = state_var[job_id]
     assert state.api is not None
     (job_state, job_node, job_eta) = state.api.poll_job_status(int(job_id))
-    if job_state == "RUNNING" and state.forwarding == False:
-        state.api.start_forwarding(
-            username=state.cluster.username,
-            compute_username=state.cluster.compute_username,
-            execnode=job_node,
-            port_map=state.port_map,
-            proxyjump=state.cluster.proxyjump,
-            loginnode=state.cluster.loginnode,
-        )
-        state.forwarding = True
-    return jsonify(sanitize(dict(state=job_state, node=job_node, eta=job_eta, ports=state.port_map)))
+    return jsonify(sanitize(apply_job_status(job_id, job_state, job_node, job_eta)))
+
+
+@app.route("/jobs/status", methods=["POST"])
+@validate_auth
+def get_kernels_status():
+    """
+    Get status of many kernels in one call
+
+    Body (msgpack):
+        job_ids (list[str]): IDs of provisioned kernels
+
+    Return:
+        {job_id: {state, node, eta, ports}} or {job_id: {error}} per job
+
+    """
+    payload: dict = msgpack.loads(request.get_data())  # type: ignore
+    results, groups = group_jobs(payload["job_ids"])
+    for job_ids in groups.values():
+        api = state_var[job_ids[0]].api
+        assert api is not None
+        statuses = api.poll_jobs_status([int(j) for j in job_ids])
+        for job_id in job_ids:
+            (job_state, job_node, job_eta) = statuses[job_id]
+            results[job_id] = sanitize(apply_job_status(job_id, job_state, job_node, job_eta))
+    return jsonify(results)
+
+
+@app.route("/jobs/signal", methods=["POST"])
+@validate_auth
+def signal_kernels():
+    """
+    Issue a signal to many kernels in one call
+
+    Body (msgpack):
+        job_ids (list[str]): IDs of provisioned kernels
+        signum (int): signal to send
+
+    Return:
+        {job_id: {success}} or {job_id: {error}} per job
+
+    """
+    payload: dict = msgpack.loads(request.get_data())  # type: ignore
+    signum = payload["signum"]
+    results, groups = group_jobs(payload["job_ids"])
+    for job_ids in groups.values():
+        api = state_var[job_ids[0]].api
+        assert api is not None
+        signaled = api.signal_jobs([int(j) for j in job_ids], signum)
+        for job_id in job_ids:
+            results[job_id] = dict(success=signaled[job_id])
+            if signum in [SIGTERM, SIGKILL] and signaled[job_id]:
+                state = state_var[job_id]
+                assert state.api is not None
+                state.api.close_forwarding()
+                app.logger.info(f"cleaning up resources for job {job_id}")
+                release_job(job_id)
+    return jsonify(sanitize(results))
 
 
 @app.route("/signal/<job_id>", methods=["POST"])
@@ -167,11 +684,85 @@ def signal_kernel(job_id: str):
 
     if signum in [SIGTERM, SIGKILL] and result == True:
         print(f"cleaning up resources for job {job_id}")
-        state_var.pop(job_id, None)
+        release_job(job_id)
 
     return jsonify(sanitize(dict(success=result)))
 
 
+@app.route("/snapshot/<job_id>", methods=["POST"])
+@validate_auth
+def snapshot_kernel(job_id: str):
+    """
+    Snapshot the user namespace of a kernel to its workdir
+
+    Args:
+        job_id (str): ID of provisioned kernel
+
+    Body (msgpack, optional):
+        release (bool): cancel the job once the snapshot is saved (hibernate)
+
+    Return:
+        {path, saved, skipped, bytes, released}
+
+    """
+    if job_id not in state_var:
+        return "Job Not Found", 404
+    if not owns_job(job_id):
+        return "Forbidden", 403
+    payload: dict = msgpack.loads(request.get_data()) if request.get_data() else {}  # type: ignore
+    try:
+        result = take_snapshot(job_id, "hibernate" if payload.get("release") else "manual")
+    except SnapshotException as e:
+        return jsonify(dict(error=str(e))), 409
+    result["released"] = False
+    if payload.get("release"):
+        info = state_var[job_id]
+        if info.api.signal_job(int(job_id), SIGTERM):
+            release_job(job_id)
+            result["released"] = True
+    return jsonify(sanitize(result))
+
+
+@app.route("/restore/<job_id>", methods=["POST"])
+@validate_auth
+def restore_kernel(job_id: str):
+    """
+    Load a snapshot into the user namespace of a running kernel
+
+    Args:
+        job_id (str): ID of provisioned kernel
+
+    Body (msgpack):
+        path (str): snapshot path, absolute or relative to the snapshot dir of the kernel
+
+    """
+    if job_id not in state_var:
+        return "Job Not Found", 404
+    # the snapshot is unpickled in the kernel, so only its own user may pick one
+    if not owns_job(job_id):
+        return "Forbidden", 403
+    payload: dict = msgpack.loads(request.get_data())  # type: ignore
+    state = state_var[job_id]
+    if not state.forwarding:
+        return jsonify(dict(error="kernel is not running")), 409
+    try:
+        result = restore(*kernel_address(state), payload["path"])
+    except SnapshotException as e:
+        return jsonify(dict(error=str(e))), 409
+    return jsonify(sanitize(result))
+
+
+@app.route("/snapshots", methods=["GET"])
+@validate_auth
+def get_snapshots():
+    """
+    List the snapshots the gateway took of a user's kernels
+
+    """
+    username = request.args.get("user", type=str, default="")
+    return jsonify([sanitize(result) for result in snapshots.get(username, [])])
+
+
 @app.route("/info/<job_id>", methods=["GET"])
 @validate_auth
 def get_kernel_info(job_id: str):
@@ -188,6 +779,86 @@ def get_kernel_info(job_id: str):
     return state_var[job_id].json()
 
 
+@app.route("/ready/<job_id>", methods=["POST"])
+@validate_auth
+def job_ready(job_id: str):
+    """
+    Callback of a job whose kernel is listening on all its ports (see the job script)
+
+    Forwarding starts right away, and /status reports the job as READY from then on.
+
+    Args:
+        job_id (str): ID of provisioned kernel
+
+    Headers:
+        Authorization: Bearer <token of the job>
+
+    Body (json):
+        node (str): host the kernel runs on
+        ports (list[int]): kernel ports, as bound
+        timings (dict): job_start, kernel_exec, ports_bound (epoch ns, clock of the node)
+
+    """
+    state = state_var.get(job_id)
+    if state is None:
+        return "Job Not Found", 404
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+    if not state.ready_token or not hmac.compare_digest(token, state.ready_token):
+        return "Unauthorized", 403
+    payload: dict = request.get_json(force=True)
+    now = time.time()
+    timings = {k: int(v) for k, v in payload.get("timings", {}).items()}
+    state.ready = dict(node=str(payload["node"]), ports=payload.get("ports", []), timings=timings)
+    state.timeline.setdefault("running", now)
+    state.timeline.setdefault("ready", now)
+    app.logger.info(f"job {job_id} ready on {state.ready['node']}")
+    if "kernel_exec" in timings and "ports_bound" in timings:
+        tracer.start("job kernel", state.traceparent or None, start_ns=timings["kernel_exec"], node=state.ready["node"]).end(timings["ports_bound"])
+    start_job_forwarding(job_id, state.ready["node"])
+    return "", 204
+
+
+@app.route("/stats/startup", methods=["GET"])
+@validate_auth
+def get_startup_stats():
+    """
+    Percentiles of the phases of kernel starts (submit, queue, tunnel, heartbeat, kernel_info, total), per cluster and spec
+
+    Args:
+        cluster (str, optional): only this cluster
+
+    """
+    cluster = request.args.get("cluster", type=str, default=None)
+    return jsonify(startup_stats.summary(cluster))
+
+
+@app.route("/trace", methods=["POST"])
+@validate_auth
+def record_trace():
+    """
+    Record the start timeline of a job script as spans, in the trace given by its traceparent header
+
+    Body (text):
+        one "<phase> <start_ns> <end_ns> [<node>]" line per phase
+
+    """
+    traceparent = request.headers.get("traceparent")
+    for line in request.get_data(as_text=True).splitlines():
+        parts = line.split()
+        if len(parts) not in [3, 4] or not parts[1].isdigit() or not parts[2].isdigit():
+            continue
+        span = tracer.start(f"job {parts[0]}", traceparent, start_ns=int(parts[1]), node=parts[3] if len(parts) == 4 else None)
+        span.end(int(parts[2]))
+    return "", 204
+
+
+def not_admitted(e: AdmissionException):
+    response = jsonify(dict(error=e.reason, retry_after=e.retry_after))
+    response.status_code = 429
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
+
 @app.route("/provision", methods=["POST"])
 @validate_auth
 def provision_kernel():
@@ -196,52 +867,133 @@ def provision_kernel():
 
     Return:
         job_id (str): ID of provisioned kernel
+        ports (list): port map of the kernel
+        placement (dict): partition/qos chosen for fastest_start, with the start estimates, or None
+        cluster (str): cluster the kernel runs on (chosen by routing for the "any" cluster)
+
+    Requests that are not admitted (login node busy, user over quota) get a 429 with Retry-After. Clusters that keep failing (open circuit) get a 503.
 
     """
+    requested = time.time()
     payload: dict = msgpack.loads(request.get_data())  # type: ignore
     data = ProvisionRequest(**payload)
 
     username = request.args.get("user", type=str, default="")
     user_config = get_user_config(username)
+
+    # route kernels of the virtual "any" cluster to the cluster expected to start them first
+    trace = None
+    if data.cluster == ANY_CLUSTER and routable(user_config.clusters):
+        try:
+            with tracer.span("routing"):
+                # querying each cluster takes a slot on its login too, without counting against the quota
+                slot = lambda cfg: admission.slot(username, cfg.loginnode or "localhost", user_config.weight, quota=False)
+                data.cluster, trace = router.route(username, user_config.clusters, data.spec, make_api, slot)
+        except NoEligibleClusterException:
+            return "No Eligible Cluster", 503
+        except AdmissionException as e:
+            return not_admitted(e)
+        data.workdir = data.workdir or user_config.clusters[data.cluster].workdir
     cluster_cfg = user_config.clusters[data.cluster]
+    api = make_api(cluster_cfg)
 
-    arg_sbatch_opts = "\n".join([f"#SBATCH --{k}={v}" for k, v in data.spec.items()])
-    arg_env_vars = "\n".join([f"export {k}={v}" for k, v in cluster_cfg.env.items()])
-    arg_exec_command = " ".join(cluster_cfg.argv).format(connection_file="$tmpfile", exec_path=data.exec_path or cluster_cfg.exec_path)
-    arg_lmod_modules = "module load " + " ".join(cluster_cfg.lmod_modules) if len(cluster_cfg.lmod_modules) else ""
-    arg_connection_info = json.dumps(sanitize(data.connection_info))
-    arg_workdir_command = f"cd {data.workdir}" if data.workdir else ""
-    arg_user_scripts = data.user_scripts
-
-    with open(TEMPLATE_DIR / "sbatch.sh", "r") as f:
-        job_script = f.read().format(
-            SBATCH_OPTS=arg_sbatch_opts,
-            CONNECTION_INFO=arg_connection_info,
-            ENV_VARS=arg_env_vars,
-            LMOD_MODULES=arg_lmod_modules,
-            WORKDIR_COMMAND=arg_workdir_command,
-            USER_SCRIPTS=arg_user_scripts,
-            EXEC_COMMAND=arg_exec_command,
-        )
-
-    api = SlurmAPI(app.logger)
-    api.ssh_prefix = api.build_ssh_command(cluster_cfg.username, cluster_cfg.loginnode, cluster_cfg.proxyjump)
-    job_id = api.launch_job(job_script)
-    port_map = generate_port_map(data.connection_info, fwd_ports)
-    # save job state
-    state_var[job_id] = JobState(
-        api=api,
-        username=data.username,
-        gateway_url=data.gateway_url,
-        cluster=cluster_cfg,
-        transport=data.transport,
-        spec=data.spec,
-        connection_info=data.connection_info,
-        port_map=port_map,
-        forwarding=False,
-        workdir=data.workdir,
-    )
-    return jsonify(sanitize(dict(job_id=job_id, ports=port_map)))
+    # bursts of provision requests queue up for the login node instead of all running sbatch at once
+    request_span = current_span.get()
+    queued = tracer.start("admission")
+    try:
+        with admission.slot(username, cluster_cfg.loginnode or "localhost", user_config.weight):
+            queued.end()
+            # pick the partition and qos that would start soonest (routing already estimated them)
+            choice = None
+            if data.fastest_start or trace is not None:
+                with tracer.span("placement"):
+                    choice = placement.choose(api, username, data.cluster, cluster_cfg, data.spec)
+                if choice is not None:
+                    data.spec.update({k: choice[k] for k in ["partition", "qos"] if k in choice})
+
+            arg_sbatch_opts = "\n".join([f"#SBATCH --{k}={v}" for k, v in data.spec.items()])
+            arg_env_vars = "\n".join([f"export {k}={v}" for k, v in cluster_cfg.env.items()])
+            arg_exec_command = " ".join(cluster_cfg.argv).format(connection_file="$tmpfile", exec_path=data.exec_path or cluster_cfg.exec_path)
+            arg_lmod_modules = "module load " + " ".join(cluster_cfg.lmod_modules) if len(cluster_cfg.lmod_modules) else ""
+            arg_connection_info = json.dumps(sanitize(data.connection_info))
+            arg_workdir_command = f"cd {data.workdir}" if data.workdir else ""
+            arg_user_scripts = data.user_scripts
+            # let the job script send the timeline of its start back into the trace of this request
+            arg_trace_env = ""
+            if tracer.enabled and request_span is not None:
+                trace_url = f"{get_gateway_url()}/trace?user={username}"
+                arg_trace_env = f"export CYBERSHUTTLE_TRACEPARENT={request_span.traceparent}\nexport CYBERSHUTTLE_TRACE_URL='{trace_url}'\ncs_last={time.time_ns()}"
+            # let the job report its kernel ready (ports bound), authenticated by a token of its own
+            ready_token = secrets.token_urlsafe(32)
+            kernel_ports = " ".join(str(data.connection_info[p]) for p in fwd_ports)
+            kernel_ip = data.connection_info.get("ip", "127.0.0.1")
+            arg_ready_env = "\n".join(
+                [
+                    f"export CYBERSHUTTLE_GATEWAY_URL='{get_gateway_url()}'",
+                    f"export CYBERSHUTTLE_USER='{username}'",
+                    f"export CYBERSHUTTLE_READY_TOKEN='{ready_token}'",
+                    f"export CYBERSHUTTLE_KERNEL_PORTS='{kernel_ports}'",
+                    f"export CYBERSHUTTLE_KERNEL_IP='{'127.0.0.1' if kernel_ip in ['', '0.0.0.0', '*'] else kernel_ip}'",
+                ]
+            )
+
+            with open(TEMPLATE_DIR / "sbatch.sh", "r") as f:
+                job_script = f.read().format(
+                    SBATCH_OPTS=arg_sbatch_opts,
+                    CONNECTION_INFO=arg_connection_info,
+                    ENV_VARS=arg_env_vars,
+                    LMOD_MODULES=arg_lmod_modules,
+                    WORKDIR_COMMAND=arg_workdir_command,
+                    USER_SCRIPTS=arg_user_scripts,
+                    TRACE_ENV=arg_trace_env,
+                    READY_ENV=arg_ready_env,
+                    EXEC_COMMAND=arg_exec_command,
+                )
+
+            job_id = api.launch_job(job_script)
+            submitted = time.time()
+            port_map = generate_port_map(data.connection_info, fwd_ports)
+            tunnel_map = port_map
+            proxy = capture = activity = None
+            # idle kernels are culled based on the traffic seen by a proxy
+            if cluster_cfg.cull_idle_timeout > 0:
+                activity = culler.track(job_id, cluster_cfg.cull_idle_timeout, cluster_cfg.cull_warning)
+            if capture_dir is not None or activity is not None:
+                tunnel_map = generate_tunnel_map(port_map)
+                proxy, capture = start_proxy(job_id, port_map, tunnel_map, activity)
+            # save job state
+            state_var[job_id] = JobState(
+                api=api,
+                username=username,
+                gateway_url=data.gateway_url,
+                cluster=cluster_cfg,
+                cluster_name=data.cluster,
+                transport=data.transport,
+                spec=data.spec,
+                connection_info=data.connection_info,
+                port_map=port_map,
+                tunnel_map=tunnel_map,
+                forwarding=False,
+                workdir=data.workdir,
+                proxy=proxy,
+                capture=capture,
+                activity=activity,
+                routing=trace,
+                restore=data.restore,
+                traceparent=request_span.traceparent if request_span is not None else "",
+                timeline=dict(requested=requested, submitted=submitted),
+                ready_token=ready_token,
+            )
+            if trace is not None:
+                router.record(trace, job_id)
+    except ClusterUnreachableException as e:
+        # includes an open circuit, and an sbatch that timed out (a job it may still have submitted is cancelled, see SlurmAPI.launch_job)
+        return jsonify(dict(error=str(e))), 503
+    except AdmissionException as e:
+        queued.fail(e.reason)
+        queued.end()
+        return not_admitted(e)
+    return jsonify(sanitize(dict(job_id=job_id, ports=port_map, placement=choice, cluster=data.cluster)))
 
 
 if __name__ == "__main__":
@@ -250,10 +1002,53 @@ if __name__ == "__main__":
     parser.add_argument("--host", "-H", type=str, default="0.0.0.0", help="Host to run gateway server")
     parser.add_argument("--port", "-p", type=int, default=9000, help="Port to run gateway server")
     parser.add_argument("--config_file", "-f", type=str, default="~/.local/etc/cybershuttle/user_config.json")
+    parser.add_argument("--capture_dir", type=str, default="", help="Record proxied kernel channels into this directory")
+    parser.add_argument("--placement_ttl", type=float, default=60.0, help="Seconds to reuse sbatch --test-only start estimates")
+    parser.add_argument("--routing_ttl", type=float, default=30.0, help="Seconds to reuse queue summaries when routing \"any\" kernels")
+    parser.add_argument("--routing_log", type=str, default="", help="Append routing decision traces (JSON lines) to this file")
+    parser.add_argument("--cull_interval", type=float, default=30.0, help="Seconds between checks for idle kernels")
+    parser.add_argument("--command_timeout", type=float, default=10.0, help="Seconds before a remote command (squeue, scancel, ...) is killed")
+    parser.add_argument("--submit_timeout", type=float, default=120.0, help="Seconds before a job submission (sbatch) is killed")
+    parser.add_argument("--stale_limit", type=float, default=600.0, help="Seconds to serve the last known job status while its cluster cannot be reached")
+    parser.add_argument("--breaker_threshold", type=int, default=5, help="Consecutive failures of a cluster before its commands fail fast")
+    parser.add_argument("--breaker_reset", type=float, default=30.0, help="Seconds to fail fast before trying a cluster again")
+    parser.add_argument("--trace_file", type=str, default="", help="Append launch traces (OTLP/JSON, one export per line) to this file")
+    parser.add_argument("--trace_endpoint", type=str, default="", help="Post launch traces to this OTLP/HTTP collector (e.g. http://localhost:4318)")
+    parser.add_argument("--startup_history", type=int, default=1000, help="Kernel startup timelines kept for /stats/startup")
+    parser.add_argument("--ssh_concurrency", type=int, default=4, help="Provision requests running SSH commands on a login node at once")
+    parser.add_argument("--user_quota", type=int, default=8, help="Outstanding kernel jobs per user")
+    parser.add_argument("--admission_queue", type=int, default=64, help="Provision requests waiting per login node before rejecting with 429")
+    parser.add_argument("--admission_wait", type=float, default=60.0, help="Seconds a provision request may wait for a login node slot")
+    parser.add_argument("--capture_bodies", type=str, default="none", choices=BODY_MODES, help="Message bodies to keep in captures")
     args = parser.parse_args()
 
     # make config file path absolute
     config_file = Path(os.path.expandvars(args.config_file)).expanduser().absolute()
     print(f"config_file={config_file}")
 
+    if args.capture_dir:
+        capture_dir = Path(os.path.expandvars(args.capture_dir)).expanduser().absolute()
+        capture_bodies = args.capture_bodies
+        print(f"capture_dir={capture_dir}, capture_bodies={capture_bodies}")
+
+    placement.ttl = args.placement_ttl
+    router.ttl = args.routing_ttl
+    culler.interval = args.cull_interval
+    command_timeout = args.command_timeout
+    submit_timeout = args.submit_timeout
+    stale_limit = args.stale_limit
+    breakers.threshold = args.breaker_threshold
+    breakers.reset_timeout = args.breaker_reset
+    admission.concurrency = args.ssh_concurrency
+    admission.quota = args.user_quota
+    admission.max_queue = args.admission_queue
+    admission.max_wait = args.admission_wait
+    culler.start()
+    startup_stats = StartupStats(args.startup_history)
+    if args.trace_file:
+        tracer.file = Path(os.path.expandvars(args.trace_file)).expanduser().absolute()
+    tracer.endpoint = args.trace_endpoint
+    if args.routing_log:
+        router.trace_file = Path(os.path.expandvars(args.routing_log)).expanduser().absolute()
+
     app.run(host=args.host, port=args.port)
@@ -0,0 +1,166 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+from logging import Logger
+from typing import Callable, Iterator
+
+from cybershuttle_gateway.exceptions import AdmissionException
+from cybershuttle_gateway.metrics import Labels, Metrics
+
+
+class Ticket:
+    """
+    A provision request waiting for a slot on a login node
+
+    """
+
+    def __init__(self, username: str, start: float, finish: float, counted: bool = True):
+        super().__init__()
+        self.username = username
+        # whether the request counts against the user's quota (see Admission.slot)
+        self.counted = counted
+        # virtual start/finish tags of start-time fair queueing
+        self.start = start
+        self.finish = finish
+        self.enqueued = time.monotonic()
+        self.granted = threading.Event()
+
+
+class Admission:
+    """
+    Admit provision requests, so that bursts do not turn into unbounded sbatch calls on a login node
+
+    At most `concurrency` requests run their SSH commands (placement and
+    submission) on a login node at once. Users may have at most `quota`
+    outstanding jobs (running, pending or being provisioned). Requests beyond
+    the concurrency wait, and slots go to waiting users in weighted fair
+    order (start-time fair queueing: each user's requests get virtual
+    finish tags 1/weight apart, and the smallest tag is served first), so one
+    user looping over /provision does not starve the others. Requests are
+    rejected with a retry delay when the queue is full, when they waited
+    max_wait seconds, or when the user is over quota. Requests that only
+    query a login node (e.g. routing a kernel to a cluster) take a slot too,
+    but do not count against the quota.
+
+    """
+
+    def __init__(
+        self,
+        logger: Logger,
+        metrics: Metrics,
+        outstanding: Callable[[str], int],
+        concurrency: int = 4,
+        quota: int = 8,
+        max_queue: int = 64,
+        max_wait: float = 60.0,
+    ):
+        super().__init__()
+        self.log = logger
+        self.metrics = metrics
+        self.outstanding = outstanding
+        self.concurrency = concurrency
+        self.quota = quota
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.running: dict[str, int] = {}
+        self.queues: dict[str, list[Ticket]] = {}
+        self.vtime: dict[str, float] = {}
+        self.last_finish: dict[tuple[str, str], float] = {}
+        self.admitting: dict[str, int] = {}
+        # moving average of seconds a slot is held, for Retry-After
+        self.service: dict[str, float] = {}
+        metrics.describe("admission_queue_depth", "gauge", "Provision requests waiting for a login node slot")
+        metrics.describe("admission_running", "gauge", "Provision requests holding a login node slot")
+        metrics.describe("admission_admitted_total", "counter", "Provision requests admitted")
+        metrics.describe("admission_wait_seconds_total", "counter", "Seconds admitted provision requests waited for a slot")
+        metrics.describe("admission_rejected_total", "counter", "Provision requests rejected with 429")
+        metrics.collect("admission_queue_depth", lambda: self.gauge(self.queues, len))
+        metrics.collect("admission_running", lambda: self.gauge(self.running, float))
+
+    def gauge(self, values: dict, value: Callable) -> dict[Labels, float]:
+        with self.lock:
+            return {(("login", k),): float(value(v)) for k, v in values.items()}
+
+    def retry_after(self, login: str, depth: int) -> int:
+        """
+        Seconds until a request queued behind depth others would likely get a slot
+
+        """
+        service = self.service.get(login, 1.0)
+        return max(1, math.ceil((depth + 1) * service / self.concurrency))
+
+    def reject(self, login: str, username: str, reason: str, retry_after: int) -> AdmissionException:
+        self.metrics.inc("admission_rejected_total", login=login, reason=reason)
+        self.log.warning(f"rejecting provision for {username}@{login}: {reason} (retry after {retry_after}s)")
+        return AdmissionException(reason, retry_after)
+
+    @contextmanager
+    def slot(self, username: str, login: str, weight: float = 1.0, quota: bool = True) -> Iterator[float]:
+        """
+        Hold a slot on a login node for the duration of the block
+
+        Args:
+            username (str): user provisioning the kernel
+            login (str): login node the SSH commands go to
+            weight (float): share of the user in fair queueing
+            quota (bool): whether the request submits a job, and counts against the user's quota
+
+        Return:
+            wait (float) seconds waited for the slot
+
+        Raises:
+            AdmissionException: when the request is not admitted, with a retry delay
+
+        """
+        ticket = self.enqueue(username, login, weight, quota)
+        if not ticket.granted.wait(self.max_wait):
+            with self.lock:
+                # granted just as the wait timed out
+                if not ticket.granted.is_set():
+                    self.queues[login].remove(ticket)
+                    self.admitting[username] -= int(ticket.counted)
+                    depth = len(self.queues[login])
+                    raise self.reject(login, username, "wait", self.retry_after(login, depth))
+        wait = time.monotonic() - ticket.enqueued
+        self.metrics.inc("admission_admitted_total", login=login)
+        self.metrics.inc("admission_wait_seconds_total", wait, login=login)
+        started = time.monotonic()
+        try:
+            yield wait
+        finally:
+            self.release(ticket, login, time.monotonic() - started)
+
+    def enqueue(self, username: str, login: str, weight: float, quota: bool = True) -> Ticket:
+        with self.lock:
+            if quota and self.outstanding(username) + self.admitting.get(username, 0) >= self.quota:
+                # a slot frees up when one of the user's jobs ends, which the gateway cannot predict
+                raise self.reject(login, username, "quota", 60)
+            queue = self.queues.setdefault(login, [])
+            if len(queue) >= self.max_queue:
+                raise self.reject(login, username, "queue", self.retry_after(login, len(queue)))
+            start = max(self.vtime.get(login, 0.0), self.last_finish.get((login, username), 0.0))
+            ticket = Ticket(username, start, start + 1.0 / max(weight, 1e-3), quota)
+            self.last_finish[(login, username)] = ticket.finish
+            self.admitting[username] = self.admitting.get(username, 0) + int(quota)
+            queue.append(ticket)
+            self.dispatch(login)
+        return ticket
+
+    def dispatch(self, login: str) -> None:
+        # called with the lock held
+        queue = self.queues[login]
+        while queue and self.running.get(login, 0) < self.concurrency:
+            ticket = min(queue, key=lambda t: (t.finish, t.enqueued))
+            queue.remove(ticket)
+            self.vtime[login] = ticket.start
+            self.running[login] = self.running.get(login, 0) + 1
+            ticket.granted.set()
+
+    def release(self, ticket: Ticket, login: str, held: float) -> None:
+        with self.lock:
+            self.running[login] -= 1
+            self.admitting[ticket.username] -= int(ticket.counted)
+            self.service[login] = 0.8 * self.service.get(login, held) + 0.2 * held
+            self.dispatch(login)
@@ -1,13 +1,144 @@
+import os
+from logging import Logger
+from subprocess import PIPE, Popen, TimeoutExpired
+from typing import Any
+
+from cybershuttle_gateway.breaker import CircuitBreaker
+from cybershuttle_gateway.exceptions import ClusterUnreachableException
+from cybershuttle_gateway.tracing import Tracer, current_span
+
+
 class APIBase:
+    """
+    Scheduler backend: launches kernel jobs, polls and signals them, and forwards their ports
+
+    Jobs are identified by integer IDs. Job states are reported as in SLURM
+    ("PENDING", "RUNNING", ...), with "UNKNOWN" for jobs that have ended,
+    "ERROR" when the scheduler could not tell, and "UNREACHABLE" when the
+    cluster could not be reached at all (see run_command).
+
+    """
+
+    log: Logger
+    ssh_prefix: list[str]
+    # deadline of remote commands (and of job submissions, which may not be retried), the circuit breaker of the cluster, and the tracer timing them (see run_command)
+    timeout: float = 10.0
+    submit_timeout: float = 120.0
+    breaker: CircuitBreaker | None = None
+    tracer: Tracer | None = None
 
     def __init__(self, **kwargs) -> None:
         pass
 
+    def run_command(self, command: list[str], input: bytes | None = None, timeout: float | None = None, name: str = "command") -> tuple[int, bytes, bytes]:
+        """
+        Run a command on the cluster with a deadline, through its circuit breaker
+
+        Timeouts, and SSH failing to reach the host (exit code 255), count as
+        failures of the cluster, and raise ClusterUnreachableException. Any
+        other exit code is the command's own.
+        Within a traced request, the command is timed as a span (named after
+        name), whose context is also given to the command as $TRACEPARENT.
+
+        Return:
+            returncode (int), stdout (bytes), stderr (bytes)
+
+        Raises:
+            CircuitOpenException: the cluster failed too often recently, the command was not run
+            ClusterUnreachableException: the command did not finish before the deadline (and was killed), or SSH could not connect
+
+        """
+        if self.tracer is None or current_span.get() is None:
+            return self._run_command(command, input, timeout or self.timeout, None)
+        host = self.ssh_prefix[-1] if self.ssh_prefix else "localhost"
+        with self.tracer.span(f"remote {name}", host=host) as span:
+            returncode, stdout, stderr = self._run_command(command, input, timeout or self.timeout, span.traceparent)
+            span.set(returncode=returncode)
+            return returncode, stdout, stderr
+
+    def _run_command(self, command: list[str], input: bytes | None, timeout: float, traceparent: str | None) -> tuple[int, bytes, bytes]:
+        if self.breaker is not None:
+            self.breaker.check()
+        env = None if traceparent is None else dict(os.environ, TRACEPARENT=traceparent)
+        process = Popen(command, stdout=PIPE, stderr=PIPE, stdin=PIPE, env=env)
+        try:
+            stdout, stderr = process.communicate(input=input, timeout=timeout)
+        except TimeoutExpired:
+            process.kill()
+            process.communicate()
+            if self.breaker is not None:
+                self.breaker.failure()
+            raise ClusterUnreachableException(f"command timed out after {timeout:g}s: {' '.join(command[:len(self.ssh_prefix) + 1])}")
+        if len(self.ssh_prefix) > 0 and process.returncode == 255:
+            if self.breaker is not None:
+                self.breaker.failure()
+            raise ClusterUnreachableException(f"cannot reach {self.ssh_prefix[-1]}: {stderr.decode().strip()}")
+        if self.breaker is not None:
+            self.breaker.success()
+        return process.returncode, stdout, stderr
+
+    def poll_job_status(self, job_id: int) -> tuple[str, str, str]:
+        raise NotImplementedError()
+
+    def poll_jobs_status(self, job_ids: list[int]) -> dict[str, tuple[str, str, str]]:
+        raise NotImplementedError()
+
+    def signal_job(self, job_id: int, signum: int) -> bool:
+        raise NotImplementedError()
+
+    def signal_jobs(self, job_ids: list[int], signum: int) -> dict[str, bool]:
+        raise NotImplementedError()
+
+    def launch_job(self, job_script: str) -> str:
+        raise NotImplementedError()
+
+    def estimate_start(self, job_script: str, options: dict[str, str] = {}) -> str | None:
+        raise NotImplementedError()
+
+    def queue_summary(self) -> dict[str, Any]:
+        raise NotImplementedError()
+
+    def start_forwarding(
+        self,
+        username: str,
+        compute_username: str,
+        execnode: str,
+        port_map: list[tuple[int, int]],
+        proxyjump: str = "",
+        loginnode: str = "",
+        localnode: str = "localhost",
+        bind_address: str = "*",
+    ) -> None:
+        raise NotImplementedError()
+
+    def close_forwarding(self) -> None:
+        raise NotImplementedError()
+
+    def build_ssh_command(self, username: str, loginnode: str, proxyjump: str = "") -> list[str]:
+        """
+        Create an SSH command for the given credentials and target
+
+        """
+        assert len(username) > 0
+        assert len(loginnode) > 0
+
+        ssh_command = ["ssh", "-tA"]
+        if len(proxyjump) > 0:
+            ssh_command.extend(["-J", f"{username}@{proxyjump}"])
+        ssh_command.extend([f"{username}@{loginnode}"])
+
+        self.log.debug(f"SSH command: {ssh_command}")
+
+        return ssh_command
+
 
+from cybershuttle_gateway.api.local import LocalAPI
 from cybershuttle_gateway.api.slurm import SlurmAPI
 
 
 def get_class_by_name(name: str) -> type[APIBase]:
     if name == "slurm":
         return SlurmAPI
+    if name == "local":
+        return LocalAPI
     raise ValueError(name)
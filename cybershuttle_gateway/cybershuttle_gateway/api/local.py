@@ -0,0 +1,334 @@
+import re
+import shlex
+from datetime import datetime
+from logging import Logger
+from typing import Any
+from signal import SIGKILL, SIGTERM
+from subprocess import PIPE, Popen
+
+from cybershuttle_gateway.api import APIBase
+from cybershuttle_gateway.exceptions import ClusterUnreachableException
+from cybershuttle_gateway.transport.zmq import ZMQTransport
+
+# kernel channels, in the order of the port map built by the gateway
+CHANNELS = ["shell", "iopub", "stdin", "hb", "control"]
+
+# every job script is saved under this name, which is how jobs are told apart from recycled PIDs
+# (ps -ww, so that the args are not cut to the width of a terminal, or of $COLUMNS)
+JOB_MARKER = "cybershuttle-job."
+
+# save the job script (stdin) and run it in its own session, under a transient
+# systemd scope with CPU and memory limits when the host has a user manager, or
+# with a virtual memory limit otherwise. A monitor enforces the time limit and
+# removes the script once the job has ended. Prints the PID, which is the job ID.
+#   $1 = cpus (0 = no limit), $2 = memory in MB (0 = no limit), $3 = time limit in seconds (0 = no limit)
+LAUNCH_SCRIPT = r"""
+cpus=$1; mem_mb=$2; limit=$3
+dir="$HOME/.cybershuttle/jobs"
+mkdir -p "$dir" || exit 1
+script=$(mktemp "$dir/cybershuttle-job.XXXXXX") || exit 1
+cat > "$script" || exit 1
+run=()
+if command -v systemd-run > /dev/null && systemd-run --user --scope --quiet true > /dev/null 2>&1; then
+  run=(systemd-run --user --scope --quiet)
+  [ "$cpus" -gt 0 ] && run+=(-p "CPUQuota=$((cpus * 100))%")
+  [ "$mem_mb" -gt 0 ] && run+=(-p "MemoryMax=${mem_mb}M")
+elif [ "$mem_mb" -gt 0 ]; then
+  ulimit -v $((mem_mb * 1024))
+fi
+cd "$HOME"
+setsid "${run[@]}" bash "$script" > "$script.log" 2>&1 < /dev/null &
+pid=$!
+setsid bash -c '
+  pid=$1; script=$2; limit=$3; sent=0
+  while state=$(ps -o stat= -p $pid) && [ "${state#Z}" = "$state" ]; do
+    if [ $limit -gt 0 ] && [ $SECONDS -ge $limit ]; then
+      if [ $sent -eq 0 ]; then kill -TERM $pid; sent=$SECONDS
+      elif [ $((SECONDS - sent)) -ge 30 ]; then kill -KILL -- -$pid; fi
+    fi
+    sleep 2
+  done
+  rm -f "$script"
+' _ $pid "$script" $limit > /dev/null 2>&1 < /dev/null &
+echo $pid
+"""
+
+# signal each job that is still ours; SIGKILL goes to the whole process group
+#   $1 = signal number, $2... = PIDs
+SIGNAL_SCRIPT = r"""
+sig=$1; shift
+for pid in "$@"; do
+  target=$pid
+  [ "$sig" = 9 ] && target=-$pid
+  if ps -ww -o args= -p $pid | grep -qF cybershuttle-job. && kill -s $sig -- $target; then
+    echo "ok $pid"
+  else
+    echo "failed $pid"
+  fi
+done
+"""
+
+
+def parse_memory_mb(value: str) -> int:
+    """
+    Read a SLURM memory size (e.g. "4G", "512M", "2048"; megabytes by default)
+
+    """
+    match = re.fullmatch(r"(\d+)([KMGT]?)B?", value.strip().upper())
+    if match is None:
+        raise ValueError(f"invalid memory size: {value}")
+    number, unit = int(match.group(1)), match.group(2) or "M"
+    return {"K": number // 1024, "M": number, "G": number * 1024, "T": number * 1024 * 1024}[unit]
+
+
+def parse_time_s(value: str) -> int:
+    """
+    Read a SLURM time limit ("MM", "MM:SS", "HH:MM:SS", "D-HH", "D-HH:MM", "D-HH:MM:SS")
+
+    """
+    value = value.strip()
+    if value.upper() in ["", "UNLIMITED", "INFINITE"]:
+        return 0
+    days = 0
+    if "-" in value:
+        d, value = value.split("-", 1)
+        days = int(d)
+        parts = [int(p) for p in value.split(":")] + [0] * (3 - len(value.split(":")))
+        hours, minutes, seconds = parts
+    else:
+        parts = [int(p) for p in value.split(":")]
+        if len(parts) == 1:
+            hours, minutes, seconds = 0, parts[0], 0
+        elif len(parts) == 2:
+            hours, minutes, seconds = 0, parts[0], parts[1]
+        else:
+            hours, minutes, seconds = parts
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def parse_limits(job_script: str) -> tuple[int, int, int]:
+    """
+    Get the resource limits requested by the #SBATCH lines of a job script
+
+    Return:
+        cpus (int), memory in MB (int), time limit in seconds (int), each 0 when not requested
+
+    """
+    opts: dict[str, str] = {}
+    for match in re.finditer(r"^#SBATCH\s+--([\w-]+)[=\s]+(\S+)", job_script, re.MULTILINE):
+        opts[match.group(1)] = match.group(2)
+    cpus = int(opts.get("cpus-per-task", 0))
+    mem_mb = 0
+    if "mem" in opts:
+        mem_mb = parse_memory_mb(opts["mem"])
+    elif "mem-per-cpu" in opts:
+        mem_mb = parse_memory_mb(opts["mem-per-cpu"]) * max(cpus, 1)
+    time_s = parse_time_s(opts.get("time", ""))
+    return cpus, mem_mb, time_s
+
+
+class LocalAPI(APIBase):
+    """
+    Run kernel jobs as supervised processes on the gateway host, or on an SSH host (no queue)
+
+    The job script is the same one that would be given to sbatch: its #SBATCH
+    lines set the CPU, memory and time limits. Job IDs are the PIDs of the
+    jobs, and the kernel ports are forwarded by an in-process channel proxy
+    (gateway host) or by SSH (SSH host).
+
+    """
+
+    def __init__(self, logger: Logger, ssh_prefix: list[str] = [], timeout: float = 10.0):
+        super().__init__()
+        self.log = logger
+        self.ssh_prefix = ssh_prefix
+        self.timeout = timeout
+        self.portfwd_process = None
+        self.proxy: ZMQTransport | None = None
+
+    @property
+    def node(self) -> str:
+        if len(self.ssh_prefix) == 0:
+            return "localhost"
+        return self.ssh_prefix[-1].split("@")[-1]
+
+    def run(self, script: str, args: list[str], input: str | None = None, timeout: float | None = None, name: str = "command") -> tuple[int, str, str]:
+        """
+        Run a bash script on the host of the jobs
+
+        Return:
+            returncode (int), stdout (str), stderr (str)
+
+        """
+        command = ["bash", "-c", script, "_"] + args
+        if len(self.ssh_prefix) > 0:
+            command = self.ssh_prefix + ["-T", shlex.join(command)]
+        returncode, stdout, stderr = self.run_command(command, input=None if input is None else input.encode(), timeout=timeout, name=name)
+        return returncode, stdout.decode(), stderr.decode()
+
+    def poll_job_status(self, job_id: int) -> tuple[str, str, str]:
+        """
+        Checks if a local job is still running.
+
+        Return:
+
+        job_state (str) one of ["RUNNING", "UNKNOWN", "ERROR", "UNREACHABLE"]
+        exec_node (str) host that job is running on
+
+        """
+        return self.poll_jobs_status([job_id])[str(job_id)]
+
+    def poll_jobs_status(self, job_ids: list[int]) -> dict[str, tuple[str, str, str]]:
+        """
+        Checks the state of many local jobs with a single ps.
+
+        Return:
+
+        {job_id (str): (job_state, exec_node, eta)} for each requested job.
+
+        """
+        ids = [str(j) for j in job_ids]
+        results = {job_id: ("UNKNOWN", "", "") for job_id in ids}
+        if not ids:
+            return results
+        self.log.info(f"requesting job states: {ids}")
+        try:
+            returncode, stdout, stderr = self.run('ps -ww -o pid=,stat=,args= -p "$1"', [",".join(ids)], name="ps")
+        except ClusterUnreachableException as e:
+            self.log.error(f"error in poll command: {e}")
+            return {job_id: ("UNREACHABLE", "", "") for job_id in ids}
+        except RuntimeError as e:
+            returncode, stdout, stderr = -1, "", str(e)
+        # ps exits with 1 when none of the processes exist
+        if returncode not in [0, 1]:
+            self.log.error(f"error in poll command: {stderr.strip()}")
+            return {job_id: ("ERROR", "", "") for job_id in ids}
+        for line in stdout.splitlines():
+            splits = line.strip().split(None, 2)
+            if len(splits) == 3 and splits[0] in results and JOB_MARKER in splits[2] and not splits[1].startswith("Z"):
+                results[splits[0]] = ("RUNNING", self.node, "N/A")
+        self.log.info(f"returning job states: {results}")
+        return results
+
+    def signal_job(self, job_id: int, signum: int) -> bool:
+        """
+        Issue signal to a running job.
+
+        """
+        status = self.signal_jobs([job_id], signum)[str(job_id)]
+        # other signals (e.g. SIGINT, or SIGUSR1 to restart the kernel) keep the job alive
+        if signum in [SIGTERM, SIGKILL]:
+            self.close_forwarding()
+        return status
+
+    def signal_jobs(self, job_ids: list[int], signum: int) -> dict[str, bool]:
+        """
+        Issue a signal to many jobs at once.
+
+        Return:
+
+        {job_id (str): success (bool)} for each job
+
+        """
+        ids = [str(j) for j in job_ids]
+        results = {job_id: False for job_id in ids}
+        if not ids:
+            return results
+        self.log.info(f"signaling kernel jobs ({ids}) on {self.node}: {signum}")
+        try:
+            _, stdout, stderr = self.run(SIGNAL_SCRIPT, [str(signum)] + ids, name="kill")
+        except RuntimeError as e:
+            self.log.error(f"error when signaling kernel jobs: {e}")
+            return results
+        for line in stdout.splitlines():
+            if len(splits := line.split()) == 2 and splits[1] in results:
+                results[splits[1]] = splits[0] == "ok"
+        if not all(results.values()):
+            self.log.error(f"error when signaling kernel jobs {[j for j, ok in results.items() if not ok]}: {stderr.strip()}")
+        return results
+
+    def close_forwarding(self) -> None:
+        if self.proxy is not None:
+            self.proxy.stop()
+            self.proxy = None
+        if self.portfwd_process is not None:
+            self.portfwd_process.terminate()
+            self.portfwd_process = None
+            self.log.info(f"SSH tunnel is now closed")
+
+    def launch_job(self, job_script: str) -> str:
+        """
+        Launch a local job and return its ID.
+
+        """
+        cpus, mem_mb, time_s = parse_limits(job_script)
+        self.log.info(f"Launching Kernel on {self.node} (cpus={cpus}, mem={mem_mb}M, time={time_s}s)")
+        returncode, stdout, stderr = self.run(LAUNCH_SCRIPT, [str(cpus), str(mem_mb), str(time_s)], input=job_script, timeout=self.submit_timeout, name="launch")
+        if returncode != 0:
+            raise RuntimeError(f"Launch command returned error code {returncode}:\n{stderr}\n")
+        self.log.info(f"Kernel Launched: {stdout.strip()}")
+
+        job_id = re.search(r"^(\d+)$", stdout, re.MULTILINE)
+        if job_id is None:
+            raise RuntimeError("Cannot find PID of local job in stdout")
+        return str(job_id.group(1))
+
+    def estimate_start(self, job_script: str, options: dict[str, str] = {}) -> str | None:
+        """
+        Local jobs start right away.
+
+        """
+        return datetime.now().isoformat(timespec="seconds")
+
+    def queue_summary(self) -> dict[str, Any]:
+        """
+        Local jobs do not queue: report the CPUs of the host.
+
+        """
+        returncode, stdout, stderr = self.run("date +%Y-%m-%dT%H:%M:%S && nproc", [], name="nproc")
+        if returncode != 0:
+            raise RuntimeError(f"cannot summarize host: {stderr.strip()}")
+        now, cpus = stdout.split()
+        return dict(now=now, idle_cpus=int(cpus), total_cpus=int(cpus), pending=0)
+
+    def start_forwarding(
+        self,
+        username: str,
+        compute_username: str,
+        execnode: str,
+        port_map: list[tuple[int, int]],
+        proxyjump: str = "",
+        loginnode: str = "",
+        localnode: str = "localhost",
+        bind_address: str = "*",
+    ) -> None:
+        """
+        Forward ports with a channel proxy (gateway host), or via SSH (SSH host)
+
+        """
+        assert len(port_map) > 0
+
+        if len(self.ssh_prefix) == 0:
+            channels = {name: (local, remote) for name, (remote, local) in zip(CHANNELS, port_map)}
+            self.proxy = ZMQTransport(self.log, channels, bind_address=bind_address, backend_host=localnode)
+            self.proxy.start()
+            return
+
+        assert len(username) > 0
+        assert len(loginnode) > 0
+
+        proxyjump_args = []
+        if len(proxyjump) > 0:
+            proxyjump_args.extend(["-J", f"{username}@{proxyjump}"])
+
+        portfwd_args = []
+        for remote, local in port_map:
+            portfwd_args.extend(["-L", f"{bind_address}:{local}:{localnode}:{remote}"])
+
+        ssh_command = ["ssh", "-gNA", "-o", "ServerAliveInterval=30", "-o", "ServerAliveCountMax=5"] + proxyjump_args + portfwd_args
+        ssh_command.append(f"{username}@{loginnode}")
+
+        self.log.info(f"Starting SSH tunnel from {loginnode} to {localnode}")
+        self.log.debug(f'SSH command: {" ".join(ssh_command)}')
+        self.portfwd_process = Popen(ssh_command, stdout=PIPE, stderr=PIPE)
+        self.log.info(f"SSH tunnel is now active")
@@ -1,16 +1,24 @@
 import re
+import shlex
+import threading
+import time
+import uuid
 from logging import Logger
-from subprocess import PIPE, Popen, TimeoutExpired, check_output
+from typing import Any
+from signal import SIGKILL, SIGTERM
+from subprocess import PIPE, Popen, check_output
 
 from cybershuttle_gateway.api import APIBase
+from cybershuttle_gateway.exceptions import CircuitOpenException, ClusterUnreachableException
 
 
 class SlurmAPI(APIBase):
 
-    def __init__(self, logger: Logger, ssh_prefix: list[str] = []):
+    def __init__(self, logger: Logger, ssh_prefix: list[str] = [], timeout: float = 10.0):
         super().__init__()
         self.log = logger
         self.ssh_prefix = ssh_prefix
+        self.timeout = timeout
         self.portfwd_process = None
 
     def poll_job_status(self, job_id: int) -> tuple[str, str, str]:
@@ -19,7 +27,7 @@ class SlurmAPI(APIBase):
 
         Return:
 
-        job_state (str) one of ["PENDING", "RUNNING", "UNKNOWN", "ERROR"]
+        job_state (str) one of ["PENDING", "RUNNING", "UNKNOWN", "ERROR", "UNREACHABLE"]
         exec_node (str) url of worker node that job is running on
 
         """
@@ -34,11 +42,18 @@ class SlurmAPI(APIBase):
         state = "UNKNOWN"
         node = eta = stdout = ""
         try:
-            stdout = check_output(poll_command).decode().strip()
+            returncode, out, err = self.run_command(poll_command, name="squeue")
+            # squeue fails outright for a job it no longer knows (ended, and purged by slurmctld)
+            if returncode != 0 and b"Invalid job id" not in err:
+                raise RuntimeError(err.decode().strip())
+            stdout = out.decode().strip()
             self.log.info(f"got job state: {stdout}")
-        except:
+        except ClusterUnreachableException as e:
+            state = "UNREACHABLE"
+            self.log.error(f"error in poll command: {e}")
+        except RuntimeError as e:
             state = "ERROR"
-            self.log.error(f"error in poll command")
+            self.log.error(f"error in poll command: {e}")
 
         if len(splits := stdout.split(" ")) == 3:
             state, node, eta = splits
@@ -46,6 +61,47 @@ class SlurmAPI(APIBase):
         self.log.info(f"returning job state: {state}, {node}, {eta}")
         return state, node, eta
 
+    def poll_jobs_status(self, job_ids: list[int]) -> dict[str, tuple[str, str, str]]:
+        """
+        Checks the state of many SLURM jobs with a single squeue.
+
+        Return:
+
+        {job_id (str): (job_state, exec_node, eta)} for each requested job.
+        Jobs no longer known to SLURM are reported as "UNKNOWN", and all jobs
+        are reported as "ERROR" if squeue failed, or "UNREACHABLE" if the
+        cluster could not be reached.
+
+        """
+        ids = [str(j) for j in job_ids]
+        results = {job_id: ("UNKNOWN", "", "") for job_id in ids}
+        if not ids:
+            return results
+        self.log.info(f"requesting job states: {ids}")
+        prefix = self.ssh_prefix.copy()
+        if len(prefix) > 0:
+            prefix.append("-T")
+        poll_command = prefix + ["bash", "-c", f"\"squeue -h -j {','.join(ids)} -o '%i %T %B %S'\""]
+        self.log.debug(f"poll command: {' '.join(poll_command)}")
+        try:
+            returncode, stdout, stderr = self.run_command(poll_command, name="squeue")
+        except ClusterUnreachableException as e:
+            self.log.error(f"error in poll command: {e}")
+            return {job_id: ("UNREACHABLE", "", "") for job_id in ids}
+        except RuntimeError as e:
+            self.log.error(f"error in poll command: {e}")
+            return {job_id: ("ERROR", "", "") for job_id in ids}
+        # squeue fails outright when given only ids it no longer knows
+        if returncode != 0 and b"Invalid job id" not in stderr:
+            self.log.error(f"error in poll command: {stderr.decode().strip()}")
+            return {job_id: ("ERROR", "", "") for job_id in ids}
+        for line in stdout.decode().splitlines():
+            if len(splits := line.strip().split(" ")) == 4 and splits[0] in results:
+                job_id, state, node, eta = splits
+                results[job_id] = (state, node, eta)
+        self.log.info(f"returning job states: {results}")
+        return results
+
     def signal_job(self, job_id: int, signum: int) -> bool:
         """
         Issue signal to a running job.
@@ -57,19 +113,57 @@ class SlurmAPI(APIBase):
         self.log.info(f"signaling kernel job ({job_id}): {signal_cmd_str}")
         status = None
         try:
-            stdout = check_output(signal_cmd).decode().strip()
-            self.log.info(f"kernel job signaled ({job_id}) - {stdout}")
+            returncode, stdout, stderr = self.run_command(signal_cmd, name="scancel")
+            if returncode != 0:
+                raise RuntimeError(stderr.decode().strip())
+            self.log.info(f"kernel job signaled ({job_id}) - {stdout.decode().strip()}")
             status = True
-        except:
-            self.log.error(f"error when signaling kernel job")
+        except RuntimeError as e:
+            self.log.error(f"error when signaling kernel job: {e}")
             status = False
+        # other signals (e.g. SIGINT, or SIGUSR1 to restart the kernel) keep the job alive
+        if signum in [SIGTERM, SIGKILL]:
+            self.close_forwarding()
+
+        return status
+
+    def signal_jobs(self, job_ids: list[int], signum: int) -> dict[str, bool]:
+        """
+        Issue a signal to many jobs with a single scancel.
+
+        Does not close SSH tunnels, which belong to the API of each job (see close_forwarding).
+
+        Return:
+
+        {job_id (str): success (bool)} for each job
+
+        """
+        ids = [str(j) for j in job_ids]
+        if not ids:
+            return {}
+        signal_cmd = self.ssh_prefix + ["bash", "-c", f"\"scancel -b -s {signum} {' '.join(ids)}\""]
+        self.log.info(f"signaling kernel jobs ({ids}): {' '.join(signal_cmd)}")
+        try:
+            returncode, _, stderr = self.run_command(signal_cmd, name="scancel")
+        except RuntimeError as e:
+            self.log.error(f"error when signaling kernel jobs {ids}: {e}")
+            return {job_id: False for job_id in ids}
+        if returncode == 0:
+            return {job_id: True for job_id in ids}
+        # scancel signals every job it can, and reports the others by id
+        errors = stderr.decode()
+        failed = {job_id for job_id in ids if re.search(rf"\b{re.escape(job_id)}\b", errors)}
+        if not failed:
+            failed = set(ids)
+        self.log.error(f"error when signaling kernel jobs {sorted(failed)}: {errors.strip()}")
+        return {job_id: job_id not in failed for job_id in ids}
+
+    def close_forwarding(self) -> None:
         if self.portfwd_process is not None:
             self.portfwd_process.terminate()
             self.portfwd_process = None
             self.log.info(f"SSH tunnel is now closed")
 
-        return status
-
     def launch_job(self, job_script: str) -> str:
         """
         Launch a SLURM job and return its ID.
@@ -81,16 +175,25 @@ class SlurmAPI(APIBase):
         spawn_cmd_str = " ".join(spawn_cmd)
         self.log.info(f"Launching Kernel: {spawn_cmd_str}")
 
+        # tag the job, so that it can be found if sbatch does not return its ID
+        tag = f"cybershuttle-{uuid.uuid4().hex}"
+        shebang, _, rest = job_script.partition("\n")
+        job_script = f"{shebang}\n#SBATCH --comment={tag}\n{rest}"
+
+        # sbatch may have submitted the job by the time a short deadline kills it, so it gets a longer one
         try:
-            spawn_process = Popen(spawn_cmd, stdout=PIPE, stderr=PIPE, stdin=PIPE)
-            stdout, stderr = spawn_process.communicate(input=job_script.encode(), timeout=10.0)
-            stdout = stdout.decode().strip()
-            stderr = stderr.decode().strip()
-            # check exit code
-            if not spawn_process.returncode == 0:
-                raise RuntimeError(f"SSH command returned error code {spawn_process.returncode}:\n{stderr}\n")
-        except TimeoutExpired:
-            raise RuntimeError(f"SSH command timed out:\n{spawn_cmd_str}\n")
+            returncode, out, err = self.run_command(spawn_cmd, input=job_script.encode(), timeout=self.submit_timeout, name="sbatch")
+        except CircuitOpenException:
+            raise
+        except ClusterUnreachableException:
+            # nobody would own a job submitted after all, so cancel it once the cluster answers again
+            threading.Thread(target=self.cancel_tagged, args=(tag,), name=f"cancel-{tag}", daemon=True).start()
+            raise
+        stdout = out.decode().strip()
+        stderr = err.decode().strip()
+        # check exit code
+        if not returncode == 0:
+            raise RuntimeError(f"SSH command returned error code {returncode}:\n{stderr}\n")
         self.log.info(f"Kernel Launched: {stdout}")
 
         # get SLURM job id from stdout
@@ -102,22 +205,99 @@ class SlurmAPI(APIBase):
 
         return job_id
 
-    def build_ssh_command(self, username: str, loginnode: str, proxyjump: str = "") -> list[str]:
+    def cancel_tagged(self, tag: str, attempts: int = 10, delay: float = 30.0) -> list[str]:
         """
-        Create an SSH command for the given credentials and target
+        Cancel the jobs of a submission (by the tag in their comment), retrying while the cluster cannot be reached
+
+        Return:
+            job_ids (list) the jobs that were cancelled
 
         """
-        assert len(username) > 0
-        assert len(loginnode) > 0
+        find_cmd = self.ssh_prefix + ["bash", "-c", "\"squeue -h -u $USER -o '%i %k'\""]
+        for _ in range(attempts):
+            time.sleep(delay)
+            try:
+                returncode, stdout, stderr = self.run_command(find_cmd, name="squeue")
+                if returncode != 0:
+                    raise RuntimeError(stderr.decode().strip())
+                job_ids = [line.split()[0] for line in stdout.decode().splitlines() if line.split()[1:] == [tag]]
+                if job_ids:
+                    returncode, _, stderr = self.run_command(self.ssh_prefix + ["bash", "-c", f"\"scancel {' '.join(job_ids)}\""], name="scancel")
+                    if returncode != 0:
+                        raise RuntimeError(stderr.decode().strip())
+                    self.log.warning(f"cancelled jobs {job_ids} of a submission whose sbatch timed out")
+                return job_ids
+            except RuntimeError as e:
+                self.log.error(f"could not look up jobs of a submission whose sbatch timed out ({tag}): {e}")
+        self.log.error(f"gave up on cancelling the jobs of a submission whose sbatch timed out ({tag})")
+        return []
+
+    def estimate_start(self, job_script: str, options: dict[str, str] = {}) -> str | None:
+        """
+        Ask SLURM when a job would start, without submitting it (sbatch --test-only).
 
-        ssh_command = ["ssh", "-tA"]
-        if len(proxyjump) > 0:
-            ssh_command.extend(["-J", f"{username}@{proxyjump}"])
-        ssh_command.extend([f"{username}@{loginnode}"])
+        Args:
+            options: sbatch options that override those of the job script (e.g. partition, qos)
 
-        self.log.debug(f"SSH command: {ssh_command}")
+        Return:
+
+        start (str) estimated start time (e.g. "2024-03-12T10:00:00"), or None if the job cannot be scheduled
 
-        return ssh_command
+        """
+        args = " ".join(f"--{k}={shlex.quote(str(v))}" for k, v in options.items())
+        prefix = self.ssh_prefix.copy()
+        if len(prefix) > 0:
+            prefix.append("-T")
+        test_cmd = prefix + ["bash", "-c", f"\"sbatch --test-only {args}\""]
+        self.log.debug(f"test command: {' '.join(test_cmd)}")
+        try:
+            returncode, stdout, stderr = self.run_command(test_cmd, input=job_script.encode(), name="sbatch --test-only")
+        except RuntimeError as e:
+            self.log.error(f"sbatch --test-only failed ({options}): {e}")
+            return None
+        # sbatch: Job 123 to start at 2024-03-12T10:00:00 using 1 processors on nodes node01 in partition cloud
+        output = (stdout + stderr).decode()
+        match = re.search(r"to start at (\S+)", output)
+        if returncode != 0 or match is None:
+            self.log.info(f"no start estimate for {options}: {output.strip()}")
+            return None
+        return match.group(1)
+
+    def queue_summary(self) -> dict[str, Any]:
+        """
+        Summarize the load of the cluster with one sinfo and one squeue.
+
+        Return:
+
+        {now (str) time on the cluster, idle_cpus (int), total_cpus (int), pending (int) jobs}
+
+        """
+        prefix = self.ssh_prefix.copy()
+        if len(prefix) > 0:
+            prefix.append("-T")
+        summary_cmd = prefix + ["bash", "-c", "\"date +%Y-%m-%dT%H:%M:%S && sinfo -h -N -o '%N %C' && echo @@ && squeue -h -t PENDING -o %i | wc -l\""]
+        self.log.debug(f"summary command: {' '.join(summary_cmd)}")
+        try:
+            returncode, out, err = self.run_command(summary_cmd, name="sinfo")
+            if returncode != 0:
+                raise RuntimeError(err.decode().strip())
+            stdout = out.decode()
+            now, rest = stdout.split("\n", 1)
+            nodes, pending = rest.split("@@\n")
+            # nodes are listed once per partition they are in
+            cpus: dict[str, tuple[int, int]] = {}
+            for line in nodes.splitlines():
+                node, states = line.split()
+                allocated, idle, other, total = [int(n) for n in states.split("/")]
+                cpus[node] = (idle, total)
+            return dict(
+                now=now.strip(),
+                idle_cpus=sum(idle for idle, _ in cpus.values()),
+                total_cpus=sum(total for _, total in cpus.values()),
+                pending=int(pending.strip()),
+            )
+        except Exception as e:
+            raise RuntimeError(f"cannot summarize queue: {e}")
 
     def start_forwarding(
         self,
@@ -128,6 +308,7 @@ class SlurmAPI(APIBase):
         proxyjump: str = "",
         loginnode: str = "",
         localnode: str = "localhost",
+        bind_address: str = "*",
     ) -> None:
         """
         Create a process to forward ports via SSH
@@ -147,7 +328,7 @@ class SlurmAPI(APIBase):
 
         portfwd_args = []
         for remote, local in port_map:
-            portfwd_args.extend(["-L", f"*:{local}:{localnode}:{remote}"])
+            portfwd_args.extend(["-L", f"{bind_address}:{local}:{localnode}:{remote}"])
 
         # NOTE first, clear known-hosts entry if exists
         clear_cmd = ["ssh-keygen", "-R", execnode]
@@ -0,0 +1,2 @@
+from cybershuttle_gateway.benchmark.echo_kernel import BenchClient, EchoKernel
+from cybershuttle_gateway.benchmark.paths import DirectPath, ProxyPath, SSHPath, TCPRelayPath, TransportPath
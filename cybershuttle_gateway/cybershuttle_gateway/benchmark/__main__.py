@@ -0,0 +1,150 @@
+"""
+Benchmark kernel transports against a local echo kernel
+
+    python -m cybershuttle_gateway.benchmark [--output results.json]
+
+Measures connection setup time, execute_request round-trip latency and
+iopub throughput for each transport path, on a single machine.
+
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import secrets
+import statistics
+import sys
+import time
+from typing import Any
+
+from cybershuttle_gateway import __version__
+from cybershuttle_gateway.benchmark.echo_kernel import BENCH_IOPUB, BenchClient, EchoKernel
+from cybershuttle_gateway.benchmark.paths import DirectPath, ProxyPath, SSHPath, TCPRelayPath, TransportPath
+from cybershuttle_gateway.transport import ZMQTransport, get_class_by_name
+
+TRANSPORT_NAMES = ["zmq", "websocket", "grpc", "kafka"]
+
+
+def summarize(samples: list[float]) -> dict[str, float]:
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return dict(
+        n=len(ordered),
+        mean_ms=statistics.fmean(ordered) * 1000,
+        p50_ms=pick(0.50) * 1000,
+        p90_ms=pick(0.90) * 1000,
+        p99_ms=pick(0.99) * 1000,
+        max_ms=ordered[-1] * 1000,
+    )
+
+
+def run_path(path: TransportPath, args: argparse.Namespace) -> dict[str, Any]:
+    ok, reason = path.available()
+    if not ok:
+        return dict(skipped=reason)
+
+    key = secrets.token_hex(16).encode()
+    kernel = EchoKernel(key)
+    kernel.start()
+    client = None
+    try:
+        # connection setup: path up + client connected + first kernel_info_reply
+        t0 = time.perf_counter()
+        ports = path.start(kernel.ports)
+        client = BenchClient(key, ports)
+        client.kernel_info(timeout=args.timeout)
+        setup_s = time.perf_counter() - t0
+
+        # execute_request round trips (request -> reply -> idle)
+        for _ in range(args.warmup):
+            client.execute("", timeout=args.timeout)
+        rtts = []
+        for _ in range(args.iterations):
+            t = time.perf_counter()
+            client.execute("", timeout=args.timeout)
+            rtts.append(time.perf_counter() - t)
+
+        # iopub throughput per payload size
+        throughput = {}
+        for size in args.sizes:
+            count = max(1, min(args.max_messages, args.bytes_per_size // size))
+            t = time.perf_counter()
+            num_messages, num_bytes = client.execute(f"{BENCH_IOPUB} {size} {count}", timeout=args.timeout)
+            elapsed = time.perf_counter() - t
+            throughput[str(size)] = dict(
+                messages=num_messages,
+                bytes=num_bytes,
+                elapsed_s=elapsed,
+                messages_per_s=num_messages / elapsed,
+                mb_per_s=num_bytes / elapsed / 1e6,
+            )
+        return dict(setup_ms=setup_s * 1000, execute_rtt=summarize(rtts), iopub=throughput)
+    except TimeoutError as e:
+        return dict(error=str(e))
+    finally:
+        if client is not None:
+            client.close()
+        path.stop()
+        kernel.stop()
+
+
+def get_paths(logger: logging.Logger, ssh_host: str) -> dict[str, TransportPath | str]:
+    """
+    Map each benchmarked path to its implementation, or to the reason it is skipped
+
+    """
+    paths: dict[str, TransportPath | str] = {"direct": DirectPath(logger)}
+    ssh = SSHPath(logger, ssh_host)
+    ok, _ = ssh.available()
+    paths["ssh"] = ssh if ok else TCPRelayPath(logger)
+    paths["agent"] = "cybershuttle_agent spawns its own ipykernel, so it cannot front the echo kernel"
+    for name in TRANSPORT_NAMES:
+        if get_class_by_name(name) is ZMQTransport:
+            paths[name] = ProxyPath(logger)
+        else:
+            paths[name] = f"{name} transport is not implemented in cybershuttle_gateway.transport"
+    return paths
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark kernel transports against a local echo kernel")
+    parser.add_argument("--output", "-o", type=str, default="", help="Write JSON results here instead of stdout")
+    parser.add_argument("--iterations", "-n", type=int, default=200, help="Number of timed execute_requests")
+    parser.add_argument("--warmup", type=int, default=20, help="Number of untimed execute_requests")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64, 1024, 65536, 1048576], help="iopub payload sizes (bytes)")
+    parser.add_argument("--bytes_per_size", type=int, default=64 * 1048576, help="Approximate bytes to publish per size")
+    parser.add_argument("--max_messages", type=int, default=20000, help="Cap on messages published per size")
+    parser.add_argument("--ssh_host", type=str, default="localhost", help="Host for the SSH path (stand-in used if unreachable)")
+    parser.add_argument("--only", type=str, nargs="*", default=[], help="Only run these paths")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger("benchmark")
+
+    results: dict[str, Any] = {}
+    for name, path in get_paths(logger, args.ssh_host).items():
+        if args.only and name not in args.only:
+            continue
+        print(f"benchmarking {name}...", file=sys.stderr)
+        if isinstance(path, str):
+            results[name] = dict(skipped=path)
+        else:
+            results[name] = dict(path=path.name, **run_path(path, args))
+
+    report = dict(
+        version=__version__,
+        timestamp=time.time(),
+        host=dict(node=platform.node(), platform=platform.platform(), python=platform.python_version(), cpus=os.cpu_count()),
+        params=dict(iterations=args.iterations, warmup=args.warmup, sizes=args.sizes, bytes_per_size=args.bytes_per_size),
+        results=results,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,188 @@
+import threading
+import time
+import uuid
+from typing import Any
+
+import zmq
+
+from cybershuttle_gateway.wire import DELIM, deserialize, new_message, serialize
+
+CHANNELS = ["shell", "iopub", "stdin", "hb", "control"]
+
+# execute_request code understood by the echo kernel:
+#   "%bench iopub <size> <count>" publishes <count> stream messages of <size> bytes
+BENCH_IOPUB = "%bench iopub"
+
+
+def _socket(ctx: zmq.Context, typ: int) -> zmq.Socket:
+    sock = ctx.socket(typ)
+    sock.setsockopt(zmq.LINGER, 0)
+    sock.setsockopt(zmq.SNDHWM, 0)
+    sock.setsockopt(zmq.RCVHWM, 0)
+    return sock
+
+
+class EchoKernel:
+    """
+    A stand-in kernel that speaks just enough of the Jupyter protocol to benchmark transports
+
+    It answers kernel_info_request and execute_request (with busy/idle status
+    on iopub), echoes heartbeats, and can flood iopub on request.
+
+    """
+
+    def __init__(self, key: bytes, host: str = "127.0.0.1") -> None:
+        super().__init__()
+        self.key = key
+        self.session = uuid.uuid4().hex
+        ctx = zmq.Context.instance()
+        self.sockets = {name: _socket(ctx, zmq.PUB if name == "iopub" else zmq.ROUTER) for name in CHANNELS}
+        self.ports = {name: sock.bind_to_random_port(f"tcp://{host}") for name, sock in self.sockets.items()}
+        self.thread: threading.Thread | None = None
+        self.running = False
+
+    def connection_info(self) -> dict[str, Any]:
+        info: dict[str, Any] = {f"{name}_port": port for name, port in self.ports.items()}
+        info.update(ip="127.0.0.1", transport="tcp", key=self.key.decode(), signature_scheme="hmac-sha256")
+        return info
+
+    def start(self) -> None:
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="echo-kernel", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(2.0)
+            self.thread = None
+        for sock in self.sockets.values():
+            sock.close()
+
+    def _publish(self, msg_type: str, content: dict[str, Any], parent: dict[str, Any]) -> None:
+        msg = new_message(msg_type, content, self.session, parent)
+        self.sockets["iopub"].send_multipart(serialize(msg, self.key, [f"kernel.{msg_type}".encode()]))
+
+    def _reply(self, channel: str, msg_type: str, content: dict[str, Any], parent: dict[str, Any]) -> None:
+        msg = new_message(msg_type, content, self.session, parent)
+        self.sockets[channel].send_multipart(serialize(msg, self.key, parent["identities"]))
+
+    def _handle(self, channel: str, frames: list[bytes]) -> None:
+        if channel == "hb":
+            self.sockets["hb"].send_multipart(frames)
+            return
+        if DELIM not in frames:
+            return
+        msg = deserialize(frames, self.key)
+        msg_type = msg["header"]["msg_type"]
+        self._publish("status", {"execution_state": "busy"}, msg)
+        if msg_type == "kernel_info_request":
+            content = dict(status="ok", protocol_version="5.3", implementation="echo", language_info={"name": "echo"})
+            self._reply(channel, "kernel_info_reply", content, msg)
+        elif msg_type == "execute_request":
+            code: str = msg["content"].get("code", "")
+            if code.startswith(BENCH_IOPUB):
+                size, count = [int(x) for x in code[len(BENCH_IOPUB) :].split()]
+                text = "x" * size
+                for _ in range(count):
+                    self._publish("stream", {"name": "stdout", "text": text}, msg)
+            self._reply(channel, "execute_reply", dict(status="ok", execution_count=1, user_expressions={}), msg)
+        elif msg_type == "shutdown_request":
+            self._reply(channel, "shutdown_reply", dict(status="ok", restart=False), msg)
+        self._publish("status", {"execution_state": "idle"}, msg)
+
+    def _run(self) -> None:
+        poller = zmq.Poller()
+        for name in ["shell", "control", "hb"]:
+            poller.register(self.sockets[name], zmq.POLLIN)
+        names = {self.sockets[name]: name for name in ["shell", "control", "hb"]}
+        while self.running:
+            for sock, _ in poller.poll(100):
+                self._handle(names[sock], sock.recv_multipart())
+
+
+class BenchClient:
+    """
+    A minimal Jupyter client used to time requests through a transport path
+
+    """
+
+    def __init__(self, key: bytes, ports: dict[str, int], host: str = "127.0.0.1") -> None:
+        super().__init__()
+        self.key = key
+        self.session = uuid.uuid4().hex
+        ctx = zmq.Context.instance()
+        self.shell = _socket(ctx, zmq.DEALER)
+        self.iopub = _socket(ctx, zmq.SUB)
+        self.iopub.setsockopt(zmq.SUBSCRIBE, b"")
+        self.shell.connect(f"tcp://{host}:{ports['shell']}")
+        self.iopub.connect(f"tcp://{host}:{ports['iopub']}")
+
+    def close(self) -> None:
+        self.shell.close()
+        self.iopub.close()
+
+    def request(self, msg_type: str, content: dict[str, Any]) -> str:
+        msg = new_message(msg_type, content, self.session)
+        self.shell.send_multipart(serialize(msg, self.key))
+        return msg["header"]["msg_id"]
+
+    def wait_reply(self, msg_id: str, timeout: float) -> dict[str, Any]:
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            if not self.shell.poll(int(remaining * 1000) + 1):
+                break
+            reply = deserialize(self.shell.recv_multipart(), self.key)
+            if reply["parent_header"].get("msg_id") == msg_id:
+                return reply
+        raise TimeoutError(f"no reply to {msg_id}")
+
+    def wait_idle(self, msg_id: str, timeout: float) -> tuple[int, int]:
+        """
+        Consume iopub until the kernel reports idle for msg_id
+
+        Return:
+
+        num_messages (int) stream messages received for msg_id
+        num_bytes (int) total size of those messages
+
+        """
+        num_messages = num_bytes = 0
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            if not self.iopub.poll(int(remaining * 1000) + 1):
+                break
+            frames = self.iopub.recv_multipart()
+            msg = deserialize(frames, self.key)
+            if msg["parent_header"].get("msg_id") != msg_id:
+                continue
+            if msg["header"]["msg_type"] == "stream":
+                num_messages += 1
+                num_bytes += sum(len(f) for f in frames)
+            elif msg["header"]["msg_type"] == "status" and msg["content"]["execution_state"] == "idle":
+                return num_messages, num_bytes
+        raise TimeoutError(f"kernel did not go idle for {msg_id}")
+
+    def kernel_info(self, timeout: float = 10.0) -> None:
+        """
+        Retry kernel_info_request until both shell and iopub answer
+
+        iopub is a PUB/SUB channel, so early status messages may be missed
+        while the subscription propagates.
+
+        """
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            msg_id = self.request("kernel_info_request", {})
+            try:
+                self.wait_reply(msg_id, remaining)
+                self.wait_idle(msg_id, min(0.2, max(remaining, 0.01)))
+                return
+            except TimeoutError:
+                continue
+        raise TimeoutError("kernel did not answer kernel_info_request")
+
+    def execute(self, code: str, timeout: float = 30.0) -> tuple[int, int]:
+        msg_id = self.request("execute_request", dict(code=code, silent=False, store_history=False))
+        self.wait_reply(msg_id, timeout)
+        return self.wait_idle(msg_id, timeout)
@@ -0,0 +1,180 @@
+import shutil
+import socket
+import subprocess
+import threading
+import time
+from logging import Logger
+
+from cybershuttle_gateway.transport import ZMQTransport
+from cybershuttle_gateway.util import get_ephemeral_ports
+
+
+def wait_for_port(port: int, timeout: float, host: str = "127.0.0.1") -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.1):
+                return
+        except OSError:
+            time.sleep(0.01)
+    raise TimeoutError(f"port {port} did not open")
+
+
+class TransportPath:
+    """
+    A way of getting from a client to the kernel ports, set up and torn down per run
+
+    """
+
+    name = ""
+
+    def __init__(self, logger: Logger) -> None:
+        super().__init__()
+        self.log = logger
+
+    def available(self) -> tuple[bool, str]:
+        return True, ""
+
+    def start(self, kernel_ports: dict[str, int]) -> dict[str, int]:
+        """
+        Start the path and return the client-facing port of each channel
+
+        """
+        raise NotImplementedError()
+
+    def stop(self) -> None:
+        pass
+
+
+class DirectPath(TransportPath):
+
+    name = "direct"
+
+    def start(self, kernel_ports: dict[str, int]) -> dict[str, int]:
+        return dict(kernel_ports)
+
+
+class ProxyPath(TransportPath):
+    """
+    The gateway's ZMQ channel proxy (see ZMQTransport)
+
+    """
+
+    name = "zmq"
+
+    def __init__(self, logger: Logger) -> None:
+        super().__init__(logger)
+        self.proxy: ZMQTransport | None = None
+
+    def start(self, kernel_ports: dict[str, int]) -> dict[str, int]:
+        ports = dict(zip(kernel_ports, get_ephemeral_ports(len(kernel_ports))))
+        channels = {name: (ports[name], kernel_ports[name]) for name in kernel_ports}
+        self.proxy = ZMQTransport(self.log, channels, bind_address="127.0.0.1")
+        self.proxy.start()
+        return ports
+
+    def stop(self) -> None:
+        if self.proxy is not None:
+            self.proxy.stop()
+            self.proxy = None
+
+
+class TCPRelayPath(TransportPath):
+    """
+    A byte-level TCP relay, standing in for an SSH -L tunnel when no local sshd is available
+
+    It adds the same extra hop (and copy) as a tunnel, without encryption.
+
+    """
+
+    name = "ssh-standin"
+
+    def __init__(self, logger: Logger) -> None:
+        super().__init__(logger)
+        self.listeners: list[socket.socket] = []
+        self.running = False
+
+    def _pump(self, src: socket.socket, dest: socket.socket) -> None:
+        try:
+            while data := src.recv(65536):
+                dest.sendall(data)
+        except OSError:
+            pass
+        finally:
+            for sock in [src, dest]:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def _accept(self, listener: socket.socket, target: int) -> None:
+        while self.running:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(("127.0.0.1", target))
+            for sock in [conn, upstream]:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._pump, args=(conn, upstream), daemon=True).start()
+            threading.Thread(target=self._pump, args=(upstream, conn), daemon=True).start()
+
+    def start(self, kernel_ports: dict[str, int]) -> dict[str, int]:
+        self.running = True
+        ports = {}
+        for name, target in kernel_ports.items():
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind(("127.0.0.1", 0))
+            listener.listen()
+            ports[name] = listener.getsockname()[1]
+            self.listeners.append(listener)
+            threading.Thread(target=self._accept, args=(listener, target), daemon=True).start()
+        return ports
+
+    def stop(self) -> None:
+        self.running = False
+        for listener in self.listeners:
+            listener.close()
+        self.listeners = []
+
+
+class SSHPath(TransportPath):
+    """
+    SSH -L forwarding through the local sshd, as done by SlurmAPI.start_forwarding
+
+    """
+
+    name = "ssh"
+
+    def __init__(self, logger: Logger, host: str = "localhost") -> None:
+        super().__init__(logger)
+        self.host = host
+        self.process: subprocess.Popen[bytes] | None = None
+
+    def available(self) -> tuple[bool, str]:
+        if shutil.which("ssh") is None:
+            return False, "ssh client not installed"
+        probe = ["ssh", "-o", "BatchMode=yes", "-o", "ConnectTimeout=2", "-o", "StrictHostKeyChecking=no", self.host, "true"]
+        try:
+            subprocess.run(probe, check=True, capture_output=True, timeout=5)
+        except (subprocess.SubprocessError, OSError):
+            return False, f"cannot ssh to {self.host} without a password"
+        return True, ""
+
+    def start(self, kernel_ports: dict[str, int]) -> dict[str, int]:
+        ports = dict(zip(kernel_ports, get_ephemeral_ports(len(kernel_ports))))
+        portfwd_args = []
+        for name, remote in kernel_ports.items():
+            portfwd_args.extend(["-L", f"127.0.0.1:{ports[name]}:127.0.0.1:{remote}"])
+        ssh_command = ["ssh", "-N", "-o", "BatchMode=yes", "-o", "StrictHostKeyChecking=no", "-o", "ExitOnForwardFailure=yes"]
+        self.process = subprocess.Popen(ssh_command + portfwd_args + [self.host], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        for port in ports.values():
+            wait_for_port(port, timeout=10.0)
+        return ports
+
+    def stop(self) -> None:
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
@@ -0,0 +1,104 @@
+import threading
+import time
+from typing import Any
+
+from cybershuttle_gateway.exceptions import CircuitOpenException
+from cybershuttle_gateway.metrics import Labels
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """
+    Fail fast on a cluster whose remote commands keep failing
+
+    closed: commands run, and `threshold` consecutive failures open the circuit.
+    open: commands fail right away (CircuitOpenException) for `reset_timeout` seconds.
+    half-open: a single trial command runs; its success closes the circuit, and its failure opens it again.
+
+    """
+
+    def __init__(self, name: str, threshold: int = 5, reset_timeout: float = 30.0):
+        super().__init__()
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.opened = 0
+        self.trial = False
+
+    def check(self) -> None:
+        """
+        Let a command through, or raise CircuitOpenException
+
+        """
+        with self.lock:
+            if self.state == OPEN:
+                assert self.opened_at is not None
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenException(self.name)
+                self.state = HALF_OPEN
+                self.trial = False
+            if self.state == HALF_OPEN:
+                if self.trial:
+                    raise CircuitOpenException(self.name)
+                self.trial = True
+
+    def success(self) -> None:
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.trial = False
+
+    def failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                if self.state != OPEN:
+                    self.opened += 1
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self.trial = False
+
+    def summary(self) -> dict[str, Any]:
+        return dict(state=self.state, failures=self.failures)
+
+
+class Breakers:
+    """
+    The circuit breakers of the gateway, one per login (SSH prefix) of the clusters
+
+    """
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30.0):
+        super().__init__()
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.breakers: dict[tuple[str, ...], CircuitBreaker] = {}
+
+    def get(self, ssh_prefix: list[str]) -> CircuitBreaker:
+        key = tuple(ssh_prefix)
+        with self.lock:
+            breaker = self.breakers.get(key)
+            if breaker is None:
+                # the gateway host itself when there is no SSH prefix
+                name = ssh_prefix[-1] if ssh_prefix else "localhost"
+                breaker = self.breakers[key] = CircuitBreaker(name, self.threshold, self.reset_timeout)
+            return breaker
+
+    def states(self) -> dict[Labels, float]:
+        with self.lock:
+            breakers = list(self.breakers.values())
+        codes = {CLOSED: 0.0, HALF_OPEN: 1.0, OPEN: 2.0}
+        return {(("login", b.name),): codes[b.state] for b in breakers}
+
+    def opened(self) -> dict[Labels, float]:
+        with self.lock:
+            breakers = list(self.breakers.values())
+        return {(("login", b.name),): float(b.opened) for b in breakers}
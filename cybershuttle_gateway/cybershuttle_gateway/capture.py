@@ -0,0 +1,131 @@
+"""
+Append-only capture log for proxied kernel channel traffic.
+
+Layout: a msgpack header map followed by one msgpack array per frame group
+
+    [t_ns, channel, direction, msg_type, n_ids, sizes, frames]
+
+t_ns is relative to the start of the capture. n_ids counts the routing
+frames before the <IDS|MSG> delimiter, or is -1 for frames outside the
+message protocol (heartbeats, subscriptions). frames is None unless bodies
+are recorded, in which case content and buffers may be redacted to filler
+of the same size so that replayed traffic keeps its shape.
+
+"""
+
+import json
+import time
+from pathlib import Path
+from typing import IO, Iterator, NamedTuple
+
+import msgpack
+
+from cybershuttle_gateway.wire import DELIM, get_msg_type, split_identities
+
+MAGIC = "cybershuttle-capture"
+VERSION = 1
+TO_KERNEL = 0
+TO_CLIENT = 1
+BODY_MODES = ["none", "redacted", "full"]
+
+
+class CaptureRecord(NamedTuple):
+    t_ns: int
+    channel: str
+    direction: int
+    msg_type: str
+    n_ids: int
+    sizes: list[int]
+    frames: list[bytes] | None
+
+
+def redact(frames: list[bytes]) -> list[bytes]:
+    """
+    Replace signature, content and buffers with same-sized filler.
+
+    Routing frames and headers are kept so that msg_type and parent
+    relationships survive.
+
+    """
+    identities, parts = split_identities(frames)
+    if len(parts) < 5:
+        return [bytes(len(f)) for f in frames]
+    signature, header, parent, metadata, content = parts[:5]
+    filler = json.dumps({"redacted": "x" * max(0, len(content) - 16)}).encode()
+    redacted = [bytes(len(signature)), header, parent, metadata, filler]
+    redacted += [bytes(len(b)) for b in parts[5:]]
+    return identities + [DELIM] + redacted
+
+
+class CaptureWriter:
+
+    def __init__(self, path: Path, job_id: str = "", bodies: str = "none", flush_every: int = 64):
+        super().__init__()
+        if bodies not in BODY_MODES:
+            raise ValueError(bodies)
+        self.path = path
+        self.bodies = bodies
+        self.flush_every = flush_every
+        self.num_records = 0
+        self.num_bytes = 0
+        self.t0 = time.monotonic_ns()
+        self.packer = msgpack.Packer()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.file: IO[bytes] | None = open(path, "ab")
+        header = dict(magic=MAGIC, version=VERSION, job_id=job_id, bodies=bodies, started=time.time())
+        self.file.write(self.packer.pack(header))
+
+    def record(self, channel: str, direction: int, frames: list[bytes]) -> None:
+        """
+        Append one frame group to the log.
+
+        """
+        if self.file is None:
+            return
+        t_ns = time.monotonic_ns() - self.t0
+        n_ids = frames.index(DELIM) if DELIM in frames else -1
+        sizes = [len(f) for f in frames]
+        body = None
+        if self.bodies == "full":
+            body = list(frames)
+        elif self.bodies == "redacted":
+            body = redact(frames)
+        rec = [t_ns, channel, direction, get_msg_type(frames), n_ids, sizes, body]
+        self.file.write(self.packer.pack(rec))
+        self.num_records += 1
+        self.num_bytes += sum(sizes)
+        if self.num_records % self.flush_every == 0:
+            self.file.flush()
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read_capture(path: Path) -> tuple[dict, Iterator[CaptureRecord]]:
+    """
+    Open a capture log and return its header and a record iterator.
+
+    A truncated trailing record (e.g. from a crashed gateway) is ignored.
+
+    """
+    f = open(path, "rb")
+    unpacker = msgpack.Unpacker(f, raw=False)
+    try:
+        header = next(unpacker)
+    except StopIteration:
+        f.close()
+        raise ValueError(f"empty capture log: {path}")
+    if not isinstance(header, dict) or header.get("magic") != MAGIC:
+        f.close()
+        raise ValueError(f"not a capture log: {path}")
+
+    def records() -> Iterator[CaptureRecord]:
+        try:
+            for rec in unpacker:
+                yield CaptureRecord(*rec)
+        finally:
+            f.close()
+
+    return header, records()
@@ -2,3 +2,6 @@ from os.path import dirname
 from pathlib import Path
 
 TEMPLATE_DIR = Path(dirname(__file__)) / "templates"
+
+# virtual cluster, whose kernels are routed to one of the user's clusters
+ANY_CLUSTER = "any"
@@ -0,0 +1,189 @@
+import json
+import threading
+import time
+from datetime import datetime
+from logging import Logger
+from typing import Any, Callable
+
+from cybershuttle_gateway.capture import TO_CLIENT, TO_KERNEL
+from cybershuttle_gateway.wire import split_identities
+
+# shell requests of clients remembered, to tell their busy/idle status apart from that of the gateway's own
+MAX_REQUESTS = 1024
+
+
+class ActivityTracker:
+    """
+    Track the activity of a kernel from the frames passing through its proxy
+
+    A kernel is active from an execute_request until its iopub status goes
+    back to idle; it is idle from then on. Idle time only counts once the job
+    is running (see mark_running). Register record() as a listener of the
+    job's proxy.
+
+    Only busy/idle status in reply to requests of the kernel's clients
+    counts. The gateway's own requests (snapshots, startup probes) go to the
+    kernel around the proxy, but their status passes through it.
+
+    """
+
+    def __init__(self, job_id: str, timeout: float, warning: float):
+        super().__init__()
+        self.job_id = job_id
+        self.timeout = timeout
+        self.warning = warning
+        self.started = time.time()
+        self.last_execute: float | None = None
+        self.last_busy: float | None = None
+        self.last_idle: float | None = None
+        self.busy = False
+        self.running = False
+        self.warned_at: float | None = None
+        # msg_ids of recent shell requests from clients, oldest first
+        self.requests: dict[str, None] = {}
+
+    def mark_running(self) -> None:
+        self.running = True
+        self.started = time.time()
+
+    def record(self, channel: str, direction: int, frames: list[bytes]) -> None:
+        if channel not in ["shell", "iopub"]:
+            return
+        _, parts = split_identities(frames)
+        if len(parts) < 5:
+            return
+        header = parts[1]
+        now = time.time()
+        if channel == "shell" and direction == TO_KERNEL:
+            try:
+                self.requests[json.loads(header)["msg_id"]] = None
+            except (ValueError, KeyError, TypeError):
+                return
+            if len(self.requests) > MAX_REQUESTS:
+                del self.requests[next(iter(self.requests))]
+            if b'"execute_request"' in header:
+                self.last_execute = now
+                self.warned_at = None
+        elif channel == "iopub" and direction == TO_CLIENT and b'"status"' in header:
+            try:
+                parent_id = json.loads(parts[2]).get("msg_id")
+                state = json.loads(parts[4]).get("execution_state")
+            except (ValueError, AttributeError):
+                return
+            if parent_id not in self.requests:
+                return
+            if state == "busy":
+                self.busy = True
+                self.last_busy = now
+                self.warned_at = None
+            elif state == "idle":
+                self.busy = False
+                self.last_idle = now
+
+    @property
+    def last_activity(self) -> float:
+        return max(t for t in [self.started, self.last_execute, self.last_busy, self.last_idle] if t is not None)
+
+    def idle_seconds(self, now: float | None = None) -> float:
+        if self.busy or not self.running:
+            return 0.0
+        return max(0.0, (now or time.time()) - self.last_activity)
+
+    @property
+    def cull_at(self) -> float:
+        return self.last_activity + self.timeout
+
+    def summary(self) -> dict[str, Any]:
+        return dict(
+            idle_s=round(self.idle_seconds(), 1),
+            busy=self.busy,
+            last_execute=self.last_execute,
+            last_busy=self.last_busy,
+            last_idle=self.last_idle,
+            cull_at=self.cull_at,
+        )
+
+    def warning_message(self) -> str | None:
+        if self.warned_at is None:
+            return None
+        since = datetime.fromtimestamp(self.last_activity).isoformat(timespec="seconds")
+        cull_at = datetime.fromtimestamp(self.cull_at).isoformat(timespec="seconds")
+        return f"kernel idle since {since}, will be shut down at {cull_at} unless used"
+
+
+class Culler:
+    """
+    Warn about, and then cull, kernels idle beyond the timeout of their cluster
+
+    Every interval seconds, kernels idle for (timeout - warning) seconds are
+    flagged with a warning, and kernels idle for timeout seconds are handed
+    to on_cull (which cancels the job and releases its resources).
+
+    """
+
+    def __init__(
+        self,
+        logger: Logger,
+        on_warn: Callable[[ActivityTracker], None],
+        on_cull: Callable[[ActivityTracker], None],
+        interval: float = 30.0,
+    ):
+        super().__init__()
+        self.log = logger
+        self.on_warn = on_warn
+        self.on_cull = on_cull
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.trackers: dict[str, ActivityTracker] = {}
+        # other periodic checks, run after each sweep
+        self.tasks: list[Callable[[], None]] = []
+        self.thread: threading.Thread | None = None
+        self.running = False
+
+    def track(self, job_id: str, timeout: float, warning: float) -> ActivityTracker:
+        tracker = ActivityTracker(job_id, timeout, warning)
+        with self.lock:
+            self.trackers[job_id] = tracker
+        return tracker
+
+    def untrack(self, job_id: str) -> None:
+        with self.lock:
+            self.trackers.pop(job_id, None)
+
+    def sweep(self) -> None:
+        now = time.time()
+        with self.lock:
+            trackers = list(self.trackers.values())
+        for tracker in trackers:
+            idle = tracker.idle_seconds(now)
+            try:
+                if idle >= tracker.timeout:
+                    # on_cull untracks the job once it is released, or it is tried again next sweep
+                    self.log.info(f"culling job {tracker.job_id}: idle for {idle:.0f}s (timeout={tracker.timeout:.0f}s)")
+                    self.on_cull(tracker)
+                elif idle >= tracker.timeout - tracker.warning and tracker.warned_at is None:
+                    tracker.warned_at = now
+                    self.log.info(f"job {tracker.job_id} idle for {idle:.0f}s, culling in {tracker.timeout - idle:.0f}s")
+                    self.on_warn(tracker)
+            except Exception:
+                self.log.exception(f"error culling job {tracker.job_id}")
+
+    def start(self) -> None:
+        if self.thread is not None:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="culler", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.running = False
+
+    def _run(self) -> None:
+        while self.running:
+            time.sleep(self.interval)
+            self.sweep()
+            for task in self.tasks:
+                try:
+                    task()
+                except Exception:
+                    self.log.exception(f"error in periodic task {task.__name__}")
@@ -1 +1,24 @@
 class NoUserConfigException(BaseException): ...
+
+
+class NoEligibleClusterException(BaseException): ...
+
+
+class SnapshotException(BaseException): ...
+
+
+class AdmissionException(BaseException):
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+# RuntimeErrors, like the other failures of remote commands, so callers that handle those fail fast too
+class ClusterUnreachableException(RuntimeError): ...
+
+
+class CircuitOpenException(ClusterUnreachableException):
+    def __init__(self, login: str):
+        super().__init__(f"circuit open for {login}: too many recent failures")
+        self.login = login
@@ -0,0 +1,62 @@
+import threading
+from typing import Callable
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = [(k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in labels]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class Metrics:
+    """
+    Counters and gauges of the gateway, rendered in the Prometheus text format
+
+    Gauges that are cheaper to compute on demand (e.g. number of jobs) are
+    registered as collectors, which are called on every render.
+
+    """
+
+    def __init__(self, prefix: str = "cybershuttle"):
+        super().__init__()
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.help: dict[str, tuple[str, str]] = {}
+        self.values: dict[str, dict[Labels, float]] = {}
+        self.collectors: dict[str, Callable[[], dict[Labels, float]]] = {}
+
+    def describe(self, name: str, kind: str, help: str) -> None:
+        self.help[name] = (kind, help)
+
+    def inc(self, name: str, value: float = 1.0, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values.setdefault(name, {})[key] = value
+
+    def collect(self, name: str, collector: Callable[[], dict[Labels, float]]) -> None:
+        self.collectors[name] = collector
+
+    def render(self) -> str:
+        with self.lock:
+            series = {name: dict(values) for name, values in self.values.items()}
+        for name, collector in self.collectors.items():
+            series[name] = collector()
+        lines = []
+        for name in sorted(series):
+            full_name = f"{self.prefix}_{name}"
+            if name in self.help:
+                kind, help = self.help[name]
+                lines.append(f"# HELP {full_name} {help}")
+                lines.append(f"# TYPE {full_name} {kind}")
+            for labels, value in sorted(series[name].items()):
+                lines.append(f"{full_name}{format_labels(labels)} {value!r}")
+        return "\n".join(lines) + "\n"
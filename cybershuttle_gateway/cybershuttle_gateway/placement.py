@@ -0,0 +1,112 @@
+import contextvars
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from logging import Logger
+from typing import Any
+
+from cybershuttle_gateway.api import APIBase
+from cybershuttle_gateway.typing import ClusterConfig
+
+
+def spec_shape(spec: dict[str, Any], chosen: set[str]) -> tuple[tuple[str, str], ...]:
+    """
+    The part of a spec that start estimates depend on, leaving out the options being chosen
+
+    """
+    return tuple(sorted((k, str(v)) for k, v in spec.items() if k not in chosen))
+
+
+def probe_script(spec: dict[str, Any]) -> str:
+    """
+    A job script with the resources of the spec, for sbatch --test-only (candidates override its options)
+
+    """
+    sbatch_opts = "\n".join([f"#SBATCH --{k}={v}" for k, v in spec.items()])
+    return f"#!/bin/bash\n{sbatch_opts}\nhostname\n"
+
+
+class Placement:
+    """
+    Pick the partition and qos with the earliest estimated start for a kernel job
+
+    Candidates are every (partition, qos) allowed for the cluster. Each is
+    estimated with sbatch --test-only, all in parallel, and the estimates are
+    reused for ttl seconds per (user, cluster, spec shape). Ties go to the
+    candidate listed first in the cluster config.
+
+    """
+
+    def __init__(self, logger: Logger, ttl: float = 60.0, workers: int = 8):
+        super().__init__()
+        self.log = logger
+        self.ttl = ttl
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="placement")
+        self.lock = threading.Lock()
+        self.cache: dict[tuple, tuple[float, list[dict[str, Any]]]] = {}
+
+    def candidates(self, cluster_cfg: ClusterConfig) -> list[dict[str, str]]:
+        partitions: list[str | None] = list(cluster_cfg.partitions) or [None]
+        qos: list[str | None] = list(cluster_cfg.qos) or [None]
+        options = []
+        for p, q in itertools.product(partitions, qos):
+            option = {}
+            if p is not None:
+                option["partition"] = p
+            if q is not None:
+                option["qos"] = q
+            options.append(option)
+        return options
+
+    def estimate(self, api: APIBase, key: tuple, spec: dict[str, Any], candidates: list[dict[str, str]]) -> tuple[list[dict[str, Any]], bool]:
+        """
+        Get the start estimates of all candidates, from the cache if fresh
+
+        Return:
+            estimates (list) [{partition, qos, start}] in candidate order, start is None when not schedulable
+            cached (bool) whether the estimates came from the cache
+
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                return entry[1], True
+
+        script = probe_script(spec)
+        # run each estimate in the context of the caller (e.g. its trace span)
+        context = contextvars.copy_context()
+        starts = list(self.pool.map(lambda option: context.copy().run(api.estimate_start, script, option), candidates))
+        estimates = [dict(**option, start=start) for option, start in zip(candidates, starts)]
+        with self.lock:
+            self.cache[key] = (time.monotonic(), estimates)
+            # drop stale entries, so the cache stays as small as the set of active shapes
+            for k in [k for k, (t, _) in self.cache.items() if time.monotonic() - t >= self.ttl]:
+                del self.cache[k]
+        return estimates, False
+
+    def choose(self, api: APIBase, username: str, cluster: str, cluster_cfg: ClusterConfig, spec: dict[str, Any]) -> dict[str, Any] | None:
+        """
+        Choose the partition and qos to run a spec with
+
+        Return:
+            choice (dict) {partition, qos, start, estimates, cached}, with partition/qos
+            set only when chosen (the cluster lists candidates), or None if no candidate could be estimated
+
+        """
+        candidates = self.candidates(cluster_cfg)
+        started = time.monotonic()
+        chosen = set(candidates[0])
+        estimates, cached = self.estimate(api, (username, cluster, spec_shape(spec, chosen)), spec, candidates)
+        schedulable = [e for e in estimates if e["start"] is not None]
+        if not schedulable:
+            self.log.warning(f"no start estimates for {username}@{cluster} ({spec}), keeping the requested spec")
+            return None
+        # ISO timestamps from the same controller sort by time
+        best = min(schedulable, key=lambda e: e["start"])
+        self.log.info(
+            f"placement for {username}@{cluster}: {best} of {len(estimates)} candidates "
+            f"({'cached' if cached else f'{time.monotonic() - started:.2f}s'})"
+        )
+        return dict(**best, estimates=estimates, cached=cached)
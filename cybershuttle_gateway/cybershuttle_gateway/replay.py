@@ -0,0 +1,255 @@
+"""
+Replay a capture log against a stand-in kernel and client
+
+    python -m cybershuttle_gateway.replay <capture.cslog> [--speed 1|N|max] [--direct]
+
+Client-to-kernel frames are sent by a stand-in client and kernel-to-client
+frames by a stand-in kernel, in recorded order and at recorded (scaled)
+timing. Unless --direct is given, traffic passes through a ZMQTransport
+proxy, so the report measures proxy throughput for that traffic pattern.
+
+"""
+
+import argparse
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+from typing import Any
+
+import zmq
+
+from cybershuttle_gateway.capture import TO_CLIENT, TO_KERNEL, CaptureRecord, read_capture
+from cybershuttle_gateway.transport import ZMQTransport
+from cybershuttle_gateway.util import get_ephemeral_ports
+from cybershuttle_gateway.wire import DELIM
+
+ROUTER_CHANNELS = ["shell", "control", "stdin", "hb"]
+CHANNELS = ROUTER_CHANNELS + ["iopub"]
+CLIENT_ID = b"replay-client"
+
+
+def pad_json(obj: Any, size: int) -> bytes:
+    # JSON allows trailing whitespace, so padding keeps frames parseable
+    data = json.dumps(obj).encode()
+    return data + b" " * max(0, size - len(data))
+
+
+def synthesize(rec: CaptureRecord) -> list[bytes]:
+    """
+    Rebuild frames of the recorded sizes for captures taken without bodies
+
+    """
+    if rec.n_ids < 0:
+        return [bytes(n) for n in rec.sizes]
+    ids = [bytes(n) for n in rec.sizes[: rec.n_ids]]
+    sizes = rec.sizes[rec.n_ids + 1 :]
+    parts = [bytes(n) for n in sizes]
+    if len(parts) >= 2:
+        parts[1] = pad_json({"msg_type": rec.msg_type}, sizes[1])
+    for i in range(2, min(len(parts), 5)):
+        parts[i] = pad_json({}, sizes[i])
+    return ids + [DELIM] + parts
+
+
+class StandIn:
+    """
+    A stand-in kernel (ROUTER/PUB) and client (DEALER/SUB) pair
+
+    """
+
+    def __init__(self, ctx: zmq.Context, host: str = "127.0.0.1") -> None:
+        super().__init__()
+        self.kernel: dict[str, zmq.Socket] = {}
+        self.client: dict[str, zmq.Socket] = {}
+        self.envelopes: dict[str, list[bytes]] = {}
+        self.kernel_ports: dict[str, int] = {}
+        for name in CHANNELS:
+            sock = ctx.socket(zmq.PUB if name == "iopub" else zmq.ROUTER)
+            sock.setsockopt(zmq.LINGER, 0)
+            sock.setsockopt(zmq.SNDHWM, 0)
+            sock.setsockopt(zmq.RCVHWM, 0)
+            self.kernel_ports[name] = sock.bind_to_random_port(f"tcp://{host}")
+            self.kernel[name] = sock
+
+    def connect_client(self, ctx: zmq.Context, ports: dict[str, int], host: str = "127.0.0.1") -> None:
+        for name in CHANNELS:
+            sock = ctx.socket(zmq.SUB if name == "iopub" else zmq.DEALER)
+            sock.setsockopt(zmq.LINGER, 0)
+            sock.setsockopt(zmq.SNDHWM, 0)
+            sock.setsockopt(zmq.RCVHWM, 0)
+            if name == "iopub":
+                sock.setsockopt(zmq.SUBSCRIBE, b"")
+            else:
+                sock.setsockopt(zmq.ROUTING_ID, CLIENT_ID)
+            sock.connect(f"tcp://{host}:{ports[name]}")
+            self.client[name] = sock
+
+    def handshake(self, timeout: float = 10.0) -> None:
+        """
+        Learn each channel's routing envelope and wait for iopub to connect
+
+        """
+        deadline = time.monotonic() + timeout
+        for name in ROUTER_CHANNELS:
+            self.client[name].send_multipart([DELIM])
+            if not self.kernel[name].poll(int(timeout * 1000)):
+                raise TimeoutError(f"no handshake on '{name}'")
+            frames = self.kernel[name].recv_multipart()
+            self.envelopes[name] = frames[: frames.index(DELIM)]
+        iopub, sub = self.kernel["iopub"], self.client["iopub"]
+        while time.monotonic() < deadline:
+            iopub.send_multipart([b"probe"])
+            if sub.poll(50):
+                sub.recv_multipart()
+                break
+        else:
+            raise TimeoutError("no handshake on 'iopub'")
+        # drop any probes still in flight
+        while sub.poll(50):
+            sub.recv_multipart()
+
+    def send(self, rec: CaptureRecord, frames: list[bytes]) -> bool:
+        if rec.channel == "iopub":
+            if rec.direction != TO_CLIENT:
+                return False  # subscriptions
+            self.kernel["iopub"].send_multipart(frames)
+            return True
+        # the first frame is the proxy-level routing id, replaced by our own
+        payload = frames[1:]
+        if rec.direction == TO_KERNEL:
+            self.client[rec.channel].send_multipart(payload)
+        else:
+            self.kernel[rec.channel].send_multipart(self.envelopes[rec.channel] + payload)
+        return True
+
+    def drain(self, counts: dict[str, list[int]]) -> None:
+        for name in CHANNELS:
+            for direction, sock in [(TO_CLIENT, self.client[name]), (TO_KERNEL, self.kernel[name])]:
+                if sock.type == zmq.PUB:
+                    continue
+                while True:
+                    try:
+                        frames = sock.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    key = "to_kernel" if direction == TO_KERNEL else "to_client"
+                    counts[key][0] += 1
+                    counts[key][1] += sum(len(f) for f in frames)
+
+    def close(self) -> None:
+        for sock in list(self.kernel.values()) + list(self.client.values()):
+            sock.close()
+
+
+def replay(
+    path: Path,
+    speed: float,
+    direct: bool = False,
+    timeout: float = 10.0,
+    logger: logging.Logger | None = None,
+) -> dict[str, Any]:
+    """
+    Replay a capture log and return a throughput report
+
+    Args:
+        path (Path): capture log to replay
+        speed (float): time scale factor, or 0 to send as fast as possible
+        direct (bool): connect client to kernel without a proxy in between
+
+    """
+    log = logger or logging.getLogger(__name__)
+    header, records = read_capture(path)
+    ctx = zmq.Context.instance()
+    standin = StandIn(ctx)
+
+    proxy = None
+    client_ports = standin.kernel_ports
+    if not direct:
+        client_ports = dict(zip(CHANNELS, get_ephemeral_ports(len(CHANNELS))))
+        channels = {name: (client_ports[name], standin.kernel_ports[name]) for name in CHANNELS}
+        proxy = ZMQTransport(log, channels, bind_address="127.0.0.1")
+        proxy.start()
+
+    sent = {"to_kernel": [0, 0], "to_client": [0, 0]}
+    received = {"to_kernel": [0, 0], "to_client": [0, 0]}
+    max_lag = 0.0
+    last_t = 0.0
+    try:
+        standin.connect_client(ctx, client_ports)
+        standin.handshake()
+        t0 = time.monotonic()
+        for rec in records:
+            last_t = rec.t_ns / 1e9
+            if speed > 0:
+                due = t0 + last_t / speed
+                while (now := time.monotonic()) < due:
+                    standin.drain(received)
+                    time.sleep(min(due - now, 0.001))
+                max_lag = max(max_lag, time.monotonic() - due)
+            frames = rec.frames if rec.frames is not None else synthesize(rec)
+            if standin.send(rec, frames):
+                key = "to_kernel" if rec.direction == TO_KERNEL else "to_client"
+                sent[key][0] += 1
+                sent[key][1] += sum(len(f) for f in frames)
+            if speed == 0 and sum(sent[k][0] for k in sent) % 64 == 0:
+                standin.drain(received)
+        # wait for everything in flight to arrive
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            standin.drain(received)
+            if all(received[k][0] >= sent[k][0] for k in sent):
+                break
+            time.sleep(0.001)
+        elapsed = time.monotonic() - t0
+    finally:
+        standin.close()
+        if proxy is not None:
+            proxy.stop()
+
+    total_messages = sum(v[0] for v in received.values())
+    total_bytes = sum(v[1] for v in received.values())
+    return dict(
+        capture=str(path),
+        job_id=header.get("job_id", ""),
+        bodies=header.get("bodies", "none"),
+        speed="max" if speed == 0 else speed,
+        via="direct" if direct else "proxy",
+        capture_duration_s=last_t,
+        elapsed_s=elapsed,
+        max_lag_ms=max_lag * 1000,
+        sent={k: dict(messages=v[0], bytes=v[1]) for k, v in sent.items()},
+        received={k: dict(messages=v[0], bytes=v[1]) for k, v in received.items()},
+        messages_per_s=total_messages / elapsed if elapsed > 0 else 0.0,
+        throughput_mb_s=total_bytes / elapsed / 1e6 if elapsed > 0 else 0.0,
+    )
+
+
+def parse_speed(value: str) -> float:
+    if value in ["max", "0"]:
+        return 0.0
+    speed = float(value.rstrip("x"))
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive or 'max'")
+    return speed
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Replay captured kernel traffic against a stand-in kernel and client")
+    parser.add_argument("capture", type=str, help="Capture log written by the gateway (--capture_dir)")
+    parser.add_argument("--speed", "-s", type=parse_speed, default=1.0, help="1 (recorded pace), N (N times faster) or max")
+    parser.add_argument("--direct", action="store_true", help="Skip the proxy and connect client to kernel directly")
+    parser.add_argument("--timeout", type=float, default=10.0, help="Seconds to wait for in-flight messages")
+    parser.add_argument("--output", "-o", type=str, default="", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    report = replay(Path(args.capture), args.speed, direct=args.direct, timeout=args.timeout)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,151 @@
+import contextvars
+import json
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from logging import Logger
+from pathlib import Path
+from typing import Any, Callable, ContextManager
+
+from cybershuttle_gateway.api import APIBase
+from cybershuttle_gateway.exceptions import NoEligibleClusterException
+from cybershuttle_gateway.placement import Placement
+from cybershuttle_gateway.typing import ClusterConfig
+
+
+def wait_seconds(start: str | None, now: str) -> float | None:
+    """
+    Seconds from now until an estimated start, both in the local time of the cluster
+
+    """
+    if start is None:
+        return None
+    try:
+        return max(0.0, (datetime.fromisoformat(start) - datetime.fromisoformat(now)).total_seconds())
+    except ValueError:
+        return None
+
+
+def rank(candidate: dict[str, Any]) -> tuple:
+    """
+    Order clusters by expected wait, then by idle CPUs and pending jobs
+
+    """
+    # estimates are to the minute in practice, so do not let seconds decide
+    wait = candidate["wait_s"] // 60 if candidate["wait_s"] is not None else math.inf
+    return (wait, -candidate["idle_cpus"], candidate["pending"])
+
+
+class Router:
+    """
+    Route kernels of the virtual "any" cluster to the user's cluster with the earliest expected start
+
+    Every cluster of the user is evaluated in parallel, from a queue summary
+    (one sinfo and one squeue, cached for ttl seconds per login) and a start
+    estimate for the spec (from placement, which caches its own), each while
+    holding a slot on the login of the cluster (see Admission). Clusters
+    that cannot be reached, or cannot schedule the spec, are not eligible.
+    Each decision is kept as a trace, and appended to trace_file if set.
+
+    """
+
+    def __init__(self, logger: Logger, placement: Placement, ttl: float = 30.0, trace_file: Path | None = None, workers: int = 8):
+        super().__init__()
+        self.log = logger
+        self.placement = placement
+        self.ttl = ttl
+        self.trace_file = trace_file
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="routing")
+        self.lock = threading.Lock()
+        self.summaries: dict[tuple[str, ...], tuple[float, dict[str, Any]]] = {}
+
+    def summary(self, api: APIBase) -> tuple[dict[str, Any], bool]:
+        key = (type(api).__name__, *api.ssh_prefix)
+        with self.lock:
+            entry = self.summaries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                return entry[1], True
+        summary = api.queue_summary()
+        with self.lock:
+            self.summaries[key] = (time.monotonic(), summary)
+        return summary, False
+
+    def evaluate(self, api: APIBase, username: str, cluster: str, cluster_cfg: ClusterConfig, spec: dict[str, Any]) -> dict[str, Any]:
+        candidate: dict[str, Any] = dict(cluster=cluster, eligible=False)
+        try:
+            summary, cached = self.summary(api)
+            candidate.update(summary, summary_cached=cached)
+            choice = self.placement.choose(api, username, cluster, cluster_cfg, spec)
+            if choice is None:
+                candidate.update(error="spec cannot be scheduled")
+                return candidate
+            candidate.update(
+                start=choice["start"],
+                wait_s=wait_seconds(choice["start"], summary["now"]),
+                placement={k: v for k, v in choice.items() if k in ["partition", "qos"]},
+                estimate_cached=choice["cached"],
+                eligible=True,
+            )
+        except Exception as e:
+            candidate.update(error=str(e))
+        return candidate
+
+    def route(
+        self,
+        username: str,
+        clusters: dict[str, ClusterConfig],
+        spec: dict[str, Any],
+        make_api: Callable[[ClusterConfig], APIBase],
+        slot: Callable[[ClusterConfig], ContextManager],
+    ) -> tuple[str, dict[str, Any]]:
+        """
+        Choose the cluster to run a spec on
+
+        Args:
+            slot: holds a slot on the login of a cluster while it is evaluated (raises AdmissionException)
+
+        Return:
+            cluster (str) name of the chosen cluster
+            trace (dict) {time, username, spec, candidates, cluster, elapsed_s}
+
+        """
+        started = time.monotonic()
+        names = list(clusters)
+
+        def evaluate(name: str) -> dict[str, Any]:
+            with slot(clusters[name]):
+                return self.evaluate(make_api(clusters[name]), username, name, clusters[name], spec)
+
+        # evaluate each cluster in the context of the caller (e.g. its trace span)
+        context = contextvars.copy_context()
+        candidates = list(self.pool.map(lambda name: context.copy().run(evaluate, name), names))
+        eligible = [c for c in candidates if c["eligible"]]
+        trace = dict(
+            time=datetime.now().isoformat(timespec="seconds"),
+            username=username,
+            spec=spec,
+            candidates=candidates,
+            cluster=None,
+            elapsed_s=round(time.monotonic() - started, 3),
+        )
+        if not eligible:
+            self.record(trace)
+            raise NoEligibleClusterException()
+        # ties go to the cluster listed first in the user config
+        best = min(eligible, key=rank)
+        trace["cluster"] = best["cluster"]
+        self.log.info(f"routing {username} to {best['cluster']} (wait={best['wait_s']}s) of {len(eligible)}/{len(candidates)} eligible clusters")
+        return best["cluster"], trace
+
+    def record(self, trace: dict[str, Any], job_id: str | None = None) -> None:
+        """
+        Append a decision trace to trace_file, for later tuning
+
+        """
+        if self.trace_file is None:
+            return
+        with self.lock:
+            with open(self.trace_file, "a") as f:
+                f.write(json.dumps(dict(trace, job_id=job_id)) + "\n")
@@ -0,0 +1,159 @@
+"""
+Snapshot the user namespace of a kernel, and restore it into another kernel
+
+The gateway sends a (silent) execute_request on the shell channel of the
+kernel, through its tunnel. The code serializes each variable of the user
+namespace with dill, cloudpickle or pickle (whichever the kernel has), skips
+modules, IPython internals and anything that cannot be serialized, writes the
+snapshot to node-local storage and then copies it to the shared workdir, so a
+kernel of a later allocation can load it.
+
+"""
+
+import ast
+import json
+import re
+import time
+import uuid
+from typing import Any
+
+import zmq
+
+from cybershuttle_gateway.exceptions import SnapshotException
+from cybershuttle_gateway.wire import deserialize, new_message, serialize
+
+# runs in the kernel; leaves only _cs_result behind, which the user expression pops
+SNAPSHOT_CODE = """
+def _cs_snapshot(name):
+    import json, os, pickle, shutil, tempfile, types
+    try:
+        import dill as serializer
+    except ImportError:
+        try:
+            import cloudpickle as serializer
+        except ImportError:
+            serializer = pickle
+    ip = get_ipython()
+    skip = set(ip.user_ns_hidden) | set(["In", "Out", "exit", "quit", "get_ipython"])
+    local_dir = os.environ.get("CYBERSHUTTLE_LOCAL_DIR") or tempfile.gettempdir()
+    shared_dir = os.environ.get("CYBERSHUTTLE_SNAPSHOT_DIR") or os.path.join(os.getcwd(), ".cybershuttle", "snapshots")
+    os.makedirs(shared_dir, exist_ok=True)
+    saved, skipped = [], []
+    fd, local_path = tempfile.mkstemp(dir=local_dir, suffix=".snapshot")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(dict(version=1, serializer=serializer.__name__), f)
+            for k, v in list(ip.user_ns.items()):
+                if k.startswith("_") or k in skip or isinstance(v, types.ModuleType):
+                    continue
+                try:
+                    data = serializer.dumps(v)
+                except Exception:
+                    skipped.append(k)
+                    continue
+                pickle.dump((k, data), f)
+                saved.append(k)
+        path = os.path.join(shared_dir, name + ".snapshot")
+        shutil.copyfile(local_path, path + ".tmp")
+        os.replace(path + ".tmp", path)
+    finally:
+        os.unlink(local_path)
+    return json.dumps(dict(path=path, saved=saved, skipped=skipped, bytes=os.path.getsize(path)))
+_cs_result = _cs_snapshot({name!r})
+del _cs_snapshot
+"""
+
+RESTORE_CODE = """
+def _cs_restore(path):
+    import importlib, json, os, pickle
+    ip = get_ipython()
+    if not os.path.isabs(path):
+        shared_dir = os.environ.get("CYBERSHUTTLE_SNAPSHOT_DIR") or os.path.join(os.getcwd(), ".cybershuttle", "snapshots")
+        path = os.path.join(shared_dir, path)
+    restored, failed = [], []
+    with open(path, "rb") as f:
+        header = pickle.load(f)
+        serializer = importlib.import_module(header["serializer"])
+        while True:
+            try:
+                k, data = pickle.load(f)
+            except EOFError:
+                break
+            try:
+                ip.user_ns[k] = serializer.loads(data)
+                restored.append(k)
+            except Exception:
+                failed.append(k)
+    return json.dumps(dict(path=path, restored=restored, failed=failed))
+_cs_result = _cs_restore({path!r})
+del _cs_restore
+"""
+
+RESULT_EXPRESSION = "get_ipython().user_ns.pop('_cs_result', None)"
+
+
+def snapshot_name(cluster: str, job_id: str, reason: str) -> str:
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    return re.sub(r"[^a-zA-Z0-9._-]", "_", f"{cluster}-{job_id}-{reason}-{stamp}")
+
+
+def execute(host: str, port: int, key: bytes, code: str, timeout: float) -> dict[str, Any]:
+    """
+    Run code silently in a kernel, and return the JSON result it leaves in _cs_result
+
+    """
+    ctx = zmq.Context.instance()
+    sock = ctx.socket(zmq.DEALER)
+    sock.setsockopt(zmq.LINGER, 0)
+    sock.connect(f"tcp://{host}:{port}")
+    try:
+        content = dict(
+            code=code,
+            silent=True,
+            store_history=False,
+            user_expressions=dict(result=RESULT_EXPRESSION),
+            allow_stdin=False,
+            stop_on_error=False,
+        )
+        msg = new_message("execute_request", content, session=uuid.uuid4().hex)
+        sock.send_multipart(serialize(msg, key))
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            if not sock.poll(remaining * 1000):
+                break
+            reply = deserialize(sock.recv_multipart(), key)
+            if reply["parent_header"].get("msg_id") != msg["header"]["msg_id"]:
+                continue
+            content = reply["content"]
+            if content.get("status") != "ok":
+                raise SnapshotException(f"{content.get('ename', 'error')}: {content.get('evalue', '')}")
+            result = content.get("user_expressions", {}).get("result", {})
+            if result.get("status") != "ok":
+                raise SnapshotException(f"{result.get('ename', 'error')}: {result.get('evalue', '')}")
+            # the expression's value is a JSON string, shown as its repr
+            return json.loads(ast.literal_eval(result["data"]["text/plain"]))
+        raise SnapshotException(f"kernel did not reply within {timeout:.0f}s")
+    finally:
+        sock.close()
+
+
+def snapshot(host: str, port: int, key: bytes, name: str, timeout: float = 300.0) -> dict[str, Any]:
+    """
+    Save the user namespace of a kernel to <snapshot dir>/<name>.snapshot
+
+    Return:
+        {path, saved, skipped, bytes}
+
+    """
+    return execute(host, port, key, SNAPSHOT_CODE.format(name=name), timeout)
+
+
+def restore(host: str, port: int, key: bytes, path: str, timeout: float = 300.0) -> dict[str, Any]:
+    """
+    Load a snapshot (absolute, or relative to the snapshot dir) into the user namespace of a kernel
+
+    Return:
+        {path, restored, failed}
+
+    """
+    return execute(host, port, key, RESTORE_CODE.format(path=path), timeout)
@@ -0,0 +1,130 @@
+import json
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Any
+
+import zmq
+
+from cybershuttle_gateway.wire import deserialize, new_message, serialize
+
+# events of a kernel start, in order, as recorded in JobState.timeline (epoch seconds)
+EVENTS = ["requested", "submitted", "pending", "running", "ready", "tunnel", "heartbeat", "kernel_info"]
+
+# phases of a kernel start: (name, from event, to event)
+PHASES = [
+    ("submit", "requested", "submitted"),
+    ("queue", "submitted", "running"),
+    ("ready", "submitted", "ready"),
+    ("tunnel", "running", "tunnel"),
+    ("heartbeat", "tunnel", "heartbeat"),
+    ("kernel_info", "heartbeat", "kernel_info"),
+    ("total", "requested", "kernel_info"),
+]
+
+
+def durations(timeline: dict[str, float]) -> dict[str, float]:
+    """
+    Seconds spent in each phase of a kernel start (phases that did not complete are left out)
+
+    """
+    return {name: round(timeline[end] - timeline[start], 3) for name, start, end in PHASES if start in timeline and end in timeline}
+
+
+def percentile(values: list[float], q: float) -> float:
+    """
+    Percentile of sorted values, interpolated between the closest ranks
+
+    """
+    rank = (len(values) - 1) * q / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def probe_heartbeat(host: str, port: int, timeout: float) -> bool:
+    """
+    Ping the heartbeat channel of a kernel, and wait for the echo
+
+    """
+    sock = zmq.Context.instance().socket(zmq.REQ)
+    sock.setsockopt(zmq.LINGER, 0)
+    sock.connect(f"tcp://{host}:{port}")
+    try:
+        sock.send(b"ping")
+        return sock.poll(timeout * 1000) != 0 and sock.recv() == b"ping"
+    finally:
+        sock.close()
+
+
+def probe_kernel_info(host: str, port: int, key: bytes, timeout: float) -> dict[str, Any] | None:
+    """
+    Send a kernel_info_request on the shell channel of a kernel, and wait for the reply
+
+    """
+    sock = zmq.Context.instance().socket(zmq.DEALER)
+    sock.setsockopt(zmq.LINGER, 0)
+    sock.connect(f"tcp://{host}:{port}")
+    try:
+        msg = new_message("kernel_info_request", {}, session=uuid.uuid4().hex)
+        sock.send_multipart(serialize(msg, key))
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            if not sock.poll(remaining * 1000):
+                break
+            reply = deserialize(sock.recv_multipart(), key)
+            if reply["parent_header"].get("msg_id") == msg["header"]["msg_id"]:
+                return reply["content"]
+        return None
+    finally:
+        sock.close()
+
+
+class StartupStats:
+    """
+    Startup timelines of recent kernels, aggregated per cluster and spec
+
+    Only the last `size` timelines are kept, so the percentiles follow
+    changes of the clusters (e.g. a new environment or module stack).
+
+    """
+
+    def __init__(self, size: int = 1000):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.history: deque[dict[str, Any]] = deque(maxlen=size)
+
+    def record(self, job_id: str, cluster: str, spec: dict[str, Any], timeline: dict[str, float]) -> None:
+        entry = dict(job_id=job_id, cluster=cluster, spec=spec, timeline=dict(timeline), durations=durations(timeline))
+        with self.lock:
+            self.history.append(entry)
+
+    def summary(self, cluster: str | None = None) -> list[dict[str, Any]]:
+        """
+        Percentiles of each phase, per cluster and spec
+
+        Return:
+            [{cluster, spec, count, phases: {phase: {count, p50, p90, p99, max}}}]
+
+        """
+        with self.lock:
+            entries = [e for e in self.history if cluster is None or e["cluster"] == cluster]
+        groups: dict[tuple[str, str], list[dict[str, Any]]] = {}
+        for e in entries:
+            groups.setdefault((e["cluster"], json.dumps(e["spec"], sort_keys=True)), []).append(e)
+        result = []
+        for (name, spec), group in sorted(groups.items()):
+            phases = {}
+            for phase, _, _ in PHASES:
+                values = sorted(e["durations"][phase] for e in group if phase in e["durations"])
+                if values:
+                    phases[phase] = dict(
+                        count=len(values),
+                        p50=round(percentile(values, 50), 3),
+                        p90=round(percentile(values, 90), 3),
+                        p99=round(percentile(values, 99), 3),
+                        max=values[-1],
+                    )
+            result.append(dict(cluster=name, spec=json.loads(spec), count=len(group), phases=phases))
+        return result
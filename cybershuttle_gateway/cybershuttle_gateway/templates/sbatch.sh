@@ -7,12 +7,91 @@ cat <<EOF >$tmpfile
 {CONNECTION_INFO}
 EOF
 
+# send each phase of the job start ("<phase> <start_ns> <end_ns> <node>") back to the gateway trace, if traced
+{TRACE_ENV}
+cs_mark() {{
+  local now=$(date +%s%N)
+  if [ -n "$CYBERSHUTTLE_TRACE_URL" ] && command -v curl >/dev/null; then
+    curl -s -m 5 -H "traceparent: $CYBERSHUTTLE_TRACEPARENT" --data-binary "$1 ${{cs_last:-$now}} $now $(hostname)" "$CYBERSHUTTLE_TRACE_URL" >/dev/null 2>&1 &
+  fi
+  cs_last=$now
+}}
+cs_mark queue
+cs_job_start=$(date +%s%N)
+
 {ENV_VARS}
 
 {LMOD_MODULES}
+cs_mark modules
 
 {WORKDIR_COMMAND}
 
+# kernel snapshots are staged on node-local storage, then kept in the workdir
+export CYBERSHUTTLE_LOCAL_DIR=${{CYBERSHUTTLE_LOCAL_DIR:-${{TMPDIR:-/tmp}}}}
+export CYBERSHUTTLE_SNAPSHOT_DIR=${{CYBERSHUTTLE_SNAPSHOT_DIR:-$PWD/.cybershuttle/snapshots}}
+
 {USER_SCRIPTS}
+cs_mark user_scripts
+
+# tell the gateway once the kernel listens on all its ports, instead of waiting for its next poll
+{READY_ENV}
+cs_ready() {{
+  local ports=($CYBERSHUTTLE_KERNEL_PORTS) deadline=$((SECONDS + ${{CYBERSHUTTLE_READY_TIMEOUT:-300}})) port
+  for port in "${{ports[@]}}"; do
+    until (exec 3<>/dev/tcp/$CYBERSHUTTLE_KERNEL_IP/$port) 2>/dev/null; do
+      [ $SECONDS -ge $deadline ] && return 1
+      sleep 0.2
+    done
+  done
+  local bound=$(date +%s%N) list=$(IFS=,; echo "${{ports[*]}}") attempt
+  local body="{{\"node\": \"$(hostname)\", \"ports\": [$list], \"timings\": {{\"job_start\": $cs_job_start, \"kernel_exec\": $1, \"ports_bound\": $bound}}}}"
+  # the gateway may not know the job yet when it starts right away, so retry a few times
+  for attempt in 1 2 3 4 5; do
+    curl -sf -m 5 -X POST -H "Authorization: Bearer $CYBERSHUTTLE_READY_TOKEN" -H "Content-Type: application/json" \
+      --data-binary "$body" "$CYBERSHUTTLE_GATEWAY_URL/ready/${{SLURM_JOB_ID:-$$}}?user=$CYBERSHUTTLE_USER" >/dev/null && return 0
+    sleep $attempt
+  done
+  return 1
+}}
+
+# supervise the kernel inside this allocation:
+#   SIGUSR1 respawns it with the same connection file (fast restart)
+#   SIGINT is forwarded to it (interrupt)
+#   SIGTERM stops it and ends the job
+# if the kernel exits by itself, wait a grace period for SIGUSR1 before ending the job
+restart_grace=${{CYBERSHUTTLE_RESTART_GRACE:-10}}
+kernel_pid=""
+grace_pid=""
+ready_pid=""
+restart=0
+stopping=0
+trap 'restart=1; [ -n "$kernel_pid" ] && kill -TERM $kernel_pid 2>/dev/null; [ -n "$grace_pid" ] && kill $grace_pid 2>/dev/null' USR1
+trap '[ -n "$kernel_pid" ] && kill -INT $kernel_pid 2>/dev/null' INT
+trap 'stopping=1; [ -n "$kernel_pid" ] && kill -TERM $kernel_pid 2>/dev/null; [ -n "$grace_pid" ] && kill $grace_pid 2>/dev/null' TERM
 
-{EXEC_COMMAND}
+while true; do
+  restart=0
+  kernel_exec=$(date +%s%N)
+  {EXEC_COMMAND} &
+  kernel_pid=$!
+  # restarts keep the connection file, so the gateway already forwards the ports
+  if [ -z "$ready_pid" ] && [ -n "$CYBERSHUTTLE_READY_TOKEN" ] && command -v curl >/dev/null; then
+    cs_ready $kernel_exec &
+    ready_pid=$!
+  fi
+  # wait returns early whenever a trapped signal arrives
+  while kill -0 $kernel_pid 2>/dev/null; do
+    wait $kernel_pid
+  done
+  kernel_pid=""
+  kill $ready_pid 2>/dev/null
+  [ $stopping -eq 1 ] && break
+  if [ $restart -eq 0 ]; then
+    sleep $restart_grace &
+    grace_pid=$!
+    wait $grace_pid
+    grace_pid=""
+    [ $restart -eq 0 ] && break
+  fi
+  echo "restarting kernel"
+done
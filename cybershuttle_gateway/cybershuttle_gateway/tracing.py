@@ -0,0 +1,211 @@
+"""
+Tracing of kernel launches, from the provisioner through the gateway to the job
+
+The provisioner starts the trace of a kernel launch, and trace context is
+propagated with W3C traceparent headers. Spans are exported in the
+OTLP/JSON format: appended to a file (one export request per line), and/or
+posted to an OTLP/HTTP collector (e.g. http://host:4318).
+
+The gateway and the provisioners are installed apart (on the gateway host,
+and in the Jupyter environment) and neither depends on the other, so both
+packages keep an identical copy of this module. Change both copies; the
+gateway's tests check that they match.
+
+"""
+
+import json
+import os
+import queue
+import re
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging import Logger
+from pathlib import Path
+from typing import Any, Iterator
+
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+# span of the current request or task (or of the work it fans out, see contextvars.copy_context)
+current_span: ContextVar["Span | None"] = ContextVar("current_span", default=None)
+
+
+def parse_traceparent(value: str | None) -> tuple[str, str] | None:
+    """
+    Read (trace_id, span_id) from a traceparent header
+
+    """
+    if not value or (match := TRACEPARENT.match(value.strip())) is None:
+        return None
+    return match.group(1), match.group(2)
+
+
+def otlp_value(value: Any) -> dict[str, Any]:
+    if isinstance(value, bool):
+        return dict(boolValue=value)
+    if isinstance(value, int):
+        return dict(intValue=str(value))
+    if isinstance(value, float):
+        return dict(doubleValue=value)
+    return dict(stringValue=str(value))
+
+
+class Span:
+    """
+    A timed operation of a trace
+
+    """
+
+    def __init__(self, tracer: "Tracer", name: str, trace_id: str, parent_id: str | None, start_ns: int | None = None, **attributes: Any):
+        super().__init__()
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns: int | None = None
+        self.attributes = attributes
+        self.error: str | None = None
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def fail(self, error: str) -> None:
+        self.error = error
+
+    def end(self, end_ns: int | None = None) -> None:
+        if self.end_ns is not None:
+            return
+        self.end_ns = end_ns or time.time_ns()
+        self.tracer.export(self)
+
+    def to_otlp(self) -> dict[str, Any]:
+        span = dict(
+            traceId=self.trace_id,
+            spanId=self.span_id,
+            name=self.name,
+            kind=1,
+            startTimeUnixNano=str(self.start_ns),
+            endTimeUnixNano=str(self.end_ns),
+            attributes=[dict(key=k, value=otlp_value(v)) for k, v in self.attributes.items() if v is not None],
+            status=dict(code=2, message=self.error) if self.error is not None else dict(code=1),
+        )
+        if self.parent_id is not None:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class Tracer:
+    """
+    Create spans, and export them in batches from a background thread
+
+    Tracing is off (spans are still created, so callers need not check)
+    until a file or an endpoint is set.
+
+    """
+
+    _instances: dict[tuple[str, str, str], "Tracer"] = {}
+
+    @classmethod
+    def instance(cls, logger: Logger, service: str, file: str = "", endpoint: str = "") -> "Tracer":
+        """
+        The tracer of a service for a file and endpoint, shared within the process
+
+        """
+        key = (service, file, endpoint)
+        if key not in cls._instances:
+            path = Path(os.path.expandvars(file)).expanduser().absolute() if file else None
+            cls._instances[key] = cls(logger, service, file=path, endpoint=endpoint)
+        return cls._instances[key]
+
+    def __init__(self, logger: Logger, service: str, file: Path | None = None, endpoint: str = "", interval: float = 2.0):
+        super().__init__()
+        self.log = logger
+        self.service = service
+        self.file = file
+        self.endpoint = endpoint
+        self.interval = interval
+        self.spans: queue.SimpleQueue[Span] = queue.SimpleQueue()
+        self.thread: threading.Thread | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.file is not None or len(self.endpoint) > 0
+
+    def start(self, name: str, parent: "str | Span | None" = None, start_ns: int | None = None, **attributes: Any) -> Span:
+        """
+        Start a span, under a parent span or traceparent (the current span by default), or as a new trace
+
+        """
+        if parent is None:
+            parent = current_span.get()
+        if isinstance(parent, Span):
+            context: tuple[str, str] | None = (parent.trace_id, parent.span_id)
+        else:
+            context = parse_traceparent(parent)
+        if context is None:
+            return Span(self, name, os.urandom(16).hex(), None, start_ns, **attributes)
+        return Span(self, name, context[0], context[1], start_ns, **attributes)
+
+    @contextmanager
+    def span(self, name: str, parent: "str | Span | None" = None, **attributes: Any) -> Iterator[Span]:
+        """
+        Time a block as a span, current within the block
+
+        """
+        span = self.start(name, parent, **attributes)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.fail(f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            current_span.reset(token)
+            span.end()
+
+    def export(self, span: Span) -> None:
+        if not self.enabled:
+            return
+        self.spans.put(span)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="tracing", daemon=True)
+            self.thread.start()
+
+    def payload(self, spans: list[Span]) -> dict[str, Any]:
+        resource = dict(attributes=[dict(key="service.name", value=otlp_value(self.service))])
+        scope = dict(name="cybershuttle")
+        return dict(resourceSpans=[dict(resource=resource, scopeSpans=[dict(scope=scope, spans=[s.to_otlp() for s in spans])])])
+
+    def flush(self) -> None:
+        spans = []
+        while not self.spans.empty():
+            spans.append(self.spans.get())
+        if not spans:
+            return
+        body = json.dumps(self.payload(spans))
+        if self.file is not None:
+            with open(self.file, "a") as f:
+                f.write(body + "\n")
+        if self.endpoint:
+            url = self.endpoint.rstrip("/") + "/v1/traces"
+            req = urllib.request.Request(url, data=body.encode(), headers={"Content-Type": "application/json"}, method="POST")
+            try:
+                urllib.request.urlopen(req, timeout=5.0).close()
+            except OSError as e:
+                self.log.warning(f"could not export {len(spans)} spans to {url}: {e}")
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                self.log.exception("error exporting spans")
@@ -1,7 +1,123 @@
+import threading
+from logging import Logger
+from typing import Callable
+
+import zmq
+
+from cybershuttle_gateway.capture import TO_CLIENT, TO_KERNEL
 from cybershuttle_gateway.transport import TransportBase
 
+# (channel, direction, frames) -> None
+FrameListener = Callable[[str, int, list[bytes]], None]
+
+# channel -> (frontend socket type, backend socket type)
+SOCKET_TYPES = {
+    "shell": (zmq.ROUTER, zmq.DEALER),
+    "control": (zmq.ROUTER, zmq.DEALER),
+    "stdin": (zmq.ROUTER, zmq.DEALER),
+    "hb": (zmq.ROUTER, zmq.DEALER),
+    "iopub": (zmq.XPUB, zmq.XSUB),
+}
+
 
 class ZMQTransport(TransportBase):
+    """
+    Proxy kernel channels between public gateway ports and tunnelled kernel ports
+
+    ------------------------------------------------------
+    [Client]      | Gateway (frontend) -> (backend) | Tunnel
+    ------------------------------------------------------
+    connects    ->| bind public port   -> connect ->| kernel ports
+
+    Every frame group that passes through is handed to the registered
+    listeners, which is how capture (and activity tracking) observe traffic.
+
+    """
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        logger: Logger,
+        channels: dict[str, tuple[int, int]],
+        listeners: list[FrameListener] = [],
+        bind_address: str = "*",
+        backend_host: str = "127.0.0.1",
+        batch_size: int = 256,
+    ) -> None:
         super().__init__()
+        self.log = logger
+        self.channels = channels
+        self.listeners = list(listeners)
+        self.bind_address = bind_address
+        self.backend_host = backend_host
+        self.batch_size = batch_size
+        self.sockets: list[tuple[str, zmq.Socket, zmq.Socket]] = []
+        self.thread: threading.Thread | None = None
+        self.running = False
+
+    def start(self) -> None:
+        """
+        Bind frontend ports, connect backend ports, and start proxying in a thread.
+
+        """
+        ctx = zmq.Context.instance()
+        for name, (frontend_port, backend_port) in self.channels.items():
+            front_type, back_type = SOCKET_TYPES[name]
+            front = ctx.socket(front_type)
+            back = ctx.socket(back_type)
+            for sock in [front, back]:
+                sock.setsockopt(zmq.LINGER, 0)
+                sock.setsockopt(zmq.SNDHWM, 0)
+                sock.setsockopt(zmq.RCVHWM, 0)
+            if front_type == zmq.ROUTER:
+                front.setsockopt(zmq.ROUTER_HANDOVER, 1)
+            front.bind(f"tcp://{self.bind_address}:{frontend_port}")
+            back.connect(f"tcp://{self.backend_host}:{backend_port}")
+            self.sockets.append((name, front, back))
+        self.log.info(f"proxying channels: {self.channels}")
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="zmq-proxy", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float = 2.0) -> None:
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+        for _, front, back in self.sockets:
+            front.close()
+            back.close()
+        self.sockets = []
+        self.log.info(f"proxy stopped: {self.channels}")
+
+    def _notify(self, channel: str, direction: int, frames: list[bytes]) -> None:
+        for listener in self.listeners:
+            try:
+                listener(channel, direction, frames)
+            except Exception:
+                self.log.exception(f"frame listener failed on '{channel}'")
+
+    def _forward(self, channel: str, direction: int, src: zmq.Socket, dest: zmq.Socket) -> None:
+        # drain up to batch_size messages per wakeup to amortize polling
+        for _ in range(self.batch_size):
+            try:
+                frames = src.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            if self.listeners:
+                self._notify(channel, direction, frames)
+            dest.send_multipart(frames)
+
+    def _run(self) -> None:
+        poller = zmq.Poller()
+        for _, front, back in self.sockets:
+            poller.register(front, zmq.POLLIN)
+            poller.register(back, zmq.POLLIN)
+        while self.running:
+            events = dict(poller.poll(100))
+            if not events:
+                continue
+            for name, front, back in self.sockets:
+                if front in events:
+                    self._forward(name, TO_KERNEL, front, back)
+                if back in events:
+                    self._forward(name, TO_CLIENT, back, front)
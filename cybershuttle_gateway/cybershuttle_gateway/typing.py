@@ -2,7 +2,10 @@ from typing import Any
 
 from pydantic import BaseModel, Field
 
-from cybershuttle_gateway.api import SlurmAPI
+from cybershuttle_gateway.api import APIBase
+from cybershuttle_gateway.capture import CaptureWriter
+from cybershuttle_gateway.culling import ActivityTracker
+from cybershuttle_gateway.transport import ZMQTransport
 
 
 class KernelProvisionerConfig(BaseModel):
@@ -14,6 +17,9 @@ class KernelProvisionerConfig(BaseModel):
     workdir: str = Field(default="")
     exec_path: str = Field(default="")
     user_scripts: str = Field(default="")
+    fastest_start: bool = Field(default=False)
+    # snapshot to load into the kernel once it runs
+    restore: str = Field(default="")
 
 
 class KernelProvisionerMetadata(BaseModel):
@@ -69,23 +75,54 @@ class ClusterConfig(BaseModel):
     compute_username: str = Field(default="")
     lmod_modules: list[str] = Field(default=[])
     workdir: str = Field(default="")
+    # candidates for fastest_start placement
+    partitions: list[str] = Field(default=[])
+    qos: list[str] = Field(default=[])
+    # seconds a kernel may stay idle before it is culled (0 = never), and how long before that to warn
+    cull_idle_timeout: float = Field(default=0)
+    cull_warning: float = Field(default=300)
+    # snapshot kernels before culling them, and this many seconds before their time limit (0 = never)
+    snapshot_on_cull: bool = Field(default=False)
+    snapshot_before_limit: float = Field(default=0)
 
 
 class UserConfig(BaseModel):
     clusters: dict[str, ClusterConfig]
+    # share of login node slots when provision requests queue up
+    weight: float = Field(default=1.0)
 
 
 class JobState(BaseModel):
-    api: SlurmAPI = Field(exclude=True)
+    api: APIBase = Field(exclude=True)
     username: str
     gateway_url: str
     cluster: ClusterConfig
+    cluster_name: str = Field(default="")
     transport: str
     spec: dict[str, Any]
     connection_info: dict[str, Any] = Field(exclude=True)
     port_map: list[tuple[int, int]]
+    tunnel_map: list[tuple[int, int]]
     forwarding: bool
     workdir: str
+    proxy: ZMQTransport | None = Field(default=None, exclude=True)
+    capture: CaptureWriter | None = Field(default=None, exclude=True)
+    activity: ActivityTracker | None = Field(default=None, exclude=True)
+    started_at: float | None = Field(default=None)
+    restore: str = Field(default="")
+    snapshotted: bool = Field(default=False)
+    # last status polled from the cluster, served (as stale) while it cannot be reached
+    last_status: dict[str, Any] | None = Field(default=None)
+    last_status_at: float | None = Field(default=None)
+    # trace context of the provision request, that the launch timeline of the job belongs to
+    traceparent: str = Field(default="")
+    # when each step of the kernel start happened (see startup.EVENTS)
+    timeline: dict[str, float] = Field(default={})
+    # token the job reports its kernel ready with, and what it reported {node, ports, timings}
+    ready_token: str = Field(default="", exclude=True)
+    ready: dict[str, Any] | None = Field(default=None)
+    # decision trace, for kernels routed from the "any" cluster
+    routing: dict[str, Any] | None = Field(default=None)
 
     class Config:
         arbitrary_types_allowed = True
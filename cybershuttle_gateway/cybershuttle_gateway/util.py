@@ -35,6 +35,30 @@ def generate_port_map(
     return list(zip(remote_ports, local_ports))
 
 
+def get_ephemeral_ports(n: int, host: str = "127.0.0.1") -> list[int]:
+    socks: list[socket.socket] = []
+    try:
+        for _ in range(n):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.bind((host, 0))
+            socks.append(sock)
+        return [sock.getsockname()[1] for sock in socks]
+    finally:
+        for sock in socks:
+            sock.close()
+
+
+def generate_tunnel_map(
+    port_map: list[tuple[int, int]],
+) -> list[tuple[int, int]]:
+    """
+    Pick loopback ports for SSH tunnel endpoints, for when a proxy binds the public ports
+
+    """
+    internal_ports = get_ephemeral_ports(len(port_map))
+    return [(remote, local) for (remote, _), local in zip(port_map, internal_ports)]
+
+
 def generate_kernel_spec(
     cluster: str,
     user: str,
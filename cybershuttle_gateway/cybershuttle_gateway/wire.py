@@ -0,0 +1,110 @@
+import hashlib
+import hmac
+import json
+import uuid
+from datetime import datetime, timezone
+from typing import Any
+
+DELIM = b"<IDS|MSG>"
+PROTOCOL_VERSION = "5.3"
+
+
+def split_identities(frames: list[bytes]) -> tuple[list[bytes], list[bytes]]:
+    """
+    Split a multipart Jupyter message into its routing prefix and message parts.
+
+    Return:
+
+    identities (list[bytes]) frames before the <IDS|MSG> delimiter
+    parts (list[bytes]) frames after the delimiter (signature, header, ...)
+
+    """
+    try:
+        idx = frames.index(DELIM)
+    except ValueError:
+        return [], list(frames)
+    return list(frames[:idx]), list(frames[idx + 1 :])
+
+
+def get_msg_type(frames: list[bytes]) -> str:
+    """
+    Read msg_type from the header frame, or return "" if it cannot be parsed.
+
+    """
+    _, parts = split_identities(frames)
+    if len(parts) < 2:
+        return ""
+    try:
+        return str(json.loads(parts[1]).get("msg_type", ""))
+    except (ValueError, AttributeError):
+        return ""
+
+
+def sign(key: bytes, parts: list[bytes]) -> bytes:
+    if not key:
+        return b""
+    h = hmac.new(key, digestmod=hashlib.sha256)
+    for p in parts:
+        h.update(p)
+    return h.hexdigest().encode()
+
+
+def new_message(
+    msg_type: str,
+    content: dict[str, Any],
+    session: str,
+    parent: dict[str, Any] | None = None,
+    username: str = "cybershuttle",
+) -> dict[str, Any]:
+    header = dict(
+        msg_id=uuid.uuid4().hex,
+        msg_type=msg_type,
+        username=username,
+        session=session,
+        date=datetime.now(timezone.utc).isoformat(),
+        version=PROTOCOL_VERSION,
+    )
+    return dict(
+        header=header,
+        parent_header=(parent or {}).get("header", {}),
+        metadata={},
+        content=content,
+        buffers=[],
+    )
+
+
+def serialize(msg: dict[str, Any], key: bytes, identities: list[bytes] = []) -> list[bytes]:
+    """
+    Serialize a message dict into signed multipart frames.
+
+    """
+    parts = [
+        json.dumps(msg["header"]).encode(),
+        json.dumps(msg.get("parent_header", {})).encode(),
+        json.dumps(msg.get("metadata", {})).encode(),
+        json.dumps(msg.get("content", {})).encode(),
+    ]
+    return list(identities) + [DELIM, sign(key, parts)] + parts + list(msg.get("buffers", []))
+
+
+def deserialize(frames: list[bytes], key: bytes = b"") -> dict[str, Any]:
+    """
+    Deserialize multipart frames into a message dict.
+
+    Signatures are only checked when a key is given.
+
+    """
+    identities, parts = split_identities(frames)
+    if len(parts) < 5:
+        raise ValueError(f"malformed message: expected >=5 parts, got {len(parts)}")
+    signature, body = parts[0], parts[1:5]
+    if key and not hmac.compare_digest(signature, sign(key, body)):
+        raise ValueError("invalid message signature")
+    return dict(
+        identities=identities,
+        header=json.loads(body[0]),
+        parent_header=json.loads(body[1]),
+        metadata=json.loads(body[2]),
+        content=json.loads(body[3]),
+        buffers=parts[5:],
+    )
@@ -0,0 +1,93 @@
+import logging
+
+import pytest
+
+from cybershuttle_gateway.admission import Admission
+from cybershuttle_gateway.exceptions import AdmissionException
+from cybershuttle_gateway.metrics import Metrics
+
+
+def make_admission(outstanding: int = 0, **kwargs) -> Admission:
+    return Admission(logging.getLogger("test"), Metrics(), lambda username: outstanding, **kwargs)
+
+
+def test_fair_order():
+    admission = make_admission(concurrency=1)
+    first = admission.enqueue("alice", "login", 1.0)
+    assert first.granted.is_set()
+    alice = [admission.enqueue("alice", "login", 1.0) for _ in range(3)]
+    bob = admission.enqueue("bob", "login", 1.0)
+    assert not bob.granted.is_set()
+
+    # bob has not been served yet, so he goes ahead of alice's backlog
+    order = []
+    current = first
+    for _ in range(4):
+        admission.release(current, "login", 0.1)
+        current = next(t for t in alice + [bob] if t.granted.is_set() and t not in order)
+        order.append(current)
+    assert order == [bob] + alice
+
+
+def test_weighted_order():
+    admission = make_admission(concurrency=1)
+    first = admission.enqueue("alice", "login", 1.0)
+    light = [admission.enqueue("alice", "login", 1.0) for _ in range(2)]
+    heavy = [admission.enqueue("bob", "login", 2.0) for _ in range(4)]
+    order = []
+    current = first
+    for _ in range(6):
+        admission.release(current, "login", 0.1)
+        current = next(t for t in light + heavy if t.granted.is_set() and t not in order)
+        order.append(current)
+    # twice the weight, tags half as far apart (alice used up her first slot already)
+    assert [t.username for t in order] == ["bob", "bob", "bob", "alice", "bob", "alice"]
+
+
+def test_concurrency_per_login():
+    admission = make_admission(concurrency=2)
+    tickets = [admission.enqueue("alice", "a", 1.0) for _ in range(3)]
+    assert [t.granted.is_set() for t in tickets] == [True, True, False]
+    assert admission.enqueue("alice", "b", 1.0).granted.is_set()
+
+
+def test_quota():
+    admission = make_admission(outstanding=1, quota=2)
+    admission.enqueue("alice", "login", 1.0)
+    # one outstanding job and one being provisioned
+    with pytest.raises(AdmissionException) as e:
+        admission.enqueue("alice", "login", 1.0)
+    assert e.value.reason == "quota"
+    # requests that do not submit a job are not counted
+    assert admission.enqueue("alice", "login", 1.0, quota=False).granted.is_set()
+    assert admission.enqueue("bob", "login", 1.0).granted.is_set()
+
+
+def test_quota_released():
+    admission = make_admission(quota=1)
+    with admission.slot("alice", "login"):
+        with pytest.raises(AdmissionException):
+            admission.enqueue("alice", "login", 1.0)
+    ticket = admission.enqueue("alice", "login", 1.0)
+    assert ticket.granted.is_set()
+
+
+def test_queue_full():
+    admission = make_admission(concurrency=1, max_queue=1)
+    admission.enqueue("alice", "login", 1.0)
+    admission.enqueue("alice", "login", 1.0)
+    with pytest.raises(AdmissionException) as e:
+        admission.enqueue("bob", "login", 1.0)
+    assert e.value.reason == "queue"
+    assert e.value.retry_after >= 1
+
+
+def test_wait_timeout():
+    admission = make_admission(concurrency=1, max_wait=0.05)
+    with admission.slot("alice", "login"):
+        with pytest.raises(AdmissionException) as e:
+            with admission.slot("bob", "login"):
+                pass
+    assert e.value.reason == "wait"
+    assert admission.queues["login"] == []
+    assert admission.running["login"] == 0
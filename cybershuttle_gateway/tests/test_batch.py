@@ -0,0 +1,130 @@
+import json
+import logging
+
+import msgpack
+import pytest
+
+from cybershuttle_gateway import __main__ as gateway
+from cybershuttle_gateway.api import APIBase
+from cybershuttle_gateway.typing import ClusterConfig, JobState
+
+
+class BatchAPI(APIBase):
+    """
+    A login whose jobs have fixed states, that records the commands it is given
+
+    """
+
+    def __init__(self, name: str, states: dict[str, str], fails: list[str] = []):
+        super().__init__()
+        self.log = logging.getLogger("test")
+        self.ssh_prefix = ["ssh", name]
+        self.states = states
+        self.fails = fails
+        self.polls: list[list[int]] = []
+        self.signals: list[tuple[list[int], int]] = []
+        self.closed = 0
+
+    def poll_jobs_status(self, job_ids: list[int]) -> dict[str, tuple[str, str, str]]:
+        self.polls.append(job_ids)
+        return {str(j): (self.states.get(str(j), "UNKNOWN"), "", "") for j in job_ids}
+
+    def signal_jobs(self, job_ids: list[int], signum: int) -> dict[str, bool]:
+        self.signals.append((job_ids, signum))
+        return {str(j): str(j) not in self.fails for j in job_ids}
+
+    def close_forwarding(self) -> None:
+        self.closed += 1
+
+
+@pytest.fixture
+def client(tmp_path):
+    config = tmp_path / "users.json"
+    config.write_text(json.dumps(dict(alice=dict(clusters={}))))
+    gateway.config_file = str(config)
+    yield gateway.app.test_client()
+    for job_id in list(gateway.state_var):
+        gateway.release_job(job_id)
+
+
+def add_job(job_id: str, api: APIBase) -> None:
+    gateway.state_var[job_id] = JobState(
+        api=api,
+        username="alice",
+        gateway_url="http://gateway",
+        cluster=ClusterConfig(),
+        transport="zmq",
+        spec={},
+        connection_info={},
+        port_map=[],
+        tunnel_map=[],
+        forwarding=True,
+        workdir="",
+    )
+
+
+def post(client, path: str, user: str = "alice", **body):
+    return client.post(path, query_string=dict(user=user), data=msgpack.dumps(body))
+
+
+def test_status_takes_one_poll_per_login(client):
+    login1 = BatchAPI("login1", {"1": "PENDING", "2": "RUNNING"})
+    login2 = BatchAPI("login2", {"3": "PENDING"})
+    add_job("1", login1)
+    add_job("2", login1)
+    add_job("3", login2)
+    r = post(client, "/jobs/status", job_ids=["1", "2", "3", "4"])
+    assert r.status_code == 200
+    assert login1.polls == [[1, 2]] and login2.polls == [[3]]
+    results = r.get_json()
+    assert {job_id: result.get("state") for job_id, result in results.items()} == {"1": "PENDING", "2": "RUNNING", "3": "PENDING", "4": None}
+    assert results["4"] == dict(error="Job Not Found")
+
+
+def test_status_deduplicates_jobs(client):
+    login = BatchAPI("login", {"1": "PENDING"})
+    add_job("1", login)
+    r = post(client, "/jobs/status", job_ids=["1", 1, "1"])
+    assert login.polls == [[1]]
+    assert list(r.get_json()) == ["1"]
+
+
+def test_status_releases_ended_jobs(client):
+    login = BatchAPI("login", {"1": "PENDING"})
+    add_job("1", login)
+    post(client, "/jobs/status", job_ids=["1"])
+    login.states["1"] = "COMPLETED"
+    r = post(client, "/jobs/status", job_ids=["1"])
+    assert r.get_json()["1"]["state"] == "COMPLETED"
+    assert "1" not in gateway.state_var
+
+
+def test_signal_takes_one_scancel_per_login(client):
+    login1 = BatchAPI("login1", {})
+    login2 = BatchAPI("login2", {})
+    add_job("1", login1)
+    add_job("2", login1)
+    add_job("3", login2)
+    r = post(client, "/jobs/signal", job_ids=["1", "2", "3"], signum=2)
+    assert r.status_code == 200
+    assert login1.signals == [([1, 2], 2)] and login2.signals == [([3], 2)]
+    assert r.get_json() == {"1": dict(success=True), "2": dict(success=True), "3": dict(success=True)}
+    # an interrupt keeps the jobs
+    assert set(gateway.state_var) == {"1", "2", "3"}
+
+
+def test_terminate_releases_signaled_jobs_only(client):
+    login = BatchAPI("login", {}, fails=["2"])
+    add_job("1", login)
+    add_job("2", login)
+    r = post(client, "/jobs/signal", job_ids=["1", "2", "3"], signum=15)
+    assert r.get_json() == {"1": dict(success=True), "2": dict(success=False), "3": dict(error="Job Not Found")}
+    assert set(gateway.state_var) == {"2"}
+    assert login.closed == 1
+
+
+def test_unknown_user_is_unauthorized(client):
+    add_job("1", BatchAPI("login", {"1": "RUNNING"}))
+    assert post(client, "/jobs/status", user="mallory", job_ids=["1"]).status_code == 403
+    assert post(client, "/jobs/signal", user="mallory", job_ids=["1"], signum=15).status_code == 403
+    assert "1" in gateway.state_var
@@ -0,0 +1,71 @@
+import time
+
+import pytest
+
+from cybershuttle_gateway.breaker import CLOSED, HALF_OPEN, OPEN, Breakers, CircuitBreaker
+from cybershuttle_gateway.exceptions import CircuitOpenException
+
+
+def test_opens_after_threshold():
+    breaker = CircuitBreaker("login", threshold=2, reset_timeout=60)
+    breaker.check()
+    breaker.failure()
+    assert breaker.state == CLOSED
+    breaker.failure()
+    assert breaker.state == OPEN
+    assert breaker.opened == 1
+    with pytest.raises(CircuitOpenException):
+        breaker.check()
+
+
+def test_success_resets_failures():
+    breaker = CircuitBreaker("login", threshold=2, reset_timeout=60)
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    assert breaker.state == CLOSED
+    assert breaker.summary() == dict(state=CLOSED, failures=1)
+
+
+def test_half_open_allows_one_trial():
+    breaker = CircuitBreaker("login", threshold=1, reset_timeout=0.05)
+    breaker.failure()
+    time.sleep(0.06)
+    breaker.check()
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(CircuitOpenException):
+        breaker.check()
+
+
+def test_half_open_trial_success_closes():
+    breaker = CircuitBreaker("login", threshold=1, reset_timeout=0.05)
+    breaker.failure()
+    time.sleep(0.06)
+    breaker.check()
+    breaker.success()
+    assert breaker.state == CLOSED
+    breaker.check()
+
+
+def test_half_open_trial_failure_reopens():
+    breaker = CircuitBreaker("login", threshold=3, reset_timeout=0.05)
+    for _ in range(3):
+        breaker.failure()
+    time.sleep(0.06)
+    breaker.check()
+    # a single failed trial is enough, whatever the threshold
+    breaker.failure()
+    assert breaker.state == OPEN
+    assert breaker.opened == 2
+    with pytest.raises(CircuitOpenException):
+        breaker.check()
+
+
+def test_breakers_per_login():
+    breakers = Breakers(threshold=1)
+    a = breakers.get(["ssh", "user@a"])
+    assert breakers.get(["ssh", "user@a"]) is a
+    assert breakers.get([]).name == "localhost"
+    a.failure()
+    assert breakers.states() == {(("login", "user@a"),): 2.0, (("login", "localhost"),): 0.0}
+    assert breakers.opened()[(("login", "user@a"),)] == 1.0
@@ -0,0 +1,112 @@
+import json
+
+import pytest
+
+from cybershuttle_gateway.capture import TO_CLIENT, TO_KERNEL, CaptureRecord, CaptureWriter, read_capture, redact
+from cybershuttle_gateway.replay import replay, synthesize
+from cybershuttle_gateway.wire import DELIM, deserialize, new_message, serialize
+
+KEY = b"secret"
+
+
+def execute(code: str = "x = 1") -> list[bytes]:
+    return serialize(new_message("execute_request", dict(code=code), session="client"), KEY, identities=[b"proxy-id"])
+
+
+def stream(text: str) -> list[bytes]:
+    return serialize(new_message("stream", dict(name="stdout", text=text), session="kernel"), KEY)
+
+
+def write_capture(path, bodies: str) -> None:
+    writer = CaptureWriter(path, job_id="42", bodies=bodies)
+    writer.record("shell", TO_KERNEL, execute())
+    writer.record("iopub", TO_CLIENT, stream("hello"))
+    writer.record("hb", TO_KERNEL, [b"ping"])
+    writer.close()
+
+
+@pytest.mark.parametrize("bodies", ["none", "redacted", "full"])
+def test_records_shape_of_traffic(tmp_path, bodies):
+    path = tmp_path / "42.cslog"
+    write_capture(path, bodies)
+    header, records = read_capture(path)
+    assert (header["job_id"], header["bodies"]) == ("42", bodies)
+    recs = list(records)
+    assert [(r.channel, r.direction, r.msg_type, r.n_ids) for r in recs] == [
+        ("shell", TO_KERNEL, "execute_request", 1),
+        ("iopub", TO_CLIENT, "stream", 0),
+        ("hb", TO_KERNEL, "", -1),
+    ]
+    assert recs[0].sizes == [len(f) for f in execute()]
+    assert [r.t_ns for r in recs] == sorted(r.t_ns for r in recs)
+    if bodies == "none":
+        assert all(r.frames is None for r in recs)
+    else:
+        assert [[len(f) for f in r.frames] for r in recs] == [r.sizes for r in recs]
+
+
+def test_full_bodies_are_kept(tmp_path):
+    path = tmp_path / "42.cslog"
+    write_capture(path, "full")
+    _, records = read_capture(path)
+    msg = deserialize(next(records).frames[1:], KEY)
+    assert msg["content"]["code"] == "x = 1"
+
+
+def test_redacted_bodies_keep_headers_only():
+    frames = execute("password = 'hunter2'")
+    redacted = redact(frames)
+    assert len(redacted) == len(frames)
+    assert redacted[:2] == [b"proxy-id", DELIM]
+    # signature and content are gone, headers (msg_type, parents) are kept
+    assert redacted[2] == bytes(len(frames[2]))
+    assert redacted[3:6] == frames[3:6]
+    assert b"hunter2" not in b"".join(redacted)
+    assert "redacted" in json.loads(redacted[6])
+
+
+def test_truncated_record_is_ignored(tmp_path):
+    path = tmp_path / "42.cslog"
+    write_capture(path, "none")
+    path.write_bytes(path.read_bytes()[:-3])
+    _, records = read_capture(path)
+    assert [r.channel for r in records] == ["shell", "iopub"]
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / "other"
+    path.write_bytes(b"")
+    with pytest.raises(ValueError):
+        read_capture(path)
+    path.write_bytes(b"\x81\xa1a\x01")
+    with pytest.raises(ValueError):
+        read_capture(path)
+    with pytest.raises(ValueError):
+        CaptureWriter(tmp_path / "x.cslog", bodies="some")
+
+
+def test_synthesized_frames_have_recorded_sizes():
+    sizes = [len(f) for f in execute()]
+    rec = CaptureRecord(0, "shell", TO_KERNEL, "execute_request", 1, sizes, None)
+    frames = synthesize(rec)
+    assert [len(f) for f in frames] == sizes
+    assert frames[1] == DELIM
+    assert json.loads(frames[3])["msg_type"] == "execute_request"
+    assert [len(f) for f in synthesize(CaptureRecord(0, "hb", TO_KERNEL, "", -1, [4], None))] == [4]
+
+
+@pytest.mark.parametrize("direct", [True, False])
+def test_replay_delivers_all_traffic(tmp_path, direct):
+    path = tmp_path / "42.cslog"
+    writer = CaptureWriter(path, job_id="42", bodies="redacted")
+    for i in range(20):
+        writer.record("shell", TO_KERNEL, execute(f"x = {i}"))
+        writer.record("iopub", TO_CLIENT, stream("x" * i))
+        writer.record("shell", TO_CLIENT, [b"proxy-id"] + serialize(new_message("execute_reply", dict(status="ok"), session="kernel"), KEY))
+    writer.close()
+    report = replay(path, speed=0, direct=direct, timeout=5.0)
+    assert report["via"] == ("direct" if direct else "proxy")
+    assert report["sent"]["to_kernel"]["messages"] == 20
+    assert report["sent"]["to_client"]["messages"] == 40
+    # routing frames differ on the way, so only messages add up
+    assert {k: v["messages"] for k, v in report["received"].items()} == {k: v["messages"] for k, v in report["sent"].items()}
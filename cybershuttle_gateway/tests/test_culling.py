@@ -0,0 +1,87 @@
+import logging
+import time
+
+from cybershuttle_gateway.capture import TO_CLIENT, TO_KERNEL
+from cybershuttle_gateway.culling import MAX_REQUESTS, ActivityTracker, Culler
+from cybershuttle_gateway.wire import new_message, serialize
+
+
+def request(msg_type: str = "execute_request") -> dict:
+    return new_message(msg_type, {}, session="client")
+
+
+def status(state: str, parent: dict) -> list[bytes]:
+    return serialize(new_message("status", dict(execution_state=state), session="kernel", parent=parent), b"")
+
+
+def running_tracker(timeout: float = 60.0, warning: float = 10.0) -> ActivityTracker:
+    tracker = ActivityTracker("1", timeout, warning)
+    tracker.mark_running()
+    return tracker
+
+
+def test_client_execute_is_activity():
+    tracker = running_tracker()
+    msg = request()
+    tracker.record("shell", TO_KERNEL, serialize(msg, b""))
+    assert tracker.last_execute is not None
+    tracker.record("iopub", TO_CLIENT, status("busy", msg))
+    assert tracker.busy and tracker.idle_seconds() == 0.0
+    tracker.record("iopub", TO_CLIENT, status("idle", msg))
+    assert not tracker.busy and tracker.last_idle is not None
+
+
+def test_gateway_requests_are_not_activity():
+    tracker = running_tracker()
+    # a snapshot or startup probe goes to the kernel around the proxy, only its status passes through
+    own = request()
+    tracker.record("iopub", TO_CLIENT, status("busy", own))
+    tracker.record("iopub", TO_CLIENT, status("idle", own))
+    assert (tracker.busy, tracker.last_busy, tracker.last_idle) == (False, None, None)
+
+
+def test_remembers_recent_requests_only():
+    tracker = running_tracker()
+    first = request("complete_request")
+    tracker.record("shell", TO_KERNEL, serialize(first, b""))
+    for _ in range(MAX_REQUESTS):
+        tracker.record("shell", TO_KERNEL, serialize(request("complete_request"), b""))
+    assert len(tracker.requests) == MAX_REQUESTS
+    tracker.record("iopub", TO_CLIENT, status("busy", first))
+    assert not tracker.busy
+
+
+def test_idle_only_once_running():
+    tracker = ActivityTracker("1", 60.0, 10.0)
+    tracker.started -= 100
+    assert tracker.idle_seconds() == 0.0
+    tracker.mark_running()
+    assert tracker.idle_seconds(time.time() + 30) >= 29.0
+
+
+def test_culler_warns_then_culls():
+    warned, culled = [], []
+    culler = Culler(logging.getLogger("test"), on_warn=warned.append, on_cull=culled.append)
+    tracker = culler.track("1", 60.0, 10.0)
+    tracker.mark_running()
+    tracker.started -= 55
+    culler.sweep()
+    assert warned == [tracker] and culled == []
+    assert tracker.warning_message() is not None
+    # a warning is only given once
+    culler.sweep()
+    assert warned == [tracker]
+    tracker.started -= 10
+    culler.sweep()
+    assert culled == [tracker]
+
+
+def test_activity_clears_warning():
+    culler = Culler(logging.getLogger("test"), on_warn=lambda t: None, on_cull=lambda t: None)
+    tracker = culler.track("1", 60.0, 10.0)
+    tracker.mark_running()
+    tracker.started -= 55
+    culler.sweep()
+    assert tracker.warned_at is not None
+    tracker.record("shell", TO_KERNEL, serialize(request(), b""))
+    assert tracker.warned_at is None and tracker.idle_seconds() < 1.0
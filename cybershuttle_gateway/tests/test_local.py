@@ -0,0 +1,75 @@
+import logging
+import time
+from signal import SIGTERM
+
+import pytest
+
+from cybershuttle_gateway.api.local import LocalAPI, parse_limits, parse_memory_mb, parse_time_s
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [("2048", 2048), ("512M", 512), ("4G", 4096), ("4gb", 4096), ("1T", 1024 * 1024), ("2048K", 2)],
+)
+def test_parse_memory_mb(value, expected):
+    assert parse_memory_mb(value) == expected
+
+
+def test_parse_memory_mb_invalid():
+    with pytest.raises(ValueError):
+        parse_memory_mb("lots")
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("", 0),
+        ("UNLIMITED", 0),
+        ("30", 30 * 60),
+        ("30:15", 30 * 60 + 15),
+        ("1:30:00", 90 * 60),
+        ("2-0", 2 * 24 * 3600),
+        ("1-2:30", 26 * 3600 + 30 * 60),
+        ("1-00:00:10", 24 * 3600 + 10),
+    ],
+)
+def test_parse_time_s(value, expected):
+    assert parse_time_s(value) == expected
+
+
+def test_parse_limits():
+    script = "#!/bin/bash\n#SBATCH --cpus-per-task=4\n#SBATCH --mem=8G\n#SBATCH --time=1:00:00\nhostname\n"
+    assert parse_limits(script) == (4, 8192, 3600)
+
+
+def test_parse_limits_mem_per_cpu():
+    script = "#!/bin/bash\n#SBATCH --cpus-per-task 2\n#SBATCH --mem-per-cpu=1G\nhostname\n"
+    assert parse_limits(script) == (2, 2048, 0)
+
+
+def test_parse_limits_none():
+    assert parse_limits("#!/bin/bash\nhostname\n") == (0, 0, 0)
+
+
+def wait_for_state(api: LocalAPI, job_id: str, state: str, timeout: float = 10.0) -> str:
+    deadline = time.monotonic() + timeout
+    while True:
+        current = api.poll_job_status(int(job_id))[0]
+        if current == state or time.monotonic() > deadline:
+            return current
+        time.sleep(0.2)
+
+
+def test_launch_poll_signal(tmp_path, monkeypatch):
+    # jobs and their scripts are kept under $HOME/.cybershuttle/jobs
+    monkeypatch.setenv("HOME", str(tmp_path))
+    api = LocalAPI(logging.getLogger("test"))
+    job_id = api.launch_job("#!/bin/bash\n#SBATCH --time=5\nsleep 60\n")
+    assert job_id.isdigit()
+    assert wait_for_state(api, job_id, "RUNNING") == "RUNNING"
+    assert api.poll_jobs_status([int(job_id), 1]) == {job_id: ("RUNNING", "localhost", "N/A"), "1": ("UNKNOWN", "", "")}
+
+    assert api.signal_job(int(job_id), SIGTERM) is True
+    assert wait_for_state(api, job_id, "UNKNOWN") == "UNKNOWN"
+    # the job is gone, so there is nothing left to signal
+    assert api.signal_job(int(job_id), SIGTERM) is False
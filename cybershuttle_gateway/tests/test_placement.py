@@ -0,0 +1,70 @@
+import logging
+from typing import Any
+
+from cybershuttle_gateway.api import APIBase
+from cybershuttle_gateway.placement import Placement
+from cybershuttle_gateway.typing import ClusterConfig
+
+
+class EstimateAPI(APIBase):
+    """
+    Start estimates by partition, without a cluster
+
+    """
+
+    def __init__(self, starts: dict[str | None, str | None]):
+        super().__init__()
+        self.log = logging.getLogger("test")
+        self.ssh_prefix = []
+        self.starts = starts
+        self.calls: list[dict[str, str]] = []
+
+    def estimate_start(self, job_script: str, options: dict[str, str] = {}) -> str | None:
+        self.calls.append(options)
+        return self.starts.get(options.get("partition"))
+
+
+SPEC: dict[str, Any] = {"cpus-per-task": 2, "time": "1:00:00"}
+
+
+def test_candidates():
+    placement = Placement(logging.getLogger("test"))
+    cfg = ClusterConfig(partitions=["a", "b"], qos=["normal"])
+    assert placement.candidates(cfg) == [dict(partition="a", qos="normal"), dict(partition="b", qos="normal")]
+    assert placement.candidates(ClusterConfig()) == [{}]
+
+
+def test_choose_earliest():
+    placement = Placement(logging.getLogger("test"))
+    api = EstimateAPI({"a": "2024-01-01T12:00:00", "b": "2024-01-01T10:00:00", "c": None})
+    choice = placement.choose(api, "alice", "cluster", ClusterConfig(partitions=["a", "b", "c"]), SPEC)
+    assert choice is not None
+    assert (choice["partition"], choice["start"], choice["cached"]) == ("b", "2024-01-01T10:00:00", False)
+    assert [e["start"] for e in choice["estimates"]] == ["2024-01-01T12:00:00", "2024-01-01T10:00:00", None]
+
+
+def test_choose_ties_go_to_first():
+    placement = Placement(logging.getLogger("test"))
+    api = EstimateAPI({"a": "2024-01-01T10:00:00", "b": "2024-01-01T10:00:00"})
+    choice = placement.choose(api, "alice", "cluster", ClusterConfig(partitions=["a", "b"]), SPEC)
+    assert choice is not None and choice["partition"] == "a"
+
+
+def test_choose_unschedulable():
+    placement = Placement(logging.getLogger("test"))
+    api = EstimateAPI({})
+    assert placement.choose(api, "alice", "cluster", ClusterConfig(partitions=["a", "b"]), SPEC) is None
+
+
+def test_choose_cached():
+    placement = Placement(logging.getLogger("test"), ttl=60)
+    api = EstimateAPI({"a": "2024-01-01T10:00:00"})
+    cfg = ClusterConfig(partitions=["a"])
+    placement.choose(api, "alice", "cluster", cfg, SPEC)
+    choice = placement.choose(api, "alice", "cluster", cfg, SPEC)
+    assert choice is not None and choice["cached"] is True
+    assert len(api.calls) == 1
+    # another user, or another shape of spec, is estimated on its own
+    placement.choose(api, "bob", "cluster", cfg, SPEC)
+    placement.choose(api, "alice", "cluster", cfg, dict(SPEC, time="2:00:00"))
+    assert len(api.calls) == 3
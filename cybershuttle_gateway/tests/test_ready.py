@@ -0,0 +1,121 @@
+import json
+import logging
+
+import msgpack
+import pytest
+
+from cybershuttle_gateway import __main__ as gateway
+from cybershuttle_gateway.api import APIBase
+from cybershuttle_gateway.typing import ClusterConfig, JobState
+from cybershuttle_gateway.util import get_ephemeral_ports
+
+TOKEN = "s3cret"
+
+
+class ReadyAPI(APIBase):
+    """
+    A login whose job stays in one state, that records the tunnels it is asked for
+
+    """
+
+    def __init__(self, state: str = "PENDING"):
+        super().__init__()
+        self.log = logging.getLogger("test")
+        self.ssh_prefix = ["ssh", "login"]
+        self.state = state
+        self.tunnels: list[str] = []
+
+    def poll_job_status(self, job_id: int) -> tuple[str, str, str]:
+        return self.state, "", ""
+
+    def poll_jobs_status(self, job_ids: list[int]) -> dict[str, tuple[str, str, str]]:
+        return {str(j): (self.state, "", "") for j in job_ids}
+
+    def start_forwarding(self, username, compute_username, execnode, port_map, **kwargs) -> None:
+        self.tunnels.append(execnode)
+
+    def close_forwarding(self) -> None:
+        pass
+
+
+@pytest.fixture
+def client(tmp_path):
+    config = tmp_path / "users.json"
+    config.write_text(json.dumps(dict(alice=dict(clusters={}))))
+    gateway.config_file = str(config)
+    yield gateway.app.test_client()
+    for job_id in list(gateway.state_var):
+        gateway.release_job(job_id)
+
+
+def add_job(job_id: str, api: APIBase, ready_token: str = TOKEN) -> JobState:
+    # nothing listens on the tunnel ports, so the startup probe gives up once the job is released
+    ports = get_ephemeral_ports(len(gateway.fwd_ports))
+    state = gateway.state_var[job_id] = JobState(
+        api=api,
+        username="alice",
+        gateway_url="http://gateway",
+        cluster=ClusterConfig(username="alice"),
+        transport="zmq",
+        spec={},
+        connection_info={},
+        port_map=[],
+        tunnel_map=[(port, port) for port in ports],
+        forwarding=False,
+        workdir="",
+        ready_token=ready_token,
+    )
+    return state
+
+
+def ready(client, job_id: str, token: str = TOKEN, **body):
+    body = dict(dict(node="node7", ports=[1, 2, 3, 4, 5], timings=dict(job_start=1, kernel_exec=2, ports_bound=3)), **body)
+    return client.post(f"/ready/{job_id}", query_string=dict(user="alice"), headers=dict(Authorization=f"Bearer {token}"), data=json.dumps(body))
+
+
+def test_ready_starts_forwarding(client):
+    api = ReadyAPI()
+    state = add_job("1", api)
+    r = ready(client, "1")
+    assert r.status_code == 204
+    assert api.tunnels == ["node7"]
+    assert state.forwarding
+    assert state.ready == dict(node="node7", ports=[1, 2, 3, 4, 5], timings=dict(job_start=1, kernel_exec=2, ports_bound=3))
+    assert {"running", "ready", "tunnel"} <= set(state.timeline)
+
+
+def test_ready_is_reported_until_the_job_ends(client):
+    api = ReadyAPI()
+    add_job("1", api)
+    ready(client, "1")
+    # squeue may not have caught up with the job yet
+    status = client.get("/status/1", query_string=dict(user="alice")).get_json()
+    assert (status["state"], status["node"]) == ("READY", "node7")
+    api.state = "RUNNING"
+    r = client.post("/jobs/status", query_string=dict(user="alice"), data=msgpack.dumps(dict(job_ids=["1"])))
+    assert r.get_json()["1"]["state"] == "READY"
+    # the poll that sees the job running does not open a second tunnel
+    assert api.tunnels == ["node7"]
+    api.state = "COMPLETED"
+    assert client.get("/status/1", query_string=dict(user="alice")).get_json()["state"] == "COMPLETED"
+    assert "1" not in gateway.state_var
+
+
+def test_ready_twice_forwards_once(client):
+    api = ReadyAPI()
+    add_job("1", api)
+    assert ready(client, "1").status_code == 204
+    assert ready(client, "1").status_code == 204
+    assert api.tunnels == ["node7"]
+
+
+def test_ready_needs_the_token_of_the_job(client):
+    api = ReadyAPI()
+    state = add_job("1", api)
+    add_job("2", ReadyAPI(), ready_token="")
+    assert ready(client, "1", token="guess").status_code == 403
+    assert client.post("/ready/1", query_string=dict(user="alice"), data=json.dumps(dict(node="node7"))).status_code == 403
+    # a job without a token cannot be reported ready at all
+    assert ready(client, "2", token="").status_code == 403
+    assert ready(client, "3").status_code == 404
+    assert api.tunnels == [] and state.ready is None and not state.forwarding
@@ -0,0 +1,112 @@
+import contextlib
+import logging
+from typing import Any
+
+import pytest
+
+from cybershuttle_gateway.api import APIBase
+from cybershuttle_gateway.exceptions import NoEligibleClusterException
+from cybershuttle_gateway.placement import Placement
+from cybershuttle_gateway.routing import Router, rank, wait_seconds
+from cybershuttle_gateway.typing import ClusterConfig
+
+NOW = "2024-01-01T10:00:00"
+
+
+class QueueAPI(APIBase):
+    """
+    A cluster with a fixed queue summary and start estimate
+
+    """
+
+    def __init__(self, name: str, start: str | None, idle_cpus: int = 0, pending: int = 0, reachable: bool = True):
+        super().__init__()
+        self.log = logging.getLogger("test")
+        self.ssh_prefix = ["ssh", name]
+        self.start = start
+        self.idle_cpus = idle_cpus
+        self.pending = pending
+        self.reachable = reachable
+
+    def estimate_start(self, job_script: str, options: dict[str, str] = {}) -> str | None:
+        return self.start
+
+    def queue_summary(self) -> dict[str, Any]:
+        if not self.reachable:
+            raise RuntimeError("cannot reach cluster")
+        return dict(now=NOW, idle_cpus=self.idle_cpus, total_cpus=64, pending=self.pending)
+
+
+def route(apis: dict[str, QueueAPI], slots: list[str] | None = None) -> tuple[str, dict[str, Any]]:
+    router = Router(logging.getLogger("test"), Placement(logging.getLogger("test")))
+    clusters = {name: ClusterConfig(loginnode=name) for name in apis}
+
+    def slot(cfg: ClusterConfig):
+        if slots is not None:
+            slots.append(cfg.loginnode)
+        return contextlib.nullcontext()
+
+    return router.route("alice", clusters, {"time": "1:00:00"}, lambda cfg: apis[cfg.loginnode], slot)
+
+
+def test_wait_seconds():
+    assert wait_seconds("2024-01-01T10:05:00", NOW) == 300.0
+    assert wait_seconds("2024-01-01T09:00:00", NOW) == 0.0
+    assert wait_seconds(None, NOW) is None
+    assert wait_seconds("N/A", NOW) is None
+
+
+def test_rank():
+    assert rank(dict(wait_s=None, idle_cpus=8, pending=0)) > rank(dict(wait_s=3600, idle_cpus=0, pending=9))
+
+
+def test_route_earliest_start():
+    slots: list[str] = []
+    cluster, trace = route(
+        {
+            "a": QueueAPI("a", "2024-01-01T11:00:00", idle_cpus=32),
+            "b": QueueAPI("b", "2024-01-01T10:10:00"),
+        },
+        slots,
+    )
+    assert cluster == "b"
+    assert trace["cluster"] == "b"
+    assert [c["wait_s"] for c in trace["candidates"]] == [3600.0, 600.0]
+    # every cluster is evaluated while holding a slot on its login
+    assert sorted(slots) == ["a", "b"]
+
+
+def test_route_same_minute_goes_to_idle_cpus():
+    cluster, _ = route(
+        {
+            "a": QueueAPI("a", "2024-01-01T10:00:10", idle_cpus=4),
+            "b": QueueAPI("b", "2024-01-01T10:00:50", idle_cpus=16),
+        }
+    )
+    assert cluster == "b"
+
+
+def test_route_then_pending_then_order():
+    cluster, _ = route({"a": QueueAPI("a", NOW, pending=5), "b": QueueAPI("b", NOW, pending=1)})
+    assert cluster == "b"
+    cluster, _ = route({"a": QueueAPI("a", NOW), "b": QueueAPI("b", NOW)})
+    assert cluster == "a"
+
+
+def test_route_skips_ineligible():
+    cluster, trace = route(
+        {
+            "a": QueueAPI("a", NOW, reachable=False),
+            "b": QueueAPI("b", None),
+            "c": QueueAPI("c", "2024-01-02T10:00:00"),
+        }
+    )
+    assert cluster == "c"
+    a, b, _ = trace["candidates"]
+    assert (a["eligible"], a["error"]) == (False, "cannot reach cluster")
+    assert (b["eligible"], b["error"]) == (False, "spec cannot be scheduled")
+
+
+def test_route_no_eligible():
+    with pytest.raises(NoEligibleClusterException):
+        route({"a": QueueAPI("a", None), "b": QueueAPI("b", NOW, reachable=False)})
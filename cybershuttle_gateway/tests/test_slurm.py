@@ -0,0 +1,73 @@
+import logging
+import threading
+
+import pytest
+
+from cybershuttle_gateway.api.slurm import SlurmAPI
+from cybershuttle_gateway.exceptions import CircuitOpenException, ClusterUnreachableException
+
+log = logging.getLogger("test")
+
+
+class FakeSlurm(SlurmAPI):
+    """
+    SlurmAPI whose remote commands are answered by a fake cluster
+
+    """
+
+    def __init__(self, submit_error: Exception | None = None):
+        super().__init__(log, ["ssh", "login"])
+        self.submit_error = submit_error
+        self.script = ""
+        self.queue: dict[str, str] = {}
+        self.cancelled: list[str] = []
+        self.done = threading.Event()
+
+    def run_command(self, command, input=None, timeout=None, name="command"):
+        remote = command[-1]
+        if name == "sbatch":
+            self.script = input.decode()
+            tag = self.script.split("--comment=")[1].split("\n")[0]
+            # the job is queued, whether or not sbatch answers in time
+            self.queue["4242"] = tag
+            if self.submit_error is not None:
+                raise self.submit_error
+            return 0, b"4242\n", b""
+        if name == "squeue":
+            return 0, "".join(f"{i} {tag}\n" for i, tag in self.queue.items()).encode(), b""
+        if name == "scancel":
+            self.cancelled.extend(remote.strip('"').split()[1:])
+            self.done.set()
+            return 0, b"", b""
+        raise AssertionError(remote)
+
+    def cancel_tagged(self, tag, attempts=10, delay=30.0):
+        job_ids = super().cancel_tagged(tag, attempts, 0)
+        self.done.set()
+        return job_ids
+
+
+def test_submission_is_tagged():
+    api = FakeSlurm()
+    assert api.launch_job("#!/bin/bash\n#SBATCH -J kernel\nhostname\n") == "4242"
+    lines = api.script.splitlines()
+    assert lines[0] == "#!/bin/bash"
+    assert lines[1].startswith("#SBATCH --comment=cybershuttle-")
+    assert lines[2:] == ["#SBATCH -J kernel", "hostname"]
+
+
+def test_timed_out_submission_is_cancelled():
+    api = FakeSlurm(ClusterUnreachableException("command timed out after 120s"))
+    api.queue["1000"] = "cybershuttle-other"
+    with pytest.raises(ClusterUnreachableException):
+        api.launch_job("#!/bin/bash\nhostname\n")
+    assert api.done.wait(5)
+    # only the job of this submission
+    assert api.cancelled == ["4242"]
+
+
+def test_open_circuit_does_not_look_for_jobs():
+    api = FakeSlurm(CircuitOpenException("circuit open"))
+    with pytest.raises(CircuitOpenException):
+        api.launch_job("#!/bin/bash\nhostname\n")
+    assert not api.done.wait(0.2)
@@ -0,0 +1,223 @@
+import json
+import logging
+import threading
+import time
+
+import msgpack
+import pytest
+import zmq
+
+from cybershuttle_gateway import __main__ as gateway
+from cybershuttle_gateway.api import APIBase
+from cybershuttle_gateway.snapshot import restore, snapshot, snapshot_name
+from cybershuttle_gateway.typing import ClusterConfig, JobState
+from cybershuttle_gateway.util import get_ephemeral_ports
+from cybershuttle_gateway.wire import deserialize, new_message, serialize, split_identities
+
+KEY = b"secret"
+
+
+class FakeIPython:
+
+    def __init__(self, user_ns: dict):
+        self.user_ns = user_ns
+        self.user_ns_hidden: dict = {}
+
+
+class FakeKernel(threading.Thread):
+    """
+    A kernel shell channel that runs execute requests in a namespace of its own, and counts the requests
+
+    """
+
+    def __init__(self, port: int = 0):
+        super().__init__(daemon=True)
+        self.sock = zmq.Context.instance().socket(zmq.ROUTER)
+        self.sock.setsockopt(zmq.LINGER, 0)
+        if port:
+            self.sock.bind(f"tcp://127.0.0.1:{port}")
+            self.port = port
+        else:
+            self.port = self.sock.bind_to_random_port("tcp://127.0.0.1")
+        self.ns: dict = {}
+        self.ns["get_ipython"] = lambda: FakeIPython(self.ns)
+        self.requests: list[str] = []
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            if not self.sock.poll(50):
+                continue
+            frames = self.sock.recv_multipart()
+            identities, _ = split_identities(frames)
+            msg = deserialize(frames, KEY)
+            msg_type = msg["header"]["msg_type"]
+            self.requests.append(msg_type)
+            if msg_type == "kernel_info_request":
+                content = dict(status="ok", protocol_version="5.3")
+            else:
+                content = self.execute(msg["content"])
+            reply = new_message(msg_type.replace("_request", "_reply"), content, session="kernel", parent=msg)
+            self.sock.send_multipart(serialize(reply, KEY, identities))
+        self.sock.close()
+
+    def execute(self, request: dict) -> dict:
+        try:
+            exec(request["code"], self.ns)
+        except Exception as e:
+            return dict(status="error", ename=type(e).__name__, evalue=str(e))
+        expressions = {}
+        for name, expression in request["user_expressions"].items():
+            value = eval(expression, self.ns)
+            expressions[name] = dict(status="ok", data={"text/plain": repr(value)})
+        return dict(status="ok", user_expressions=expressions)
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join()
+
+
+class SnapshotAPI(APIBase):
+
+    def __init__(self):
+        super().__init__()
+        self.log = logging.getLogger("test")
+        self.ssh_prefix = []
+        self.signals: list[tuple[int, int]] = []
+
+    def signal_job(self, job_id: int, signum: int) -> bool:
+        self.signals.append((job_id, signum))
+        return True
+
+    def close_forwarding(self) -> None:
+        pass
+
+
+@pytest.fixture
+def snapshot_dir(tmp_path, monkeypatch):
+    path = tmp_path / "snapshots"
+    monkeypatch.setenv("CYBERSHUTTLE_SNAPSHOT_DIR", str(path))
+    return path
+
+
+@pytest.fixture
+def kernel():
+    kernel = FakeKernel()
+    kernel.start()
+    yield kernel
+    kernel.stop()
+
+
+@pytest.fixture
+def client(tmp_path):
+    config = tmp_path / "users.json"
+    config.write_text(json.dumps(dict(alice=dict(clusters={}), bob=dict(clusters={}))))
+    gateway.config_file = str(config)
+    yield gateway.app.test_client()
+    for job_id in list(gateway.state_var):
+        gateway.release_job(job_id)
+    gateway.snapshots.clear()
+
+
+def add_job(job_id: str, port: int, forwarding: bool = True, restore: str = "") -> JobState:
+    state = gateway.state_var[job_id] = JobState(
+        api=SnapshotAPI(),
+        username="alice",
+        gateway_url="http://gateway",
+        cluster=ClusterConfig(),
+        cluster_name="hpc",
+        transport="zmq",
+        spec={},
+        connection_info=dict(key=KEY.decode()),
+        port_map=[],
+        tunnel_map=[(0, port)],
+        forwarding=forwarding,
+        workdir="",
+        restore=restore,
+    )
+    return state
+
+
+def post(client, url: str, user: str = "alice", **body):
+    return client.post(url, query_string=dict(user=user), data=msgpack.dumps(body) if body else b"")
+
+
+def test_snapshot_then_restore_into_another_kernel(snapshot_dir, kernel):
+    kernel.ns.update(x=1, data=dict(a=[1, 2]), numbers=(i for i in range(3)))
+    result = snapshot("127.0.0.1", kernel.port, KEY, "hpc-1-manual", timeout=5.0)
+    assert result["path"] == str(snapshot_dir / "hpc-1-manual.snapshot")
+    assert sorted(result["saved"]) == ["data", "x"]
+    # generators cannot be serialized, and the helpers leave nothing behind
+    assert result["skipped"] == ["numbers"]
+    assert not any(k.startswith("_cs") for k in kernel.ns)
+
+    other = FakeKernel()
+    other.start()
+    try:
+        result = restore("127.0.0.1", other.port, KEY, "hpc-1-manual.snapshot", timeout=5.0)
+    finally:
+        other.stop()
+    assert sorted(result["restored"]) == ["data", "x"] and result["failed"] == []
+    assert (other.ns["x"], other.ns["data"]) == (1, dict(a=[1, 2]))
+
+
+def test_snapshot_names_are_safe():
+    assert snapshot_name("my cluster", "1", "../manual").startswith("my_cluster-1-.._manual-")
+
+
+def test_snapshot_endpoint(client, snapshot_dir, kernel):
+    add_job("1", kernel.port)
+    kernel.ns.update(x=1)
+    r = post(client, "/snapshot/1")
+    assert r.status_code == 200
+    assert r.get_json()["saved"] == ["x"] and not r.get_json()["released"]
+    assert [s["reason"] for s in client.get("/snapshots", query_string=dict(user="alice")).get_json()] == ["manual"]
+    assert client.get("/snapshots", query_string=dict(user="bob")).get_json() == []
+
+
+def test_hibernate_releases_the_job(client, snapshot_dir, kernel):
+    state = add_job("1", kernel.port)
+    r = post(client, "/snapshot/1", release=True)
+    assert r.get_json()["released"]
+    assert state.api.signals == [(1, 15)]
+    assert "1" not in gateway.state_var
+
+
+def test_only_owner_may_snapshot_or_restore(client, kernel):
+    add_job("1", kernel.port)
+    assert post(client, "/snapshot/1", user="bob").status_code == 403
+    assert post(client, "/restore/1", user="bob", path="/tmp/evil.snapshot").status_code == 403
+    assert post(client, "/snapshot/2").status_code == 404
+    assert kernel.requests == []
+
+
+def test_kernel_must_be_running(client, kernel):
+    add_job("1", kernel.port, forwarding=False)
+    assert post(client, "/snapshot/1").status_code == 409
+    assert post(client, "/restore/1", path="x.snapshot").status_code == 409
+    assert kernel.requests == []
+
+
+def test_failed_restore_is_a_conflict(client, snapshot_dir, kernel):
+    add_job("1", kernel.port)
+    r = post(client, "/restore/1", path="missing.snapshot")
+    assert r.status_code == 409
+    assert "FileNotFoundError" in r.get_json()["error"]
+
+
+def test_restore_when_ready_restores_once(snapshot_dir, kernel):
+    kernel.ns.update(x=1)
+    snapshot("127.0.0.1", kernel.port, KEY, "saved", timeout=5.0)
+    # the new kernel only listens a while after its tunnel is up
+    [free] = get_ephemeral_ports(1)
+    add_job("2", free, restore="saved.snapshot")
+    late = FakeKernel(free)
+    thread = threading.Thread(target=gateway.restore_when_ready, args=("2", 10.0))
+    thread.start()
+    time.sleep(0.5)
+    late.start()
+    thread.join(10.0)
+    late.stop()
+    gateway.release_job("2")
+    assert late.requests.count("execute_request") == 1
+    assert late.ns["x"] == 1
@@ -0,0 +1,49 @@
+from cybershuttle_gateway.startup import StartupStats, durations, percentile
+
+
+def timeline(queue: float) -> dict[str, float]:
+    return dict(requested=0.0, submitted=1.0, running=1.0 + queue, tunnel=2.0 + queue, heartbeat=2.5 + queue, kernel_info=3.0 + queue)
+
+
+def test_durations_skip_incomplete():
+    assert durations(dict(requested=0.0, submitted=1.5)) == dict(submit=1.5)
+
+
+def test_percentile():
+    assert percentile([1.0, 2.0, 3.0, 4.0, 5.0], 50) == 3.0
+    assert percentile([1.0, 2.0], 50) == 1.5
+    assert percentile([7.0], 99) == 7.0
+
+
+def test_summary():
+    stats = StartupStats()
+    spec = {"time": "1:00:00"}
+    for i, queue in enumerate([10.0, 20.0, 30.0]):
+        stats.record(str(i), "a", spec, timeline(queue))
+    stats.record("3", "b", spec, dict(requested=0.0, submitted=2.0))
+
+    summary = stats.summary()
+    assert [(s["cluster"], s["count"]) for s in summary] == [("a", 3), ("b", 1)]
+    a = summary[0]
+    assert a["spec"] == spec
+    assert a["phases"]["queue"] == dict(count=3, p50=20.0, p90=28.0, p99=29.8, max=30.0)
+    assert a["phases"]["total"]["p50"] == 23.0
+    # phases that no kernel of the group went through are left out
+    assert list(summary[1]["phases"]) == ["submit"]
+
+
+def test_summary_per_cluster_and_spec():
+    stats = StartupStats()
+    stats.record("0", "a", {"mem": "4G"}, timeline(1.0))
+    stats.record("1", "a", {"mem": "8G"}, timeline(1.0))
+    stats.record("2", "b", {"mem": "4G"}, timeline(1.0))
+    assert [s["spec"] for s in stats.summary("a")] == [{"mem": "4G"}, {"mem": "8G"}]
+    assert stats.summary("c") == []
+
+
+def test_history_size():
+    stats = StartupStats(size=2)
+    for i in range(3):
+        stats.record(str(i), "a", {}, timeline(float(i)))
+    assert stats.summary()[0]["phases"]["queue"]["max"] == 2.0
+    assert stats.summary()[0]["count"] == 2
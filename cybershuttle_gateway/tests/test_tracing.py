@@ -0,0 +1,37 @@
+import logging
+from pathlib import Path
+
+import pytest
+
+from cybershuttle_gateway import tracing
+from cybershuttle_gateway.tracing import Tracer, current_span, parse_traceparent
+
+PROVISIONER_COPY = Path(__file__).parents[2] / "cybershuttle_provisioners" / "cybershuttle_provisioners" / "tracing.py"
+
+
+@pytest.mark.skipif(not PROVISIONER_COPY.exists(), reason="not in a checkout with the provisioners")
+def test_same_as_provisioner_copy():
+    assert Path(tracing.__file__).read_text() == PROVISIONER_COPY.read_text()
+
+
+def test_parse_traceparent():
+    trace_id, span_id = "0af7651916cd43dd8448eb211c80319c", "b7ad6b7169203331"
+    assert parse_traceparent(f"00-{trace_id}-{span_id}-01") == (trace_id, span_id)
+    assert parse_traceparent("00-xyz-01") is None
+    assert parse_traceparent(None) is None
+
+
+def test_child_spans():
+    tracer = Tracer(logging.getLogger("test"), "test")
+    with tracer.span("parent") as parent:
+        assert current_span.get() is parent
+        with tracer.span("child") as child:
+            assert child.trace_id == parent.trace_id
+            assert child.parent_id == parent.span_id
+    assert current_span.get() is None
+
+
+def test_instance_shared():
+    tracer = Tracer.instance(logging.getLogger("test"), "test")
+    assert Tracer.instance(logging.getLogger("test"), "test") is tracer
+    assert Tracer.instance(logging.getLogger("test"), "other") is not tracer
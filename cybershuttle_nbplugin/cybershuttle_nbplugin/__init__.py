@@ -7,6 +7,7 @@ except ImportError:
     import warnings
     warnings.warn("Importing 'cybershuttle_nbplugin' outside a proper installation.")
     __version__ = "dev"
+from .config import CybershuttleConfig
 from .handlers import setup_handlers
 
 
@@ -31,6 +32,7 @@ def _load_jupyter_server_extension(server_app):
     server_app: jupyterlab.labapp.LabApp
         JupyterLab application instance
     """
-    setup_handlers(server_app.web_app)
+    config = CybershuttleConfig(parent=server_app)
+    setup_handlers(server_app.web_app, config, server_app.log)
     name = "cybershuttle_nbplugin"
-    server_app.log.info(f"Registered {name} server extension")
+    server_app.log.info(f"Registered {name} server extension (gateway: {config.gateway_url})")
@@ -0,0 +1,59 @@
+import asyncio
+import time
+from logging import Logger
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class SWRCache:
+    """
+    TTL cache that serves stale values while refreshing them (stale-while-revalidate)
+
+    - fresh (younger than ttl): served from cache
+    - stale (younger than ttl + stale_ttl): served from cache, refreshed in the background
+    - missing or expired: fetched, and the caller waits for it
+
+    Concurrent fetches of the same key are coalesced into one.
+
+    """
+
+    def __init__(self, logger: Logger, ttl: float = 30.0, stale_ttl: float = 300.0):
+        super().__init__()
+        self.log = logger
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.entries: dict[Hashable, tuple[float, Any]] = {}
+        self.inflight: dict[Hashable, asyncio.Future] = {}
+
+    async def get(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        entry = self.entries.get(key)
+        if entry is not None:
+            fetched, value = entry
+            age = time.monotonic() - fetched
+            if age < self.ttl:
+                return value
+            if age < self.ttl + self.stale_ttl:
+                self.refresh(key, fetch)
+                return value
+        # shield, so that a caller going away does not cancel the fetch for the others
+        return await asyncio.shield(self.refresh(key, fetch))
+
+    def refresh(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        if key not in self.inflight:
+            future = asyncio.ensure_future(self._fetch(key, fetch))
+            future.add_done_callback(lambda f: self._done(key, f))
+            self.inflight[key] = future
+        return self.inflight[key]
+
+    def invalidate(self, key: Hashable) -> None:
+        self.entries.pop(key, None)
+
+    async def _fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        value = await fetch()
+        self.entries[key] = (time.monotonic(), value)
+        return value
+
+    def _done(self, key: Hashable, future: asyncio.Future) -> None:
+        self.inflight.pop(key, None)
+        # background refreshes have no caller to see their error
+        if not future.cancelled() and future.exception() is not None:
+            self.log.warning(f"error refreshing {key}: {future.exception()!r}")
@@ -0,0 +1,24 @@
+import os
+
+from traitlets import Float, Int, Unicode, default
+from traitlets.config import Configurable
+
+
+class CybershuttleConfig(Configurable):
+    """
+    Settings of the Cybershuttle server extension
+
+    Set them in jupyter_server_config, e.g. c.CybershuttleConfig.gateway_url = "https://...",
+    or set the gateway through the CYBERSHUTTLE_GATEWAY_URL environment variable.
+
+    """
+
+    gateway_url = Unicode(config=True, help="URL of the Cybershuttle Gateway")
+    cache_ttl = Float(30.0, config=True, help="Seconds a kernelspec response is served from cache")
+    cache_stale_ttl = Float(300.0, config=True, help="Seconds a stale response is served while it is refreshed")
+    request_timeout = Float(10.0, config=True, help="Seconds to wait for the gateway")
+    max_clients = Int(10, config=True, help="Concurrent connections to the gateway")
+
+    @default("gateway_url")
+    def _default_gateway_url(self):
+        return os.environ.get("CYBERSHUTTLE_GATEWAY_URL", "http://74.235.88.134")
@@ -3,10 +3,16 @@ import os
 import uuid
 from pathlib import Path
 
-import requests
 import tornado
 from jupyter_server.base.handlers import APIHandler
 from jupyter_server.utils import url_path_join
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.httputil import url_concat
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from .cache import SWRCache
+from .config import CybershuttleConfig
+from .kernelspec import CybershuttleKernelSpecManager
 
 """
 this is what the json body should look like
@@ -21,15 +27,50 @@ input_data = {
 """
 
 
+def make_http_client(max_clients: int) -> AsyncHTTPClient:
+    """
+    Create a client of our own (not the shared instance), keeping connections alive if pycurl is available
+
+    """
+    try:
+        from tornado.curl_httpclient import CurlAsyncHTTPClient
+
+        return CurlAsyncHTTPClient(force_instance=True, max_clients=max_clients)
+    except ImportError:
+        return AsyncHTTPClient(force_instance=True, max_clients=max_clients)
+
+
 class RouteHandler(APIHandler):
 
-    gateway_url = "http://74.235.88.134"
+    @property
+    def cs_config(self) -> CybershuttleConfig:
+        return self.settings["cybershuttle_config"]
+
+    @property
+    def gateway_url(self) -> str:
+        return self.cs_config.gateway_url.rstrip("/")
+
+    async def fetch_kernelspecs(self, user: str) -> str:
+        client: AsyncHTTPClient = self.settings["cybershuttle_http_client"]
+        url = url_concat(f"{self.gateway_url}/kernelspecs", {"user": user})
+        try:
+            res = await client.fetch(url, request_timeout=self.cs_config.request_timeout)
+        except HTTPClientError as e:
+            # errors are passed on, and not cached
+            raise tornado.web.HTTPError(e.code if e.code < 599 else 502, f"gateway: {e}")
+        except OSError as e:
+            raise tornado.web.HTTPError(502, f"gateway: {e}")
+        return json.dumps(json.loads(res.body))
 
     @tornado.web.authenticated
-    def get(self):
+    async def get(self):
         user = self.get_query_argument("user")
-        res = requests.get(f"{self.gateway_url}/kernelspecs?user={user}")
-        self.finish(json.dumps(res.json()))
+        cache: SWRCache = self.settings["cybershuttle_cache"]
+        body = await cache.get((self.gateway_url, user), lambda: self.fetch_kernelspecs(user))
+        ksm = self.kernel_spec_manager
+        if isinstance(ksm, CybershuttleKernelSpecManager) and user == ksm.username:
+            ksm.set_remote_specs(json.loads(body))
+        self.finish(body)
 
     @tornado.web.authenticated
     def post(self):
@@ -64,7 +105,14 @@ class RouteHandler(APIHandler):
             },
         }
 
-        # save kernelspec in local directory with uuid
+        # keep kernelspec in memory under a unique name, if the kernelspec manager allows
+        ksm = self.kernel_spec_manager
+        if isinstance(ksm, CybershuttleKernelSpecManager):
+            kernel_name = ksm.register_launch_spec(kernelspec, prefix=f"cs-{input_data['cluster']}")
+            self.finish(json.dumps({"name": kernel_name}))
+            return
+
+        # otherwise, save kernelspec in local directory with uuid
         path = Path(os.path.expanduser("~/.local/share/jupyter/kernels"))
 
         # hardcode kernel name to "<cluster_name>" to avoid 100s of kernespecs
@@ -79,9 +127,19 @@ class RouteHandler(APIHandler):
         self.finish(json.dumps({"name": kernel_uuid}))
 
 
-def setup_handlers(web_app):
+def setup_handlers(web_app, config: CybershuttleConfig, logger):
     host_pattern = ".*$"
 
+    web_app.settings["cybershuttle_config"] = config
+    web_app.settings["cybershuttle_cache"] = SWRCache(logger, config.cache_ttl, config.cache_stale_ttl)
+    web_app.settings["cybershuttle_http_client"] = client = make_http_client(config.max_clients)
+
+    # keep the gateway's kernelspecs in memory, if served by our kernelspec manager
+    ksm = web_app.settings.get("kernel_spec_manager")
+    if isinstance(ksm, CybershuttleKernelSpecManager):
+        IOLoop.current().add_callback(ksm.sync, client)
+        PeriodicCallback(lambda: ksm.sync(client), ksm.sync_interval * 1000).start()
+
     base_url = web_app.settings["base_url"]
     route_pattern = url_path_join(base_url, "cybershuttle-nbplugin", "kernelspec")
     handlers = [(route_pattern, RouteHandler)]
@@ -0,0 +1,172 @@
+import getpass
+import json
+import os
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from typing import Any
+
+from jupyter_client.kernelspec import KernelSpec, KernelSpecManager
+from jupyter_core.paths import jupyter_data_dir
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.httputil import url_concat
+from traitlets import Float, Unicode, default
+
+from .config import CybershuttleConfig
+
+# kernels written to disk by kernel_sync_daemon.py (listed in each kernels directory it syncs)
+DAEMON_MANIFEST = ".cybershuttle_kernels.json"
+
+
+class CybershuttleKernelSpecManager(KernelSpecManager):
+    """
+    KernelSpecManager that serves Cybershuttle kernelspecs from memory
+
+    Kernelspecs offered by the gateway are kept in memory and refreshed by
+    sync(). Per-launch kernelspecs (spec, workdir, exec_path, user_scripts)
+    are registered under unique names with register_launch_spec(), so that
+    nothing is written to the kernels directory. They are kept (in
+    launch_specs_file, across server restarts) while a kernel runs from them,
+    and for launch_spec_ttl seconds after they were last used, so kernels can
+    be restarted and sessions reconnected. Other kernelspecs are found on disk
+    as usual, with the directory scan cached for local_scan_ttl seconds;
+    those written by kernel_sync_daemon.py are left out, since the same
+    kernelspecs are served from memory.
+
+    Enable with c.ServerApp.kernel_spec_manager_class = "cybershuttle_nbplugin.kernelspec.CybershuttleKernelSpecManager"
+
+    """
+
+    username = Unicode(config=True, help="Gateway user whose kernelspecs are listed")
+    local_scan_ttl = Float(10.0, config=True, help="Seconds to reuse a scan of the kernels directories")
+    launch_spec_ttl = Float(7 * 24 * 3600.0, config=True, help="Seconds to keep a per-launch kernelspec once no kernel runs from it")
+    launch_specs_file = Unicode(config=True, help="File that per-launch kernelspecs are kept in across server restarts")
+    sync_interval = Float(30.0, config=True, help="Seconds between syncs of the gateway's kernelspecs")
+
+    @default("username")
+    def _default_username(self):
+        return os.environ.get("CYBERSHUTTLE_USER", getpass.getuser())
+
+    @default("launch_specs_file")
+    def _default_launch_specs_file(self):
+        return os.path.join(jupyter_data_dir(), "cybershuttle_launch_specs.json")
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.cs_config = CybershuttleConfig(parent=self)
+        self.remote_specs: dict[str, dict[str, Any]] = {}
+        # {name: {"spec": kernelspec, "used": epoch seconds of the last launch or restart}}
+        self.launch_specs: dict[str, dict[str, Any]] = self.load_launch_specs()
+        self.etag = ""
+        self.local_scan: tuple[float, dict[str, str]] | None = None
+        # kernelspecs need a resource directory; ours have no resources
+        self.resource_dir = tempfile.mkdtemp(prefix="cybershuttle-kernels-")
+
+    @property
+    def gateway_url(self) -> str:
+        return self.cs_config.gateway_url.rstrip("/")
+
+    def set_remote_specs(self, specs: dict[str, dict[str, Any]]) -> None:
+        self.remote_specs = {name.lower(): {**spec, "display_name": name} for name, spec in specs.items()}
+
+    async def sync(self, client: AsyncHTTPClient) -> None:
+        """
+        Refresh the gateway's kernelspecs (a cheap 304 when they have not changed)
+
+        """
+        url = url_concat(f"{self.gateway_url}/kernelspecs", {"user": self.username})
+        headers = {"If-None-Match": self.etag} if self.etag else {}
+        try:
+            res = await client.fetch(url, headers=headers, request_timeout=self.cs_config.request_timeout)
+        except HTTPClientError as e:
+            if e.code != 304:
+                self.log.warning(f"could not sync kernelspecs from {self.gateway_url}: {e}")
+            return
+        except OSError as e:
+            self.log.warning(f"could not sync kernelspecs from {self.gateway_url}: {e}")
+            return
+        self.etag = res.headers.get("ETag", "")
+        self.set_remote_specs(json.loads(res.body))
+
+    def load_launch_specs(self) -> dict[str, dict[str, Any]]:
+        try:
+            with open(self.launch_specs_file, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_launch_specs(self) -> None:
+        path = Path(self.launch_specs_file)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.launch_specs, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            self.log.warning(f"could not save launch kernelspecs to {path}: {e}")
+
+    def running_kernel_names(self) -> set[str]:
+        """
+        Kernelspec names of the kernels running on the server (if this manager belongs to one)
+
+        """
+        kernel_manager = getattr(self.parent, "kernel_manager", None)
+        if kernel_manager is None:
+            return set()
+        return {kernel_manager.get_kernel(kernel_id).kernel_name for kernel_id in kernel_manager.list_kernel_ids()}
+
+    def register_launch_spec(self, kernelspec: dict[str, Any], prefix: str = "cs") -> str:
+        """
+        Keep a kernelspec for a single launch, and return its (unique) name
+
+        Kernelspecs that no kernel runs from, and that were not used for launch_spec_ttl seconds, are dropped.
+
+        """
+        name = f"{prefix}-{uuid.uuid4().hex[:12]}".lower()
+        now = time.time()
+        running = self.running_kernel_names()
+        for old in [n for n, entry in self.launch_specs.items() if n not in running and now - entry["used"] > self.launch_spec_ttl]:
+            del self.launch_specs[old]
+        self.launch_specs[name] = dict(spec=kernelspec, used=now)
+        self.save_launch_specs()
+        return name
+
+    def find_kernel_specs(self) -> dict[str, str]:
+        now = time.monotonic()
+        if self.local_scan is None or now - self.local_scan[0] > self.local_scan_ttl:
+            self.local_scan = (now, self.scan_local_specs())
+        specs = dict(self.local_scan[1])
+        # launch specs are only looked up by name, not listed in the launcher
+        for name in self.remote_specs:
+            specs[name] = self.resource_dir
+        return specs
+
+    def scan_local_specs(self) -> dict[str, str]:
+        specs = super().find_kernel_specs()
+        synced: set[str] = set()
+        for kernel_dir in self.kernel_dirs:
+            try:
+                with open(os.path.join(kernel_dir, DAEMON_MANIFEST), "r") as f:
+                    synced.update(name.lower() for name in json.load(f))
+            except (OSError, ValueError):
+                continue
+        return {name: path for name, path in specs.items() if name not in synced}
+
+    def get_kernel_spec(self, kernel_name: str) -> KernelSpec:
+        name = kernel_name.lower()
+        entry = self.launch_specs.get(name)
+        if entry is not None:
+            # looked up on each launch and restart of its kernel
+            entry["used"] = time.time()
+            self.save_launch_specs()
+        spec = entry["spec"] if entry is not None else self.remote_specs.get(name)
+        if spec is not None:
+            return self.kernel_spec_class(resource_dir=self.resource_dir, **spec)
+        resource_dir = self.find_kernel_specs().get(name)
+        if resource_dir is not None:
+            return self._get_kernel_spec_by_name(kernel_name, resource_dir)
+        # may have been added on disk since the last cached scan
+        self.local_scan = None
+        return super().get_kernel_spec(kernel_name)
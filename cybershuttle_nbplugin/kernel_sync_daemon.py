@@ -1,52 +1,188 @@
 """
-Periodically sync available kernels with Cybershuttle Gateway
+Keep local kernels in sync with Cybershuttle Gateway
+
+Subscribes to the gateway's kernel spec feed (server-sent events) and falls
+back to polling /kernelspecs while the feed is unavailable. A kernel.json is
+only written when its content changed, via a temp file and rename, and kernels
+this daemon wrote that are no longer offered by the gateway are removed.
+
+Servers that use CybershuttleKernelSpecManager serve the same kernelspecs
+from memory, and leave out the ones written here. The daemon is for other
+Jupyter servers and clients, which only find kernels on disk.
 
 @author: Yasith Jayawardana <yasith@cs.odu.edu>
 
 """
 
 import argparse
+import hashlib
 import json
 import os
+import shutil
+import tempfile
 import time
 from pathlib import Path
+from typing import Any, Iterator
 
 import requests
-import schedule
+
+MANIFEST = ".cybershuttle_kernels.json"
 
 
-def sync_cybershuttle_kernels_with_localfs():
+def write_atomic(path: Path, data: bytes) -> None:
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
     try:
-        response = requests.get(f"{url}/kernelspecs", params={"user": username})
-        if response.status_code == 200:
-            data: dict[str, dict] = response.json()
-            for kernel_name, kernel_spec in data.items():
-                kernel_fp = kernel_dir / kernel_name
-                kernel_spec["display_name"] = kernel_name
-                os.makedirs(kernel_fp, exist_ok=True)
-                with open(kernel_fp / "kernel.json", "w") as f:
-                    json.dump(kernel_spec, f)
-            print(f"Wrote {len(data)} kernels to {kernel_dir}")
-        else:
-            print(f"Got HTTP {response.status_code} error for kernel request")
-    except Exception as e:
-        print("Error getting kernels:", e)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class KernelSync:
+    """
+    Mirror the gateway's kernel specs for one user into a kernel directory
+
+    """
+
+    def __init__(self, url: str, username: str, kernel_dir: Path, interval: float = 5.0, heartbeat: float = 15.0):
+        super().__init__()
+        self.url = url.rstrip("/")
+        self.username = username
+        self.kernel_dir = kernel_dir
+        self.interval = interval
+        self.heartbeat = heartbeat
+        self.session = requests.Session()
+        self.etag = ""
+        self.version = ""
+
+    def read_manifest(self) -> list[str]:
+        try:
+            with open(self.kernel_dir / MANIFEST, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def apply(self, data: dict[str, dict[str, Any]]) -> None:
+        """
+        Write the kernel specs that changed, and remove those that are gone
+
+        """
+        os.makedirs(self.kernel_dir, exist_ok=True)
+        written = 0
+        for kernel_name, kernel_spec in data.items():
+            kernel_fp = self.kernel_dir / kernel_name
+            kernel_spec["display_name"] = kernel_name
+            content = json.dumps(kernel_spec).encode()
+            try:
+                with open(kernel_fp / "kernel.json", "rb") as f:
+                    unchanged = digest(f.read()) == digest(content)
+            except OSError:
+                unchanged = False
+            if unchanged:
+                continue
+            os.makedirs(kernel_fp, exist_ok=True)
+            write_atomic(kernel_fp / "kernel.json", content)
+            written += 1
+
+        # only remove kernels this daemon created, never ones added by hand
+        previous = self.read_manifest()
+        removed = [name for name in previous if name not in data]
+        for kernel_name in removed:
+            shutil.rmtree(self.kernel_dir / kernel_name, ignore_errors=True)
+        if sorted(data) != sorted(previous):
+            write_atomic(self.kernel_dir / MANIFEST, json.dumps(sorted(data)).encode())
+
+        if written or removed:
+            print(f"Wrote {written} and removed {len(removed)} of {len(data)} kernels in {self.kernel_dir}")
+
+    def poll(self) -> None:
+        headers = {"If-None-Match": self.etag} if self.etag else {}
+        response = self.session.get(
+            f"{self.url}/kernelspecs", params={"user": self.username}, headers=headers, timeout=30
+        )
+        if response.status_code == 304:
+            return
+        if response.status_code != 200:
+            raise RuntimeError(f"Got HTTP {response.status_code} error for kernel request")
+        self.etag = response.headers.get("ETag", "")
+        self.apply(response.json())
+
+    def events(self) -> Iterator[tuple[str, str, str]]:
+        """
+        Yield (event, id, data) from the gateway's kernel spec feed until it drops
+
+        """
+        headers = {"Accept": "text/event-stream"}
+        if self.version:
+            headers["Last-Event-ID"] = self.version
+        # no data (not even a keepalive) for a few heartbeats means the feed is dead
+        with self.session.get(
+            f"{self.url}/kernelspecs/events",
+            params={"user": self.username},
+            headers=headers,
+            stream=True,
+            timeout=(10, self.heartbeat * 3),
+        ) as response:
+            if response.status_code != 200:
+                raise RuntimeError(f"Got HTTP {response.status_code} error for kernel feed")
+            event, event_id, data = "message", "", []
+            for line in response.iter_lines(decode_unicode=True):
+                if line == "":
+                    if data:
+                        yield event, event_id, "\n".join(data)
+                    event, event_id, data = "message", "", []
+                elif line.startswith(":"):
+                    continue
+                else:
+                    field, _, value = line.partition(":")
+                    value = value.removeprefix(" ")
+                    if field == "event":
+                        event = value
+                    elif field == "id":
+                        event_id = value
+                    elif field == "data":
+                        data.append(value)
+        raise ConnectionError("kernel feed closed")
+
+    def run(self, max_backoff: float = 300.0) -> None:
+        backoff = self.interval
+        while True:
+            try:
+                for event, event_id, data in self.events():
+                    if event == "kernelspecs":
+                        self.apply(json.loads(data))
+                        self.version = event_id
+                        backoff = self.interval
+            except Exception as e:
+                print(f"Kernel feed unavailable ({e}), polling for {backoff:.0f}s")
+
+            # poll until it is time to try the feed again
+            retry_at = time.monotonic() + backoff
+            while True:
+                try:
+                    self.poll()
+                except Exception as e:
+                    print("Error getting kernels:", e)
+                if time.monotonic() >= retry_at:
+                    break
+                time.sleep(self.interval)
+            backoff = min(backoff * 2, max_backoff)
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Periodically sync available kernels with Cybershuttle Gateway")
+    parser = argparse.ArgumentParser(description="Keep local kernels in sync with Cybershuttle Gateway")
     parser.add_argument("--url", "-u", type=str, help="URL of Cybershuttle Gateway Server")
     parser.add_argument("--username", "-U", type=str, help="Username for Cybershuttle Gateway Server")
     parser.add_argument("--kernel_dir", "-k,", type=str, help="Path to store kernel specs locally")
+    parser.add_argument("--interval", type=float, default=5.0, help="Seconds between polls while the feed is down")
+    parser.add_argument("--heartbeat", type=float, default=15.0, help="Keepalive interval of the gateway's feed")
     args = parser.parse_args()
-    url = args.url
-    username = args.username
     kernel_dir = Path(os.path.expandvars(args.kernel_dir)).expanduser().absolute()
 
-    # run every 5 seconds
-    N = 5
-    schedule.every(N).seconds.do(sync_cybershuttle_kernels_with_localfs)
-
-    while True:
-        schedule.run_pending()
-        time.sleep(N / 2)
+    KernelSync(args.url, args.username, kernel_dir, args.interval, args.heartbeat).run()
@@ -1,74 +1,225 @@
+import asyncio
+import random
+import signal
 import urllib.parse
+import weakref
 from logging import Logger
 from subprocess import PIPE, Popen
 from typing import Any
 
+import httpx
 import msgpack
-import requests
+
+from cybershuttle_provisioners.tracing import Tracer, current_span
+
+try:
+    import h2  # noqa: F401 - enables HTTP/2 in httpx
+
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+RETRY_STATUS = [502, 503, 504]
+
+
+def terminates(signum: int) -> bool:
+    # a repeated SIGTERM/SIGKILL is harmless, a repeated SIGINT or SIGUSR1 (restart) is not
+    return signum in [signal.SIGTERM, signal.SIGKILL]
+
+
+# one pooled client per gateway and event loop, shared by all kernels of this server
+# (dropped with their loop, whose id could be reused by a later loop)
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[str, httpx.AsyncClient]]" = weakref.WeakKeyDictionary()
+
+
+def get_client(url: str) -> httpx.AsyncClient:
+    clients = _clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(url)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            base_url=url,
+            http2=HTTP2,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=8, keepalive_expiry=60.0),
+        )
+        clients[url] = client
+    return client
 
 
 class CybershuttleAPI:
 
-    def __init__(self, url: str, logger: Logger, username: str):
+    def __init__(
+        self,
+        url: str,
+        logger: Logger,
+        username: str,
+        timeout: float = 30.0,
+        connect_timeout: float = 5.0,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+    ):
         super().__init__()
         self.url = url
         self.log = logger
         self.username = username
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.warnings: dict[str, str] = {}
+        self.tracer: Tracer | None = None
 
-    def poll_job_status(self, job_id: int) -> tuple[str, str, str, list[tuple[int, int]]]:
+    async def request(self, method: str, path: str, idempotent: bool = True, **kwargs: Any) -> httpx.Response:
+        """
+        Send a request to the gateway over the pooled client, retrying with jittered backoff.
+
+        Failures to connect are always retried, since the request never
+        reached the gateway. Timeouts, dropped connections and 502/503/504
+        are only retried for idempotent requests. A 429 means the gateway did
+        not admit the request (and did nothing), so it is always retried,
+        after the Retry-After it gives.
+
+        Within a traced task, the request is a span whose context goes to the
+        gateway in a traceparent header.
+
+        """
+        parent = current_span.get()
+        if self.tracer is None or not self.tracer.enabled or parent is None:
+            return await self._request(method, path, idempotent, **kwargs)
+        span = self.tracer.start(f"{method} {path}", parent)
+        kwargs["headers"] = dict(kwargs.get("headers", {}), traceparent=span.traceparent)
+        try:
+            r = await self._request(method, path, idempotent, **kwargs)
+            span.set(status_code=r.status_code)
+            return r
+        except BaseException as e:
+            span.fail(f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            span.end()
+
+    async def _request(self, method: str, path: str, idempotent: bool, **kwargs: Any) -> httpx.Response:
+        client = get_client(self.url)
+        attempt = 0
+        while True:
+            try:
+                r = await client.request(method, path, params={"user": self.username}, timeout=self.timeout, **kwargs)
+                if r.status_code == 429 and attempt < self.max_retries:
+                    delay = float(r.headers.get("Retry-After", self.backoff * 2**attempt))
+                    attempt += 1
+                    self.log.warning(f"[{attempt}/{self.max_retries}] {method} {path} not admitted ({r.text.strip()}). retrying in {delay:.0f}s")
+                    await asyncio.sleep(delay)
+                    continue
+                if not idempotent or r.status_code not in RETRY_STATUS or attempt >= self.max_retries:
+                    return r
+                reason = f"HTTP {r.status_code}"
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                reason = repr(e)
+            except (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError) as e:
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+                reason = repr(e)
+            # full jitter: sleep a random fraction of the exponential backoff
+            delay = random.uniform(0, self.backoff * 2**attempt)
+            attempt += 1
+            self.log.warning(f"[{attempt}/{self.max_retries}] {method} {path} failed ({reason}). retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+    def _warn(self, job_id: int | str, data: dict[str, Any]) -> None:
+        # gateway warnings (e.g. about idle culling) are repeated on every poll, so log each once
+        warning = data.get("warning", "")
+        if warning and self.warnings.get(str(job_id)) != warning:
+            self.log.warning(f"kernel={job_id}: {warning}")
+        self.warnings[str(job_id)] = warning
+
+    async def poll_job_status(self, job_id: int) -> tuple[str, str, str, list[tuple[int, int]]]:
         """
         Checks if job is still running.
 
         Return:
 
-        job_state (str) one of ["PENDING", "RUNNING", "UNKNOWN", "ERROR"]
+        job_state (str) one of ["PENDING", "RUNNING", "READY", "UNKNOWN", "ERROR"]
         exec_node (str) url of worker node that job is running on
 
+        READY is RUNNING with the kernel listening on its ports (reported by the job itself).
+
         """
-        r = requests.get(
-            f"{self.url}/status/{job_id}",
-            params={"user": self.username},
-        )
+        r = await self.request("GET", f"/status/{job_id}")
         state = "UNKNOWN"
         node = eta = ""
         ports = []
         if r.status_code == 200:
             data = r.json()
             state, node, eta = data["state"], data["node"], data["eta"]
+            self._warn(job_id, data)
             if "ports" in data:
                 ports = data["ports"]
 
         return state, node, eta, ports
 
-    def signal_job(self, job_id: int, signum: int) -> bool:
+    async def poll_jobs_status(self, job_ids: list[int]) -> dict[str, tuple[str, str, str, list[tuple[int, int]]]]:
+        """
+        Checks the state of many jobs in one request.
+
+        Return:
+
+        {job_id (str): (job_state, exec_node, eta, ports)} for each requested job.
+        Jobs unknown to the gateway are reported as "UNKNOWN".
+
+        """
+        job_ids = [str(j) for j in job_ids]
+        r = await self.request("POST", "/jobs/status", content=msgpack.dumps(dict(job_ids=job_ids)))
+        results = {job_id: ("UNKNOWN", "", "", []) for job_id in job_ids}
+        if r.status_code == 200:
+            for job_id, data in r.json().items():
+                if "error" not in data:
+                    self._warn(job_id, data)
+                    results[job_id] = (data["state"], data["node"], data["eta"], data.get("ports", []))
+        return results
+
+    async def signal_job(self, job_id: int, signum: int) -> bool:
         """
         Issue signal to a running job.
 
         """
-        r = requests.post(
-            f"{self.url}/signal/{job_id}",
-            data=msgpack.dumps(dict(signum=signum)),
-            params={"user": self.username},
-        )
+        r = await self.request("POST", f"/signal/{job_id}", idempotent=terminates(signum), content=msgpack.dumps(dict(signum=signum)))
         return r.status_code == 200
 
-    def launch_job(self, job_config: dict[str, Any]) -> tuple[int, list[tuple[int,int]]]:
+    async def signal_jobs(self, job_ids: list[int], signum: int) -> dict[str, bool]:
+        """
+        Issue a signal to many jobs in one request.
+
+        Return:
+
+        {job_id (str): success (bool)} for each requested job.
+        Jobs unknown to the gateway are reported as False.
+
+        """
+        job_ids = [str(j) for j in job_ids]
+        r = await self.request("POST", "/jobs/signal", idempotent=terminates(signum), content=msgpack.dumps(dict(job_ids=job_ids, signum=signum)))
+        results = {job_id: False for job_id in job_ids}
+        if r.status_code == 200:
+            for job_id, data in r.json().items():
+                results[job_id] = data.get("success", False)
+        return results
+
+    async def launch_job(self, job_config: dict[str, Any]) -> tuple[int, list[tuple[int, int]]]:
         """
         Launch a new job and return its ID.
 
         """
         self.log.warn(job_config)
-        r = requests.post(
-            f"{self.url}/provision",
-            data=msgpack.dumps(job_config),
-            params={"user": self.username},
-        )
+        # not idempotent: a retried provision could submit a second job
+        r = await self.request("POST", "/provision", idempotent=False, content=msgpack.dumps(job_config))
         if r.status_code == 200:
             data: dict = r.json()  # type: ignore
+            if data.get("placement") is not None:
+                placement = {k: v for k, v in data["placement"].items() if k != "estimates"}
+                self.log.info(f"job {data['job_id']} placed by the gateway: {placement}")
             return data["job_id"], data["ports"]
         raise RuntimeError()
 
-    def start_forwarding(
+    async def start_forwarding(
         self,
         job_id: int,
     ) -> Popen[bytes]:
@@ -77,10 +228,7 @@ class CybershuttleAPI:
 
         """
 
-        r = requests.get(
-            f"{self.url}/info/{job_id}",
-            params={"user": self.username},
-        )
+        r = await self.request("GET", f"/info/{job_id}")
         assert r.status_code == 200
 
         host = urllib.parse.urlparse(self.url).netloc
@@ -1,7 +1,10 @@
+import asyncio
+import os
 import re
+import signal
 from logging import Logger
-from subprocess import PIPE, Popen, TimeoutExpired, check_output
-from typing import Any
+from subprocess import DEVNULL, PIPE, Popen, TimeoutExpired, check_output
+from typing import Any, Callable, Optional
 
 
 class SlurmAPI:
@@ -24,10 +27,7 @@ class SlurmAPI:
 
         # poll for job state
         self.log.info(f"requesting job state: {job_id}")
-        prefix = self.ssh_prefix.copy()
-        if len(prefix) > 0:
-            prefix.append("-T")
-        poll_command = prefix + ["bash", "-c", f"\"squeue -h -j {job_id} -o '%T %B %S'\""]
+        poll_command = self.poll_command(job_id)
         self.log.debug(f"poll command: {' '.join(poll_command)}")
         state = "UNKNOWN"
         node = eta = stdout = ""
@@ -43,13 +43,42 @@ class SlurmAPI:
 
         return state, node, eta
 
+    def remote_command(self, command: str) -> str:
+        """
+        Quote a command for bash -c, so that it survives the extra shell on the far end of SSH
+
+        """
+        return f'"{command}"' if len(self.ssh_prefix) > 0 else command
+
+    def poll_command(self, job_id: int) -> list[str]:
+        prefix = self.ssh_prefix.copy()
+        if len(prefix) > 0:
+            prefix.append("-T")
+        return prefix + ["bash", "-c", self.remote_command(f"squeue -h -j {job_id} -o '%T %B %S'")]
+
+    def signal_command(self, job_id: int, signum: int) -> list[str]:
+        return self.ssh_prefix + ["bash", "-c", self.remote_command(f"scancel -b -s {signum} {job_id}")]
+
+    def launch_command(self) -> list[str]:
+        return self.ssh_prefix + ["bash", "-c", "sbatch --parsable"]
+
+    def parse_job_id(self, stdout: str) -> int:
+        """
+        Get the SLURM job id from the output of sbatch
+
+        """
+        job_id = re.search(r"(\d+)", stdout, re.IGNORECASE)
+        if job_id is None:
+            raise RuntimeError("Cannot find SLURM Job ID in stdout")
+        return int(job_id.group(1))
+
     def signal_job(self, job_id: int, signum: int) -> bool:
         """
         Issue signal to a running job.
 
         """
 
-        signal_cmd = self.ssh_prefix + ["bash", "-c", f"\"scancel -b -s {signum} {job_id}\""]
+        signal_cmd = self.signal_command(job_id, signum)
         signal_cmd_str = " ".join(signal_cmd)
         self.log.info(f"signaling kernel job ({job_id}): {signal_cmd_str}")
         status = None
@@ -69,7 +98,7 @@ class SlurmAPI:
         """
 
         # build spawn_cmd
-        spawn_cmd = self.ssh_prefix + ["bash", "-c", "sbatch --parsable"]
+        spawn_cmd = self.launch_command()
         spawn_cmd_str = " ".join(spawn_cmd)
         self.log.info(f"Launching Kernel: {spawn_cmd_str}")
 
@@ -86,10 +115,7 @@ class SlurmAPI:
         self.log.info(f"Kernel Launched: {stdout}")
 
         # get SLURM job id from stdout
-        job_id = re.search(r"(\d+)", stdout, re.IGNORECASE)
-        if job_id is None:
-            raise RuntimeError("Cannot find SLURM Job ID in stdout")
-        job_id = int(job_id.group(1))
+        job_id = self.parse_job_id(stdout)
         self.log.debug(f"SLURM Job ID: {job_id}")
 
         return job_id
@@ -153,3 +179,194 @@ class SlurmAPI:
         process = Popen(ssh_command, stdout=PIPE, stderr=PIPE)
         self.log.info(f"SSH tunnel is now active")
         return process
+
+
+class AsyncSlurmAPI(SlurmAPI):
+    """
+    SlurmAPI whose squeue/scancel/sbatch calls run as asyncio subprocesses
+
+    The event loop keeps serving other kernels while a command runs. Each
+    command is killed if it outlives its timeout or if the awaiting task is
+    cancelled, and its output is logged line by line as it arrives.
+
+    """
+
+    def __init__(self, logger: Logger, ssh_prefix: list[str] = [], timeout: float = 30.0, launch_timeout: float = 60.0):
+        super().__init__(logger, ssh_prefix)
+        self.timeout = timeout
+        self.launch_timeout = launch_timeout
+
+    async def run(
+        self,
+        cmd: list[str],
+        input: Optional[bytes] = None,
+        timeout: Optional[float] = None,
+        on_line: Optional[Callable[[str], None]] = None,
+    ) -> tuple[int, str, str]:
+        """
+        Run a command without blocking the event loop.
+
+        Args:
+            cmd (list[str]): command to run
+            input (bytes): data written to the command's stdin, if any
+            timeout (float): seconds before the command is killed (default: self.timeout)
+            on_line (callable): called with each line of stdout as it arrives
+
+        Return:
+
+        returncode (int), stdout (str), stderr (str)
+
+        """
+        cmd_str = " ".join(cmd)
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=PIPE if input is not None else DEVNULL,
+            stdout=PIPE,
+            stderr=PIPE,
+            # own process group, so that children (e.g. the remote shell's ssh) go down with it
+            start_new_session=True,
+        )
+
+        async def communicate() -> tuple[str, str]:
+            assert proc.stdout is not None and proc.stderr is not None
+            if input is not None:
+                assert proc.stdin is not None
+                proc.stdin.write(input)
+                await proc.stdin.drain()
+                proc.stdin.close()
+            stderr_task = asyncio.ensure_future(proc.stderr.read())
+            lines = []
+            async for raw in proc.stdout:
+                line = raw.decode().rstrip("\n")
+                lines.append(line)
+                if on_line is not None:
+                    on_line(line)
+            stderr = await stderr_task
+            await proc.wait()
+            return "\n".join(lines).strip(), stderr.decode().strip()
+
+        try:
+            stdout, stderr = await asyncio.wait_for(communicate(), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            raise RuntimeError(f"SSH command timed out:\n{cmd_str}\n")
+        finally:
+            # on timeout or cancellation, do not leave the command running
+            if proc.returncode is None:
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                await asyncio.shield(proc.wait())
+        assert proc.returncode is not None
+        return proc.returncode, stdout, stderr
+
+    async def poll_job_status(self, job_id: int) -> tuple[str, str, str]:  # type: ignore[override]
+        """
+        Checks if SLURM job is still running.
+
+        Return:
+
+        job_state (str) one of ["PENDING", "RUNNING", "UNKNOWN", "ERROR"]
+        exec_node (str) url of worker node that job is running on
+
+        """
+        self.log.info(f"requesting job state: {job_id}")
+        poll_command = self.poll_command(job_id)
+        self.log.debug(f"poll command: {' '.join(poll_command)}")
+        state = "UNKNOWN"
+        node = eta = stdout = ""
+        try:
+            returncode, stdout, stderr = await self.run(poll_command)
+            if returncode != 0:
+                raise RuntimeError(f"squeue returned error code {returncode}:\n{stderr}\n")
+            self.log.info(f"got job state: {stdout}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            state = "ERROR"
+            self.log.error(f"error in poll command: {e}")
+
+        if len(splits := stdout.split(" ")) == 3:
+            state, node, eta = splits
+
+        return state, node, eta
+
+    async def poll_jobs_status(self, job_ids: list[int | str]) -> dict[str, tuple[str, str, str]]:
+        """
+        Checks the state of many SLURM jobs with a single squeue.
+
+        Return:
+
+        {job_id (str): (job_state, exec_node, eta)} for each requested job.
+        Jobs no longer known to SLURM are reported as "UNKNOWN", and all jobs
+        are reported as "ERROR" if squeue could not be run.
+
+        """
+        job_ids = [str(j) for j in job_ids]
+        results = {job_id: ("UNKNOWN", "", "") for job_id in job_ids}
+        if not job_ids:
+            return results
+        prefix = self.ssh_prefix.copy()
+        if len(prefix) > 0:
+            prefix.append("-T")
+        poll_command = prefix + ["bash", "-c", self.remote_command(f"squeue -h -j {','.join(job_ids)} -o '%i %T %B %S'")]
+        self.log.debug(f"poll command: {' '.join(poll_command)}")
+        try:
+            returncode, stdout, stderr = await self.run(poll_command)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.log.error(f"error in poll command: {e}")
+            return {job_id: ("ERROR", "", "") for job_id in job_ids}
+        # squeue fails outright when given only ids it no longer knows
+        if returncode != 0 and "Invalid job id" not in stderr:
+            self.log.error(f"squeue returned error code {returncode}:\n{stderr}\n")
+            return {job_id: ("ERROR", "", "") for job_id in job_ids}
+        for line in stdout.splitlines():
+            if len(splits := line.split(" ")) == 4 and splits[0] in results:
+                job_id, state, node, eta = splits
+                results[job_id] = (state, node, eta)
+        return results
+
+    async def signal_job(self, job_id: int, signum: int) -> bool:  # type: ignore[override]
+        """
+        Issue signal to a running job.
+
+        """
+        signal_cmd = self.signal_command(job_id, signum)
+        self.log.info(f"signaling kernel job ({job_id}): {' '.join(signal_cmd)}")
+        try:
+            returncode, stdout, stderr = await self.run(signal_cmd)
+            if returncode != 0:
+                raise RuntimeError(f"scancel returned error code {returncode}:\n{stderr}\n")
+            self.log.info(f"kernel job signaled ({job_id}) - {stdout}")
+            return True
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.log.error(f"error when signaling kernel job: {e}")
+            return False
+
+    async def launch_job(self, job_script: str) -> int:  # type: ignore[override]
+        """
+        Launch a SLURM job and return its ID.
+
+        """
+        spawn_cmd = self.launch_command()
+        spawn_cmd_str = " ".join(spawn_cmd)
+        self.log.info(f"Launching Kernel: {spawn_cmd_str}")
+
+        returncode, stdout, stderr = await self.run(
+            spawn_cmd,
+            input=job_script.encode(),
+            timeout=self.launch_timeout,
+            on_line=lambda line: self.log.debug(f"sbatch: {line}"),
+        )
+        if not returncode == 0:
+            raise RuntimeError(f"SSH command returned error code {returncode}:\n{stderr}\n")
+        self.log.info(f"Kernel Launched: {stdout}")
+
+        job_id = self.parse_job_id(stdout)
+        self.log.debug(f"SLURM Job ID: {job_id}")
+
+        return job_id
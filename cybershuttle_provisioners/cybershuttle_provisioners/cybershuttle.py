@@ -1,5 +1,6 @@
 import asyncio
 import signal
+import time
 import urllib.parse
 from typing import TYPE_CHECKING, Any, Dict, List, Literal, Optional
 
@@ -10,6 +11,9 @@ from jupyter_client.provisioning.provisioner_base import KernelProvisionerBase
 
 from cybershuttle_provisioners.api import CybershuttleAPI
 from cybershuttle_provisioners.config import TEMPLATE_DIR
+from cybershuttle_provisioners.poller import JobPoller
+from cybershuttle_provisioners.polling import PollingPolicy
+from cybershuttle_provisioners.tracing import Span, Tracer, current_span
 
 localhost = "127.0.0.1"
 
@@ -31,9 +35,18 @@ class CybershuttleProvisioner(KernelProvisionerBase):
     awaiting_shutdown = False
     exec_node = None
     proc_portfwd = None
-    num_retries = 0
-
-    max_retries: int = 100
+    missing_since: Optional[float] = None
+    restarting = False
+    gave_up = False
+    poll_policy: PollingPolicy
+    poller: JobPoller
+    last_poll: Optional[int] = None
+    tracer: Tracer
+    # from launch until the job is first seen running
+    launch_span: Optional[Span] = None
+
+    # seconds a job may be missing from squeue (e.g. right after sbatch) before it is considered gone
+    missing_timeout: float = 100.0
 
     gateway_url: str = traitlets.Unicode(config=True)  # type: ignore
     cluster: str = traitlets.Unicode(config=True)  # type: ignore
@@ -43,6 +56,14 @@ class CybershuttleProvisioner(KernelProvisionerBase):
     workdir: str = traitlets.Unicode(config=True)  # type: ignore
     exec_path: str = traitlets.Unicode(config=True, default_value="")  # type: ignore
     user_scripts: str = traitlets.Unicode(config=True, default_value="")  # type: ignore
+    fast_restart: bool = traitlets.Bool(config=True, default_value=True)  # type: ignore
+    # let the gateway pick the partition/qos that would start soonest
+    fastest_start: bool = traitlets.Bool(config=True, default_value=False)  # type: ignore
+    # snapshot to load into the kernel once it starts (path, absolute or relative to its snapshot dir)
+    restore: str = traitlets.Unicode(config=True, default_value="")  # type: ignore
+    # export launch traces (OTLP/JSON) to a file and/or an OTLP/HTTP collector
+    trace_file: str = traitlets.Unicode(config=True, default_value="")  # type: ignore
+    trace_endpoint: str = traitlets.Unicode(config=True, default_value="")  # type: ignore
     template_dir = TEMPLATE_DIR
     fwd_ports = ["shell_port", "iopub_port", "stdin_port", "hb_port", "control_port"]
     cached_ports = None
@@ -53,7 +74,10 @@ class CybershuttleProvisioner(KernelProvisionerBase):
         self.awaiting_shutdown = False
         self.exec_node = None
         self.proc_portfwd = None
-        self.num_retries = 0
+        self.missing_since = None
+        self.poll_policy = PollingPolicy()
+        self.last_poll = None
+        self.gave_up = False
 
     @property
     def has_process(self) -> bool:
@@ -77,15 +101,58 @@ class CybershuttleProvisioner(KernelProvisionerBase):
         if not self.has_process:
             return 0
 
+        # the kernel process is being respawned inside the job, so it is gone
+        if self.restarting:
+            return 0
+
+        # give up (and cancel the job) if it never started within the polling budget
+        if self.poll_policy.exhausted:
+            await self.give_up()
+            return 1
+
+        # skip the remote call until the polling policy says it is due
+        if not self.poll_policy.due():
+            return self.last_poll
+
+        self.last_poll = await self._poll_job()
+        return self.last_poll
+
+    async def give_up(self) -> None:
+        """
+        Cancel a job that did not start in time, so that it does not run later with no kernel attached
+
+        """
+        if self.gave_up:
+            return
+        self.gave_up = True
+        self.log.warning(f"job {self.job_id} did not start within {self.poll_policy.max_wait:.0f}s, cancelling it")
+        assert self.job_id is not None
+        await self.api.signal_job(self.job_id, signal.SIGTERM)
+
+    async def _poll_job(self) -> Optional[int]:
+        """
+        Poll the job state and map it to a poll() result.
+
+        """
         # poll for job state
         assert self.job_id is not None
-        state, node, eta, ports = self.api.poll_job_status(self.job_id)
+        state, node, eta, ports = await self.poller.poll_job_status(self.job_id)
+        if state == "READY":
+            # the job reported its kernel listening, and the gateway forwards its ports
+            self.log.debug(f"job {self.job_id} is READY")
+            state = "RUNNING"
+        self.poll_policy.observe(state, eta)
 
         # case 1 - running state
         if state == "RUNNING":
             self.job_state = "RUNNING"
+            self.missing_since = None
             self.exec_node = node
             self.log.debug(f"job {self.job_id} is RUNNING. NODE={self.exec_node}")
+            if self.launch_span is not None:
+                self.launch_span.set(node=node)
+                self.launch_span.end()
+                self.launch_span = None
             # at this point both exec_node and connection_info must exist
             assert self.exec_node is not None
             assert self.connection_info is not None
@@ -94,7 +161,7 @@ class CybershuttleProvisioner(KernelProvisionerBase):
             # if self.proc_portfwd is None:
             # start port forwarding process
             # assert self.exec_node is not None
-            # self.proc_portfwd = self.api.start_forwarding(job_id=self.job_id)
+            # self.proc_portfwd = await self.api.start_forwarding(job_id=self.job_id)
             # self.log.info(f"Started forwarding from gateway server to localhost")
 
             return None
@@ -102,6 +169,7 @@ class CybershuttleProvisioner(KernelProvisionerBase):
         # case 2 - pending state
         if state in ["PENDING", "CONFIGURING"]:
             self.job_state = "PENDING"
+            self.missing_since = None
             self.log.debug(f"job {self.job_id} is PENDING. NODE={self.exec_node}, ETA={eta}")
             return None
 
@@ -115,19 +183,18 @@ class CybershuttleProvisioner(KernelProvisionerBase):
             return 0
 
         # fallback - unknown state
-        # give some time for job to show up in squeue
-        if self.num_retries < self.max_retries:
-            self.num_retries += 1
-            self.log.warn(
-                f"[{self.num_retries}/{self.max_retries}] Job {self.job_id} not in squeue. using state=PENDING"
-            )
+        # give some time for job to show up in squeue (counted in seconds, since polls back off)
+        now = time.monotonic()
+        if self.missing_since is None:
+            self.missing_since = now
+        missing = now - self.missing_since
+        if missing < self.missing_timeout:
+            self.log.warn(f"[{missing:.0f}/{self.missing_timeout:.0f}s] Job {self.job_id} not in squeue. using state=PENDING")
             self.job_state = "PENDING"
             return None
         else:
-            self.log.warn(
-                f"[{self.num_retries}/{self.max_retries}] Job {self.job_id} not in squeue. using state=UNKNOWN"
-            )
-            self.num_retries = 0
+            self.log.warn(f"[{missing:.0f}/{self.missing_timeout:.0f}s] Job {self.job_id} not in squeue. using state=UNKNOWN")
+            self.missing_since = None
             self.job_state = "UNKNOWN"
             return 1
 
@@ -143,12 +210,12 @@ class CybershuttleProvisioner(KernelProvisionerBase):
         ret: Optional[int] = 0
         if self.awaiting_shutdown:
             self.log.warning(f"cleanup(): waiting for job {self.job_id} to terminate...")
-            # Use busy loop at 1 second intervals, polling until the process is
+            # Poll at intervals set by the polling policy until the process is
             # not alive.  If we find the process is no longer alive, complete
             # its cleanup via the blocking wait().  Callers are responsible for
             # issuing calls to wait() using a timeout (see kill()).
-            while {ret := await self.poll()} is None:
-                await asyncio.sleep(1.0)
+            while (ret := await self.poll()) is None:
+                await self.poll_policy.sleep()
             assert ret is not None
 
         # allow has_process to now return False
@@ -169,7 +236,7 @@ class CybershuttleProvisioner(KernelProvisionerBase):
             await self.poll()
         else:
             assert self.job_id is not None
-            self.api.signal_job(self.job_id, signum)
+            await self.api.signal_job(self.job_id, signum)
 
     async def kill(self, restart: bool = False) -> None:
         """
@@ -181,6 +248,8 @@ class CybershuttleProvisioner(KernelProvisionerBase):
 
         restart is True if this operation will precede a subsequent launch_kernel request.
         """
+        if restart and await self._fast_restart():
+            return
         assert self.awaiting_shutdown == True
         if self.job_state == "RUNNING":
             await self.send_signal(signal.SIGKILL)
@@ -196,10 +265,30 @@ class CybershuttleProvisioner(KernelProvisionerBase):
 
         restart is True if this operation precedes a start launch_kernel request.
         """
+        if restart and await self._fast_restart():
+            return
         assert self.awaiting_shutdown == True
         if self.job_state == "RUNNING":
             await self.send_signal(signal.SIGTERM)
 
+    async def _fast_restart(self) -> bool:
+        """
+        Ask the job's supervisor to respawn the kernel inside the current allocation.
+
+        The job script restarts the kernel on SIGUSR1 with the same connection
+        file, so ports and tunnels stay as they are. Returns True if a restart
+        was requested, in which case the job must not be signalled or relaunched.
+        """
+        if self.restarting:
+            return True
+        if not self.fast_restart or self.job_state != "RUNNING":
+            return False
+        assert self.job_id is not None
+        self.restarting = await self.api.signal_job(self.job_id, signal.SIGUSR1)
+        if self.restarting:
+            self.log.info(f"restarting kernel inside job {self.job_id}")
+        return self.restarting
+
     async def launch_kernel(self, cmd: List[str], **kwargs: Any) -> KernelConnectionInfo:
         """
         Launch the kernel process and return its connection information.
@@ -208,6 +297,14 @@ class CybershuttleProvisioner(KernelProvisionerBase):
         kernel manager's start kernel sequence.
         """
 
+        # respawned by the job's supervisor, with the same connection info
+        if self.restarting:
+            self.restarting = False
+            self.awaiting_shutdown = False
+            self.last_poll = None
+            self.poll_policy.reset()
+            return self.connection_info
+
         # reset state variables
         self._reset_state()
         self.reset_connection_info()
@@ -222,9 +319,22 @@ class CybershuttleProvisioner(KernelProvisionerBase):
             cluster=self.cluster,
             transport=self.transport,
             spec=self.spec,
+            fastest_start=self.fastest_start,
+            restore=self.restore,
             connection_info=self.connection_info,
         )
-        self.job_id, ports = self.api.launch_job(job_config)
+        self.launch_span = self.tracer.start("kernel start", username=self.username, cluster=self.cluster)
+        token = current_span.set(self.launch_span)
+        try:
+            self.job_id, ports = await self.api.launch_job(job_config)
+        except BaseException as e:
+            self.launch_span.fail(f"{type(e).__name__}: {e}")
+            self.launch_span.end()
+            raise
+        finally:
+            current_span.reset(token)
+        self.launch_span.set(job_id=self.job_id)
+        self.poller.subscribe(self.job_id)
         self.update_connection_info(self.gateway_url, ports, **kwargs)
 
         return self.connection_info
@@ -238,6 +348,12 @@ class CybershuttleProvisioner(KernelProvisionerBase):
 
         restart is True if this operation precedes a start launch_kernel request.
         """
+        # the job and its ports stay in use by the respawned kernel
+        if self.restarting:
+            return
+        if self.job_id is not None:
+            self.log.info(f"poll stats for job {self.job_id}: {self.poll_policy.stats}")
+            self.poller.unsubscribe(self.job_id)
         if not restart:
             # provisioner is about to be destroyed, return cached portsa
             assert self.cached_ports is not None
@@ -258,6 +374,11 @@ class CybershuttleProvisioner(KernelProvisionerBase):
         may need to perform other operations in preparation for a kernel's shutdown.
         """
         self.awaiting_shutdown = True
+        if self.has_process:
+            if restart:
+                await self._fast_restart()
+            # look for the job to end right away, then back off
+            self.poll_policy.reset()
 
     async def pre_launch(self, **kwargs: Any) -> Dict[str, Any]:
         """
@@ -295,6 +416,9 @@ class CybershuttleProvisioner(KernelProvisionerBase):
 
         # create provisioner api
         self.api = CybershuttleAPI(logger=self.log, url=self.gateway_url, username=self.username)
+        self.tracer = Tracer.instance(self.log, "cybershuttle-provisioner", self.trace_file, self.trace_endpoint)
+        self.api.tracer = self.tracer
+        self.poller = JobPoller.instance(self.api)
 
         # define cached ports to use during provisioner lifecycle
         # TODO move this port selection logic to gateway API.
@@ -320,10 +444,14 @@ class CybershuttleProvisioner(KernelProvisionerBase):
         # wait for the kernel to be started
         assert self.job_id is not None
         while True:
-            state, node, eta, ports = self.api.poll_job_status(self.job_id)
+            state, node, eta, ports = await self.poller.poll_job_status(self.job_id)
+            interval = self.poll_policy.observe(state, eta)
             if state == "PENDING":
-                self.log.info(f"kernel={self.job_id} waiting to start...")
-                await asyncio.sleep(5.0)
+                if self.poll_policy.exhausted:
+                    await self.give_up()
+                    raise RuntimeError(f"kernel={self.job_id} did not start within {self.poll_policy.max_wait:.0f}s")
+                self.log.info(f"kernel={self.job_id} waiting to start (eta={eta}). checking again in {interval:.1f}s...")
+                await asyncio.sleep(interval)
             else:
                 break
         self.log.info(f"kernel={self.job_id} started.")
@@ -57,3 +57,13 @@ class FileAlreadyExists(Exception):
 
 class RenderTemplateError(Exception):
     pass
+
+
+class TemplateStepFailed(Exception):
+
+    def __init__(self, step: int, line: str, returncode: int, output: str = ""):
+        super().__init__(f"Line {step + 1} failed with exit code {returncode}: {line}")
+        self.step = step
+        self.line = line
+        self.returncode = returncode
+        self.output = output
@@ -0,0 +1,242 @@
+"""
+Install a kernel template on many clusters at once
+
+    python -m cybershuttle_provisioners.install <template> --targets targets.json [--values values.json]
+
+targets.json lists the login nodes to install to:
+
+    [
+        {"loginnode": "login.cluster-a.edu", "user": "alice", "slurm_parameter": "account=hpc,time=01:00:00"},
+        {"loginnode": "login.cluster-b.edu", "user": "alice", "proxyjump": "gw.edu", "values": {"2": "/scratch"}}
+    ]
+
+The kernel connects to the proxyjump as `user` too, so a proxyjump is a host
+(a user@ prefix is left out of the kernel spec).
+
+values.json gives the INPUT_n variables of the template ({"1": "...", "2": "..."}),
+which each target may override. Templates run in batch mode, on up to --workers
+targets at a time, and one slurm-remote kernel spec is written per target.
+Lines that already succeeded unchanged on a target are skipped unless --force is given.
+
+"""
+
+import argparse
+import json
+import os
+import re
+import shlex
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, NamedTuple
+
+from cybershuttle_provisioners.templating import Color, ScriptTemplate
+
+DEFAULT_KERNEL_DIR = "~/.local/share/jupyter/kernels"
+
+
+class Target(NamedTuple):
+    loginnode: str
+    user: str
+    proxyjump: str = ""
+    slurm_parameter: str = ""
+    lmod_modules: list[str] = []
+    values: dict[int, str] = {}
+
+
+def load_targets(path: Path) -> list[Target]:
+    with open(path) as f:
+        entries = json.load(f)
+    targets = []
+    for entry in entries:
+        values = {int(k): str(v) for k, v in entry.pop("values", {}).items()}
+        target = Target(values=values, **entry)
+        jump_user = target.proxyjump.rpartition("@")[0]
+        if jump_user and jump_user != target.user:
+            raise ValueError(f"proxyjump {target.proxyjump} of {target.loginnode}: kernels connect to it as {target.user}")
+        targets.append(target)
+    return targets
+
+
+def parse_list(value: str) -> list[str]:
+    """
+    Read ARGV from a template: a JSON list, or a shell command line
+
+    """
+    try:
+        parsed = json.loads(value)
+        if isinstance(parsed, list):
+            return [str(v) for v in parsed]
+    except ValueError:
+        pass
+    return shlex.split(value)
+
+
+def parse_dict(value: str) -> dict[str, str]:
+    """
+    Read ENV or Slurm parameters: a JSON object, or "key=value,key=value"
+
+    """
+    try:
+        parsed = json.loads(value)
+        if isinstance(parsed, dict):
+            return {str(k): str(v) for k, v in parsed.items()}
+    except ValueError:
+        pass
+    return dict((k.strip(), v.strip()) for k, v in (item.split("=", 1) for item in value.split(",") if item.strip()))
+
+
+def jump_host(proxyjump: str) -> str:
+    """
+    The host of a proxyjump, without a user@ prefix (slurm-remote adds the username itself)
+
+    """
+    return proxyjump.rpartition("@")[2]
+
+
+def make_kernel_spec(specs: dict[str, str], target: Target) -> dict[str, Any]:
+    """
+    Build a slurm-remote kernel.json from the kernel spec returned by a template
+
+    """
+    return {
+        "argv": parse_list(specs.get("argv", "")),
+        "display_name": specs.get("displayname", f"{target.loginnode}"),
+        "env": parse_dict(specs.get("env", "")),
+        "language": specs.get("language", "python"),
+        "metadata": {
+            "kernel_provisioner": {
+                "config": {
+                    "loginnode": target.loginnode,
+                    "username": target.user,
+                    "proxyjump": jump_host(target.proxyjump),
+                    "sbatch_flags": parse_dict(target.slurm_parameter),
+                    "lmod_modules": target.lmod_modules,
+                },
+                "provisioner_name": "slurm-remote",
+            }
+        },
+    }
+
+
+def kernel_name(template: Path, target: Target) -> str:
+    return re.sub(r"[^a-zA-Z0-9._-]", "_", f"{template.stem}-{target.user}-{target.loginnode}")
+
+
+class Installer:
+    """
+    Run one template on many targets with a bounded pool of workers
+
+    """
+
+    def __init__(
+        self,
+        template: Path,
+        kernel_dir: Path,
+        values: dict[int, str] = {},
+        dry_run: bool = False,
+        verbose: bool = True,
+        force: bool = False,
+    ):
+        super().__init__()
+        self.template = template
+        self.kernel_dir = kernel_dir
+        self.values = values
+        self.dry_run = dry_run
+        self.force = force
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.done = 0
+
+    def echo(self, target: Target, line: str) -> None:
+        with self.lock:
+            print(f"{Color.F_Cyan}[{target.loginnode}]{Color.F_Default} {line}", flush=True)
+
+    def install(self, target: Target) -> dict[str, Any]:
+        echo = (lambda line: self.echo(target, line)) if self.verbose else (lambda line: None)
+        values = {**self.values, **target.values}
+        started = time.monotonic()
+        result: dict[str, Any] = dict(loginnode=target.loginnode, user=target.user)
+        try:
+            specs = ScriptTemplate(self.template).install(
+                target.loginnode, target.user, target.proxyjump, values, dry_run=self.dry_run, echo=echo, force=self.force
+            )
+            name = kernel_name(self.template, target)
+            spec_dir = self.kernel_dir / name
+            if not self.dry_run:
+                spec_dir.mkdir(parents=True, exist_ok=True)
+                with open(spec_dir / "kernel.json", "w") as f:
+                    json.dump(make_kernel_spec(specs, target), f, indent=2)
+            result.update(ok=True, kernel=name, path=str(spec_dir / "kernel.json"))
+        except Exception as e:
+            result.update(ok=False, error=f"{type(e).__name__}: {e}")
+            for attr in ["step", "line", "returncode", "output"]:
+                if hasattr(e, attr):
+                    result[attr] = getattr(e, attr)
+        result["elapsed_s"] = round(time.monotonic() - started, 2)
+        return result
+
+    def run(self, targets: list[Target], workers: int) -> list[dict[str, Any]]:
+        results = []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(self.install, target): target for target in targets}
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                self.done += 1
+                status = f"{Color.F_LightGreen}ok" if result["ok"] else f"{Color.F_LightRed}FAILED"
+                with self.lock:
+                    print(
+                        f"[{self.done}/{len(targets)}] {result['user']}@{result['loginnode']}: "
+                        f"{status}{Color.F_Default} ({result['elapsed_s']}s)",
+                        flush=True,
+                    )
+        return results
+
+
+def print_report(results: list[dict[str, Any]], elapsed: float) -> None:
+    failed = [r for r in results if not r["ok"]]
+    print(f"\nInstalled to {len(results) - len(failed)}/{len(results)} targets in {elapsed:.1f}s")
+    for r in sorted(results, key=lambda r: r["elapsed_s"], reverse=True):
+        detail = r.get("path", "") if r["ok"] else r["error"]
+        print(f"  {r['elapsed_s']:>8.2f}s  {r['user']}@{r['loginnode']}  {detail}")
+    for r in failed:
+        if "output" in r and r["output"]:
+            print(f"\n{Color.F_LightRed}{r['user']}@{r['loginnode']} (line {r['step'] + 1}: {r['line']}){Color.F_Default}")
+            print(r["output"])
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Install a kernel template on many clusters at once")
+    parser.add_argument("template", type=Path, help="Template name (in the template directory) or path")
+    parser.add_argument("--targets", type=Path, required=True, help="JSON list of targets")
+    parser.add_argument("--values", type=Path, default=None, help="JSON object of INPUT_n values")
+    parser.add_argument("--workers", type=int, default=8, help="Number of targets to install to at a time")
+    parser.add_argument("--kernel_dir", type=str, default=DEFAULT_KERNEL_DIR, help="Where to write kernel specs")
+    parser.add_argument("--report", type=Path, default=None, help="Write a JSON report here")
+    parser.add_argument("--dry_run", action="store_true", help="Print the lines that would run or be skipped, and write no kernel specs")
+    parser.add_argument("--force", action="store_true", help="Run every line, even those that already succeeded unchanged")
+    parser.add_argument("--quiet", action="store_true", help="Only show per-target progress, not template output")
+    args = parser.parse_args()
+
+    if "SSH_AUTH_SOCK" not in os.environ:
+        sys.exit("SSH Agent is not running. Did you try running eval $(ssh-agent)?")
+
+    values = {}
+    if args.values is not None:
+        with open(args.values) as f:
+            values = {int(k): str(v) for k, v in json.load(f).items()}
+    targets = load_targets(args.targets)
+
+    installer = Installer(args.template, Path(os.path.expanduser(args.kernel_dir)), values, args.dry_run, not args.quiet, args.force)
+    started = time.monotonic()
+    results = installer.run(targets, max(1, args.workers))
+    print_report(results, time.monotonic() - started)
+
+    if args.report is not None:
+        with open(args.report, "w") as f:
+            json.dump(results, f, indent=2)
+    sys.exit(0 if all(r["ok"] for r in results) else 1)
@@ -0,0 +1,104 @@
+import asyncio
+import time
+import weakref
+from logging import Logger
+
+from cybershuttle_provisioners.api import CybershuttleAPI
+
+JobStatus = tuple[str, str, str, list[tuple[int, int]]]
+
+
+class JobPoller:
+    """
+    Shared job status poller for all kernels of one (gateway, user) in this process
+
+    Provisioners ask for the status of their job; requests that arrive within
+    a short window are answered together by a single /jobs/status call
+    covering every subscribed job, and the only subscribed job is polled right
+    away. Results are kept for one tick, so a provisioner asking right after
+    another one's request is answered without a request.
+
+    """
+
+    # per event loop, and dropped with it (its id could be reused by a later loop); pollers
+    # hold no reference to their loop once idle, so that it can be collected
+    _instances: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[tuple[str, str], JobPoller]]" = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def instance(cls, api: CybershuttleAPI) -> "JobPoller":
+        instances = cls._instances.setdefault(asyncio.get_running_loop(), {})
+        key = (api.url, api.username)
+        if key not in instances:
+            instances[key] = cls(api, api.log)
+        return instances[key]
+
+    def __init__(self, api: CybershuttleAPI, logger: Logger, tick: float = 1.0, window: float = 0.05):
+        super().__init__()
+        self.api = api
+        self.log = logger
+        self.tick = tick
+        self.window = window
+        self.subscribed: set[str] = set()
+        self.waiters: dict[str, list[asyncio.Future[JobStatus]]] = {}
+        self.results: dict[str, tuple[float, JobStatus]] = {}
+        self.task: asyncio.Task | None = None
+        self.num_requests = 0
+
+    def subscribe(self, job_id: int | str) -> None:
+        self.subscribed.add(str(job_id))
+
+    def unsubscribe(self, job_id: int | str) -> None:
+        """
+        Stop polling a job and cancel anyone still waiting on it
+
+        """
+        job_id = str(job_id)
+        self.subscribed.discard(job_id)
+        self.results.pop(job_id, None)
+        for fut in self.waiters.pop(job_id, []):
+            fut.cancel()
+
+    async def poll_job_status(self, job_id: int | str) -> JobStatus:
+        """
+        Get the status of a job from the next batched request (or one less than a tick old)
+
+        """
+        job_id = str(job_id)
+        self.subscribe(job_id)
+        cached = self.results.get(job_id)
+        if cached is not None and time.monotonic() - cached[0] < self.tick:
+            return cached[1]
+        fut: asyncio.Future[JobStatus] = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(job_id, []).append(fut)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        return await fut
+
+    async def _run(self) -> None:
+        while self.waiters:
+            # let other provisioners join this request, if there are any
+            if len(self.subscribed) > 1:
+                await asyncio.sleep(self.window)
+            waiters, self.waiters = self.waiters, {}
+            job_ids = sorted(self.subscribed | set(waiters))
+            if not job_ids:
+                continue
+            try:
+                self.num_requests += 1
+                results = await self.api.poll_jobs_status(job_ids)  # type: ignore
+            except Exception as e:
+                self.log.error(f"error polling jobs {job_ids}: {e!r}")
+                for futs in waiters.values():
+                    for fut in futs:
+                        if not fut.done():
+                            fut.set_exception(e)
+                continue
+            now = time.monotonic()
+            for job_id, status in results.items():
+                if job_id in self.subscribed:
+                    self.results[job_id] = (now, status)
+                for fut in waiters.get(job_id, []):
+                    if not fut.done():
+                        fut.set_result(status)
+        # a finished task still refers to its loop
+        self.task = None
@@ -0,0 +1,127 @@
+import asyncio
+import time
+from datetime import datetime
+from typing import Any
+
+
+def seconds_until(eta: str) -> float | None:
+    """
+    Seconds until a squeue start time (%S), e.g. "2024-03-12T10:00:00".
+
+    Returns None if the time is unknown (e.g. "N/A").
+
+    """
+    try:
+        return (datetime.fromisoformat(eta) - datetime.now()).total_seconds()
+    except (TypeError, ValueError):
+        return None
+
+
+class PollingPolicy:
+    """
+    Decide when a provisioner should next ask for the state of its job
+
+    - PENDING, far from the expected start time: back off, but wake up in time for the ETA
+    - PENDING, within eta_window before the ETA: poll every min_interval
+    - PENDING, past the ETA (SLURM often keeps a stale one for hours): back off again
+    - RUNNING: poll every min_interval for settle_period, then every running_interval
+    - anything else (not yet in squeue, shutting down): back off from min_interval
+
+    A job that is not RUNNING for max_wait seconds in a row is given up on (0 = never).
+
+    """
+
+    def __init__(
+        self,
+        min_interval: float = 1.0,
+        max_interval: float = 60.0,
+        running_interval: float = 30.0,
+        backoff: float = 1.5,
+        eta_window: float = 30.0,
+        settle_period: float = 10.0,
+        max_wait: float = 6 * 3600.0,
+    ):
+        super().__init__()
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.running_interval = running_interval
+        self.backoff = backoff
+        self.eta_window = eta_window
+        self.settle_period = settle_period
+        self.max_wait = max_wait
+        self.stats: dict[str, Any] = dict(polls=0, skipped=0, waiting_polls=0, by_state={}, max_interval=0.0)
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Make the next poll due immediately and forget the backoff (stats are kept)
+
+        """
+        self.state = ""
+        self.interval = 0.0
+        self.next_poll = 0.0
+        self.running_since: float | None = None
+        self.waiting_since: float | None = None
+
+    @property
+    def exhausted(self) -> bool:
+        return self.max_wait > 0 and self.waiting_since is not None and time.monotonic() - self.waiting_since >= self.max_wait
+
+    def due(self) -> bool:
+        """
+        Check whether a remote call should be made now. Counts skipped calls.
+
+        """
+        if time.monotonic() >= self.next_poll and not self.exhausted:
+            return True
+        self.stats["skipped"] += 1
+        return False
+
+    def time_until_due(self) -> float:
+        return max(0.0, self.next_poll - time.monotonic())
+
+    async def sleep(self) -> None:
+        await asyncio.sleep(self.time_until_due())
+
+    def observe(self, state: str, eta: str = "") -> float:
+        """
+        Record the result of a poll and schedule the next one.
+
+        Return:
+
+        interval (float) seconds until the next poll is due
+
+        """
+        now = time.monotonic()
+        self.stats["polls"] += 1
+        self.stats["by_state"][state] = self.stats["by_state"].get(state, 0) + 1
+        if state != "RUNNING":
+            self.stats["waiting_polls"] += 1
+            if self.waiting_since is None:
+                self.waiting_since = now
+        else:
+            self.waiting_since = None
+
+        changed = state != self.state
+        self.state = state
+        if state == "RUNNING":
+            if changed or self.running_since is None:
+                self.running_since = now
+            settling = now - self.running_since < self.settle_period
+            interval = self.min_interval if settling else self.running_interval
+        else:
+            self.running_since = None
+            grown = self.min_interval if changed else max(self.min_interval, self.interval * self.backoff)
+            interval = min(grown, self.max_interval)
+            if state == "PENDING":
+                remaining = seconds_until(eta)
+                if remaining is not None and remaining > self.eta_window:
+                    # do not sleep past the start of the ETA window
+                    interval = max(self.min_interval, min(interval, remaining - self.eta_window))
+                elif remaining is not None and remaining > 0:
+                    interval = self.min_interval
+
+        self.interval = interval
+        self.next_poll = now + interval
+        self.stats["max_interval"] = max(self.stats["max_interval"], interval)
+        return interval
@@ -1,6 +1,7 @@
 import asyncio
 import os
 import signal
+import time
 from typing import TYPE_CHECKING, Any, Dict, List, Literal, Optional
 
 import traitlets
@@ -8,8 +9,9 @@ from jupyter_client.connect import KernelConnectionInfo, LocalPortCache
 from jupyter_client.localinterfaces import is_local_ip, local_ips
 from jupyter_client.provisioning.provisioner_base import KernelProvisionerBase
 
-from cybershuttle_provisioners.api import SlurmAPI
+from cybershuttle_provisioners.api import AsyncSlurmAPI
 from cybershuttle_provisioners.config import TEMPLATE_DIR, jsonify
+from cybershuttle_provisioners.polling import PollingPolicy
 
 
 class RemoteSlurmProvisioner(KernelProvisionerBase):
@@ -31,9 +33,14 @@ class RemoteSlurmProvisioner(KernelProvisionerBase):
     awaiting_shutdown = False
     exec_node = None
     proc_portfwd = None
-    num_retries = 0
-
-    max_retries: int = 100
+    missing_since: Optional[float] = None
+    restarting = False
+    gave_up = False
+    poll_policy: PollingPolicy
+    last_poll: Optional[int] = None
+
+    # seconds a job may be missing from squeue (e.g. right after sbatch) before it is considered gone
+    missing_timeout: float = 100.0
     ports_cached = False
 
     sbatch_flags: dict = traitlets.Dict(config=True)  # type: ignore
@@ -41,6 +48,7 @@ class RemoteSlurmProvisioner(KernelProvisionerBase):
     loginnode: str = traitlets.Unicode(config=True)  # type: ignore
     username: str = traitlets.Unicode(config=True)  # type: ignore
     lmod_modules: list = traitlets.List(config=True)  # type: ignore
+    fast_restart: bool = traitlets.Bool(config=True, default_value=True)  # type: ignore
     template_dir = TEMPLATE_DIR
     fwd_ports = ["stdin_port", "shell_port", "iopub_port", "hb_port", "control_port"]
 
@@ -50,7 +58,10 @@ class RemoteSlurmProvisioner(KernelProvisionerBase):
         self.awaiting_shutdown = False
         self.exec_node = None
         self.proc_portfwd = None
-        self.num_retries = 0
+        self.missing_since = None
+        self.poll_policy = PollingPolicy()
+        self.last_poll = None
+        self.gave_up = False
 
     @property
     def has_process(self) -> bool:
@@ -74,13 +85,48 @@ class RemoteSlurmProvisioner(KernelProvisionerBase):
         if not self.has_process:
             return 0
 
+        # the kernel process is being respawned inside the job, so it is gone
+        if self.restarting:
+            return 0
+
+        # give up (and cancel the job) if it never started within the polling budget
+        if self.poll_policy.exhausted:
+            await self.give_up()
+            return 1
+
+        # skip the remote call until the polling policy says it is due
+        if not self.poll_policy.due():
+            return self.last_poll
+
+        self.last_poll = await self._poll_job()
+        return self.last_poll
+
+    async def give_up(self) -> None:
+        """
+        Cancel a job that did not start in time, so that it does not run later with no kernel attached
+
+        """
+        if self.gave_up:
+            return
+        self.gave_up = True
+        self.log.warning(f"job {self.job_id} did not start within {self.poll_policy.max_wait:.0f}s, cancelling it")
+        assert self.job_id is not None
+        await self.api.signal_job(self.job_id, signal.SIGTERM)
+
+    async def _poll_job(self) -> Optional[int]:
+        """
+        Poll the job state and map it to a poll() result.
+
+        """
         # poll for job state
         assert self.job_id is not None
-        state, node, eta = self.api.poll_job_status(self.job_id)
+        state, node, eta = await self.api.poll_job_status(self.job_id)
+        self.poll_policy.observe(state, eta)
 
         # case 1 - running state
         if state == "RUNNING":
             self.job_state = "RUNNING"
+            self.missing_since = None
             self.exec_node = node
             self.log.debug(f"job {self.job_id} is RUNNING. NODE={self.exec_node}")
             # at this point both exec_node and connection_info must exist
@@ -102,6 +148,7 @@ class RemoteSlurmProvisioner(KernelProvisionerBase):
         # case 2 - pending state
         if state == "PENDING":
             self.job_state = "PENDING"
+            self.missing_since = None
             self.log.debug(f"job {self.job_id} is PENDING. NODE={self.exec_node}, ETA={eta}")
             return None
 
@@ -115,15 +162,18 @@ class RemoteSlurmProvisioner(KernelProvisionerBase):
             return 0
 
         # fallback - unknown state
-        # give some time for job to show up in squeue
-        if self.num_retries < self.max_retries:
-            self.num_retries += 1
-            self.log.warn(f"[{self.num_retries}/{self.max_retries}] Job {self.job_id} not in squeue. using state=PENDING")
+        # give some time for job to show up in squeue (counted in seconds, since polls back off)
+        now = time.monotonic()
+        if self.missing_since is None:
+            self.missing_since = now
+        missing = now - self.missing_since
+        if missing < self.missing_timeout:
+            self.log.warn(f"[{missing:.0f}/{self.missing_timeout:.0f}s] Job {self.job_id} not in squeue. using state=PENDING")
             self.job_state = "PENDING"
             return None
         else:
-            self.log.warn(f"[{self.num_retries}/{self.max_retries}] Job {self.job_id} not in squeue. using state=UNKNOWN")
-            self.num_retries = 0
+            self.log.warn(f"[{missing:.0f}/{self.missing_timeout:.0f}s] Job {self.job_id} not in squeue. using state=UNKNOWN")
+            self.missing_since = None
             self.job_state = "UNKNOWN"
             return 1
 
@@ -138,15 +188,16 @@ class RemoteSlurmProvisioner(KernelProvisionerBase):
         """
         ret = 0
         if self.awaiting_shutdown:
-            # Use busy loop at 100ms intervals, polling until the process is
+            # Poll at intervals set by the polling policy until the process is
             # not alive.  If we find the process is no longer alive, complete
             # its cleanup via the blocking wait().  Callers are responsible for
             # issuing calls to wait() using a timeout (see kill()).
             while await self.poll() is None:  # type:ignore[unreachable]
-                await asyncio.sleep(0.1)
+                await self.poll_policy.sleep()
 
         # job is no longer alive, wait and clear port forwarding process
-        if self.proc_portfwd is not None:
+        # (unless the kernel is being respawned inside it, and still needs the tunnel)
+        if self.proc_portfwd is not None and not self.restarting:
             ret = self.proc_portfwd.wait()
             # Make sure all the fds get closed.
             for attr in ["stdout", "stderr", "stdin"]:
@@ -171,7 +222,7 @@ class RemoteSlurmProvisioner(KernelProvisionerBase):
             await self.poll()
         else:
             assert self.job_id is not None
-            self.api.signal_job(self.job_id, signum)
+            await self.api.signal_job(self.job_id, signum)
 
     async def kill(self, restart: bool = False) -> None:
         """
@@ -183,6 +234,8 @@ class RemoteSlurmProvisioner(KernelProvisionerBase):
 
         restart is True if this operation will precede a subsequent launch_kernel request.
         """
+        if restart and await self._fast_restart():
+            return
         if self.job_state == "RUNNING":
             await self.send_signal(signal.SIGKILL)
 
@@ -197,9 +250,29 @@ class RemoteSlurmProvisioner(KernelProvisionerBase):
 
         restart is True if this operation precedes a start launch_kernel request.
         """
+        if restart and await self._fast_restart():
+            return
         if self.job_state == "RUNNING":
             await self.send_signal(signal.SIGTERM)
 
+    async def _fast_restart(self) -> bool:
+        """
+        Ask the job's supervisor to respawn the kernel inside the current allocation.
+
+        The job script restarts the kernel on SIGUSR1 with the same connection
+        file, so ports and tunnels stay as they are. Returns True if a restart
+        was requested, in which case the job must not be signalled or relaunched.
+        """
+        if self.restarting:
+            return True
+        if not self.fast_restart or self.job_state != "RUNNING":
+            return False
+        assert self.job_id is not None
+        self.restarting = await self.api.signal_job(self.job_id, signal.SIGUSR1)
+        if self.restarting:
+            self.log.info(f"restarting kernel inside job {self.job_id}")
+        return self.restarting
+
     async def launch_kernel(self, cmd: List[str], **kwargs: Any) -> KernelConnectionInfo:
         """
         Launch the kernel process and return its connection information.
@@ -208,11 +281,19 @@ class RemoteSlurmProvisioner(KernelProvisionerBase):
         kernel manager's start kernel sequence.
         """
 
+        # respawned by the job's supervisor, with the same connection info
+        if self.restarting:
+            self.restarting = False
+            self.awaiting_shutdown = False
+            self.last_poll = None
+            self.poll_policy.reset()
+            return self.connection_info
+
         # reset state variables
         self._reset_state()
 
         # launch kernel
-        self.job_id = self.api.launch_job(self.job_script)
+        self.job_id = await self.api.launch_job(self.job_script)
 
         return self.connection_info
 
@@ -225,6 +306,11 @@ class RemoteSlurmProvisioner(KernelProvisionerBase):
 
         restart is True if this operation precedes a start launch_kernel request.
         """
+        # the job and its ports stay in use by the respawned kernel
+        if self.restarting:
+            return
+        if self.job_id is not None:
+            self.log.info(f"poll stats for job {self.job_id}: {self.poll_policy.stats}")
         if self.ports_cached and not restart:
             # provisioner is about to be destroyed, return cached ports
             lpc = LocalPortCache.instance()
@@ -251,6 +337,11 @@ class RemoteSlurmProvisioner(KernelProvisionerBase):
         may need to perform other operations in preparation for a kernel's shutdown.
         """
         self.awaiting_shutdown = True
+        if self.has_process:
+            if restart:
+                await self._fast_restart()
+            # look for the job to end right away, then back off
+            self.poll_policy.reset()
 
     async def pre_launch(self, **kwargs: Any) -> Dict[str, Any]:
         """
@@ -323,7 +414,7 @@ class RemoteSlurmProvisioner(KernelProvisionerBase):
             raise RuntimeError("SSH Agent is not running. Did you try running eval $(ssh-agent)?")
 
         # create provisioner api
-        self.api = SlurmAPI(logger=self.log)
+        self.api = AsyncSlurmAPI(logger=self.log)
         self.api.ssh_prefix = self.api.build_ssh_command(self.username, self.loginnode, self.proxyjump)
 
         # build job script
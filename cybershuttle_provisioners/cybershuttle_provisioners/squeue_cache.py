@@ -0,0 +1,241 @@
+"""
+Host-wide squeue cache for LocalSlurmProvisioner
+
+    cybershuttle-squeue-cache --socket /run/cybershuttle/squeue.sock [--mode 0666]
+
+Every kernel on a login node would otherwise run its own `squeue -j <id>`.
+The daemon keeps the set of jobs that provisioners have asked about and
+refreshes all of them with one squeue per interval, so the load on slurmctld
+grows with the number of hosts rather than the number of kernels.
+
+Provisioners talk to it over a Unix socket, one JSON object per line:
+
+    -> {"job_id": "123"}
+    <- {"state": "RUNNING", "node": "node01", "eta": "2024-03-12T10:00:00", "age": 1.2}
+
+A job stays of interest for `ttl` seconds after it was last asked about.
+
+Provisioners act on the answers (they forward ports, and an ssh-agent, to the
+node), so they only use a cache served by themselves, root, or the trusted
+owner they are configured with, and only accept plain host names as nodes.
+The socket is only readable by its owner unless --mode says otherwise.
+
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import pwd
+import re
+import socket
+import struct
+import time
+from logging import Logger
+from typing import Optional
+
+from cybershuttle_provisioners.api import AsyncSlurmAPI
+
+# the cache is opt-in: a well-known path in a shared directory could be taken by anyone
+DEFAULT_SOCKET = os.environ.get("CYBERSHUTTLE_SQUEUE_SOCKET", "")
+JOB_ID = re.compile(r"\d+(_\d+)?")
+HOSTNAME = re.compile(r"[A-Za-z0-9]([A-Za-z0-9.-]*[A-Za-z0-9])?")
+
+JobStatus = tuple[str, str, str]
+
+
+class SqueueCache:
+    """
+    Answer job status queries from one batched squeue per interval
+
+    """
+
+    def __init__(self, logger: Logger, interval: float = 5.0, min_gap: float = 1.0, ttl: float = 300.0):
+        super().__init__()
+        self.log = logger
+        self.api = AsyncSlurmAPI(logger)
+        self.interval = interval
+        self.min_gap = min_gap
+        self.ttl = ttl
+        self.interest: dict[str, float] = {}
+        self.results: dict[str, tuple[float, JobStatus]] = {}
+        self.wakeup = asyncio.Event()
+        self.refreshed = asyncio.Event()
+        self.last_refresh = 0.0
+        self.num_squeue = 0
+        self.num_queries = 0
+
+    async def get(self, job_id: str) -> tuple[JobStatus, float]:
+        """
+        Get the cached status of a job, waiting for the next refresh if it is new
+
+        Return:
+
+        status (job_state, exec_node, eta), age (float) seconds since it was fetched
+
+        """
+        self.num_queries += 1
+        self.interest[job_id] = time.monotonic()
+        while job_id not in self.results:
+            # new job: have it picked up by an early (but rate-limited) refresh
+            refreshed = self.refreshed
+            self.wakeup.set()
+            await refreshed.wait()
+        fetched, status = self.results[job_id]
+        return status, time.monotonic() - fetched
+
+    async def refresh(self) -> None:
+        now = time.monotonic()
+        for job_id, asked in list(self.interest.items()):
+            if now - asked > self.ttl:
+                del self.interest[job_id]
+                self.results.pop(job_id, None)
+        if self.interest:
+            self.num_squeue += 1
+            results = await self.api.poll_jobs_status(sorted(self.interest))
+            fetched = time.monotonic()
+            for job_id, status in results.items():
+                self.results[job_id] = (fetched, status)
+            self.log.debug(f"refreshed {len(results)} jobs ({self.num_squeue} squeue calls for {self.num_queries} queries)")
+        self.last_refresh = time.monotonic()
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            # never run squeue more often than every min_gap seconds
+            await asyncio.sleep(max(0.0, self.last_refresh + self.min_gap - time.monotonic()))
+            self.wakeup.clear()
+            try:
+                await self.refresh()
+            except Exception as e:
+                self.log.error(f"error refreshing job states: {e!r}")
+            refreshed, self.refreshed = self.refreshed, asyncio.Event()
+            refreshed.set()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while line := await reader.readline():
+                try:
+                    job_id = str(json.loads(line)["job_id"])
+                    if not JOB_ID.fullmatch(job_id):
+                        raise ValueError(job_id)
+                except (ValueError, KeyError, TypeError):
+                    response = dict(error="bad request")
+                else:
+                    (state, node, eta), age = await self.get(job_id)
+                    response = dict(state=state, node=node, eta=eta, age=round(age, 3))
+                writer.write((json.dumps(response) + "\n").encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path: str, mode: int = 0o600) -> None:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = await asyncio.start_unix_server(self.handle, path=socket_path)
+        # 0o666 to share it with the Jupyter servers of all users on this host
+        os.chmod(socket_path, mode)
+        self.log.info(f"serving job states on {socket_path} (interval={self.interval}s)")
+        try:
+            async with server:
+                await asyncio.gather(server.serve_forever(), self.run())
+        finally:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+
+
+def peer_uid(sock: socket.socket) -> int:
+    """
+    User ID of the process serving a Unix socket (or owning its file, where SO_PEERCRED is not available)
+
+    """
+    if hasattr(socket, "SO_PEERCRED"):
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+        return struct.unpack("3i", creds)[1]
+    return os.stat(sock.getpeername()).st_uid
+
+
+class SqueueCacheClient:
+    """
+    Ask the host's squeue cache for the state of a job
+
+    poll_job_status() returns None when the cache cannot be reached, or
+    cannot be trusted (served by another user than this one, root, or
+    owner), so that callers can fall back to running squeue themselves.
+
+    """
+
+    def __init__(self, socket_path: str, logger: Logger, owner: str = "", timeout: float = 30.0):
+        super().__init__()
+        self.socket_path = socket_path
+        self.log = logger
+        self.timeout = timeout
+        self.available: Optional[bool] = None
+        self.trusted_uids = {os.getuid(), 0}
+        if owner:
+            self.trusted_uids.add(pwd.getpwnam(owner).pw_uid)
+
+    async def poll_job_status(self, job_id: int | str) -> Optional[JobStatus]:
+        if not os.path.exists(self.socket_path):
+            self._set_available(False, "no socket")
+            return None
+        try:
+            data = await asyncio.wait_for(self._query(str(job_id)), self.timeout)
+            status = (data["state"], data["node"], data["eta"])
+            if status[1] and not HOSTNAME.fullmatch(status[1]):
+                raise ValueError(f"not a host name: {status[1]!r}")
+        except (OSError, asyncio.TimeoutError, ValueError, KeyError, TypeError) as e:
+            self._set_available(False, repr(e))
+            return None
+        self._set_available(True)
+        return status
+
+    async def _query(self, job_id: str) -> dict:
+        reader, writer = await asyncio.open_unix_connection(self.socket_path)
+        try:
+            uid = peer_uid(writer.get_extra_info("socket"))
+            if uid not in self.trusted_uids:
+                raise PermissionError(f"socket is served by untrusted uid {uid}")
+            writer.write((json.dumps(dict(job_id=job_id)) + "\n").encode())
+            await writer.drain()
+            return json.loads(await reader.readline())
+        finally:
+            writer.close()
+
+    def _set_available(self, available: bool, reason: str = "") -> None:
+        # only log when availability changes, not on every poll
+        if available == self.available:
+            return
+        self.available = available
+        if available:
+            self.log.info(f"using squeue cache at {self.socket_path}")
+        else:
+            self.log.info(f"squeue cache at {self.socket_path} unavailable ({reason}), running squeue directly")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Host-wide squeue cache for LocalSlurmProvisioner")
+    parser.add_argument("--socket", type=str, default=DEFAULT_SOCKET, required=not DEFAULT_SOCKET, help="Unix socket to serve on")
+    parser.add_argument("--interval", type=float, default=5.0, help="Seconds between squeue calls")
+    parser.add_argument("--min_gap", type=float, default=1.0, help="Minimum seconds between squeue calls")
+    parser.add_argument("--ttl", type=float, default=300.0, help="Forget jobs not asked about for this long")
+    parser.add_argument("--mode", type=lambda m: int(m, 8), default=0o600, help="Permissions of the socket (octal, 0666 to share it with all users)")
+    parser.add_argument("--log_level", type=str, default="INFO")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    cache = SqueueCache(logging.getLogger("squeue_cache"), interval=args.interval, min_gap=args.min_gap, ttl=args.ttl)
+    try:
+        asyncio.run(cache.serve(args.socket, args.mode))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
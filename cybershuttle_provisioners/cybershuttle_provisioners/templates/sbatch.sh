@@ -9,4 +9,37 @@ EOF
 
 {ENV_VARS}
 {LMOD_MODULES}
-{EXEC_COMMAND}
+
+# supervise the kernel inside this allocation:
+#   SIGUSR1 respawns it with the same connection file (fast restart)
+#   SIGINT is forwarded to it (interrupt)
+#   SIGTERM stops it and ends the job
+# if the kernel exits by itself, wait a grace period for SIGUSR1 before ending the job
+restart_grace=${{CYBERSHUTTLE_RESTART_GRACE:-10}}
+kernel_pid=""
+grace_pid=""
+restart=0
+stopping=0
+trap 'restart=1; [ -n "$kernel_pid" ] && kill -TERM $kernel_pid 2>/dev/null; [ -n "$grace_pid" ] && kill $grace_pid 2>/dev/null' USR1
+trap '[ -n "$kernel_pid" ] && kill -INT $kernel_pid 2>/dev/null' INT
+trap 'stopping=1; [ -n "$kernel_pid" ] && kill -TERM $kernel_pid 2>/dev/null; [ -n "$grace_pid" ] && kill $grace_pid 2>/dev/null' TERM
+
+while true; do
+  restart=0
+  {EXEC_COMMAND} &
+  kernel_pid=$!
+  # wait returns early whenever a trapped signal arrives
+  while kill -0 $kernel_pid 2>/dev/null; do
+    wait $kernel_pid
+  done
+  kernel_pid=""
+  [ $stopping -eq 1 ] && break
+  if [ $restart -eq 0 ]; then
+    sleep $restart_grace &
+    grace_pid=$!
+    wait $grace_pid
+    grace_pid=""
+    [ $restart -eq 0 ] && break
+  fi
+  echo "restarting kernel"
+done
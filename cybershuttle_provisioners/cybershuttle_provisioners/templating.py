@@ -1,6 +1,11 @@
+import hashlib
 import os
+import re
+import secrets
 import subprocess
+import threading
 from pathlib import Path
+from typing import Callable, Optional
 from shutil import copyfile
 
 from pexpect import pxssh
@@ -30,6 +35,93 @@ class Color:
     F_White = "\x1b[97m"
 
 
+# marks the start and end of each template line in the output of a batch run
+STEP_MARKER = "@@CS_STEP"
+KERNEL_SPECS = ["LANGUAGE", "DISPLAYNAME", "ARGV", "ENV"]
+# lines that only change the state of the shell; they run every time and are never cached
+STATEFUL_LINE = re.compile(
+    r"^\s*(cd|pushd|popd|export|unset|source|\.|alias|set|shopt|umask|ulimit|module|ml"
+    r"|(conda|mamba|micromamba)\s+(activate|deactivate))(\s|$)"
+    r"|^\s*[A-Za-z_][A-Za-z0-9_]*="
+)
+# where successful steps are recorded on the remote host, per template
+STEP_STORE = "$HOME/.cybershuttle/steps"
+# shell words that open and close multi-line constructs, and those after which a command starts
+OPENERS = ["if", "for", "while", "until", "case", "select", "{"]
+CLOSERS = ["fi", "done", "esac", "}"]
+COMMAND_PREFIXES = ["then", "do", "else", "elif", "if", "while", "until", "{", "!", "time"]
+HEREDOC = re.compile(r"<<(-?)\s*(['\"]?)([A-Za-z0-9_]+)\2")
+
+
+def shell_continues(text: str) -> bool:
+    """
+    Whether shell text continues on the next line: a backslash continuation, an
+    open quote or heredoc, or a construct (if, for, while, case, { ... }) not yet closed
+
+    """
+    depth = 0
+    quote = ""
+    heredocs: list[tuple[str, bool]] = []
+    continued = False
+    for line in text.split("\n"):
+        if heredocs:
+            delimiter, strip_tabs = heredocs[0]
+            if (line.lstrip("\t") if strip_tabs else line) == delimiter:
+                heredocs.pop(0)
+            continue
+        command = True
+        continued = False
+        word, quoted = "", False
+
+        def end_word() -> None:
+            nonlocal command, depth, word, quoted
+            if word and command and not quoted:
+                if word in OPENERS:
+                    depth += 1
+                elif word in CLOSERS:
+                    depth -= 1
+            if word:
+                command = word in COMMAND_PREFIXES and not quoted
+            word, quoted = "", False
+
+        i = 0
+        while i < len(line):
+            c = line[i]
+            if quote:
+                if c == "\\" and quote == '"':
+                    i += 1
+                elif c == quote:
+                    quote = ""
+                i += 1
+                continue
+            if c in "'\"":
+                quote, quoted = c, True
+            elif c == "\\":
+                if i == len(line) - 1:
+                    continued = True
+                word += line[i : i + 2]
+                i += 2
+                continue
+            elif c == "#" and not word:
+                break
+            elif c == "<" and (match := HEREDOC.match(line, i)) is not None:
+                end_word()
+                heredocs.append((match.group(3), match.group(1) == "-"))
+                i = match.end()
+                continue
+            elif c in " \t":
+                end_word()
+            elif c in ";&|()":
+                end_word()
+                command = True
+            else:
+                word += c
+            i += 1
+        if not quote:
+            end_word()
+    return continued or quote != "" or len(heredocs) > 0 or depth > 0
+
+
 class ScriptTemplate:
 
     template_directory = TEMPLATE_DIR
@@ -68,10 +160,20 @@ class ScriptTemplate:
             script_to_install = self.template_directory / template_to_install
             return script_to_install
 
-    def use(self, loginnode=None, user=None, proxyjump=None, dry_run=False):
+    def use(self, loginnode=None, user=None, proxyjump=None, dry_run=False, batch=False, force=False):
+        """
+        Run a template on a login node and return the kernel spec it describes
+
+        Args:
+            batch (bool): upload the template once and run it as a single remote
+                bash process, stopping at the first failing line, instead of
+                sending each line over an interactive session. Lines that already
+                succeeded unchanged on this host are skipped.
+            force (bool): in batch mode, run every line even if it is unchanged
+
+        """
 
         ssh_options = {}
-        kernel_specs = ["LANGUAGE", "DISPLAYNAME", "ARGV", "ENV"]
 
         # first of all: check running ssh-agent
         try:
@@ -112,8 +214,9 @@ class ScriptTemplate:
             ssh_cmd_str = ssh_cmd_str + " " + user
             print(Color.F_Default)
 
-        # startup ssh connection
-        while True:
+        # startup ssh connection (batch runs open their own)
+        ssh_session = None
+        while not batch:
             try:
                 print(f"\nTry to establish a ssh connection using command: {Color.F_Default}{ssh_cmd_str}\n")
                 ssh_session = pxssh.pxssh(options=ssh_options)
@@ -133,71 +236,38 @@ class ScriptTemplate:
             script_to_install = self.choose_template()
         assert script_to_install is not None
 
-        script = open(script_to_install, "r")
         print(f"Try to parse template...")
-
-        input_variables = {}
-        set_kernel_specs = {}
-        execute_lines = []
-        for line in script.readlines():
-            line = line.replace("\n", "")
-            if line == "" or line.startswith("#"):
-                continue
-
-            # get all input variables
-            if line.startswith("INPUT_"):
-                # get everything after INPUT_* = ???
-                input_variables[str(line[6])] = "=".join(line.split("=")[1:])
-            # get all kernel information
-            elif line.split("=")[0] in kernel_specs:
-                set_kernel_specs[str(line.split("=")[0])] = "=".join(line.split("=")[1:])
-            # and all other things: the script lines to execute
-            else:
-                execute_lines.append(line)
+        input_variables, set_kernel_specs, execute_lines = self.parse(script_to_install)
 
         print("\033[0m")
         # now collect input data
-        var_values = {}
-        for varid, inputvar in input_variables.items():
-            try:
-                var_value = inputvar.split(";")
-                try:
-                    input_default = var_value[1]
-                    input_title = var_value[0]
-                    tag_value = input(f"{input_title} [{input_default}]: ")
-                    if tag_value == "":
-                        tag_value = input_default
-                except IndexError:
-                    input_title = var_value[0]
-                    tag_value = input(f"{input_title}: ")
-
-                var_values[int(varid)] = tag_value
-            except IndexError:
-                print(f'Warning: Skipping line "{inputvar}" due to parsing error!')
+        var_values = self.collect_values(input_variables)
 
         print("\033[0m")
         # EXECUTE ALL LINES SPECIFIED IN execute_lines
-        for line in execute_lines:
-            for replace_item, replace_value in var_values.items():
-                if "$" + str(replace_item) in line:
-                    line = line.replace("$" + str(replace_item), replace_value)
-
-            if dry_run == True:
+        execute_lines = [self.substitute(line, var_values) for line in execute_lines]
+        store = self.step_store(script_to_install)
+        if dry_run == True and batch:
+            cached = self.cached_steps(loginnode, user, proxy, store)
+            self.preview(execute_lines, self.step_hashes(execute_lines), cached, force)
+        elif dry_run == True:
+            for line in execute_lines:
                 print(f"[DRY RUN/EXECUTE TEMPLATE] Would execute: {line}")
-            else:
+        elif batch:
+            self.run_batch(execute_lines, loginnode, user, proxy, store=store, force=force)
+        else:
+            assert ssh_session is not None
+            for line in execute_lines:
                 print(f"Executing following line: {Color.F_Blue}" + str(line) + f"{Color.F_Default}")
                 ssh_session.sendline(str(line))
                 ssh_session.prompt()
 
         # REPLACE '$' vars in kernel specs
         for type_spec, value in set_kernel_specs.items():
-            for replace_item, replace_value in var_values.items():
-                if "$" + str(replace_item) in value:
-                    set_kernel_specs[str(type_spec)] = set_kernel_specs[str(type_spec)].replace(
-                        "$" + str(replace_item), replace_value
-                    )
+            set_kernel_specs[str(type_spec)] = self.substitute(value, var_values)
 
-        ssh_session.logout()
+        if ssh_session is not None:
+            ssh_session.logout()
 
         if len(input_variables) < 1 or len(set_kernel_specs) < 1:
             raise RenderTemplateError()
@@ -243,6 +313,310 @@ class ScriptTemplate:
 
         return set_kernel_specs
 
+    def install(
+        self,
+        loginnode: str,
+        user: str,
+        proxyjump: str = "",
+        values: dict[int, str] = {},
+        dry_run: bool = False,
+        echo: Callable[[str], None] = print,
+        force: bool = False,
+    ) -> dict[str, str]:
+        """
+        Run the template on a login node without prompting, and return the kernel spec it describes
+
+        Args:
+            values (dict): value of each INPUT_n variable; variables not given here use their default
+            force (bool): run every line, even those that already succeeded unchanged on this host
+
+        """
+        assert self.template is not None
+        script_to_install = self.template_directory / self.template.with_suffix(".sh")
+        input_variables, set_kernel_specs, execute_lines = self.parse(script_to_install)
+        if len(input_variables) < 1 or len(set_kernel_specs) < 1:
+            raise RenderTemplateError()
+
+        var_values = {}
+        for varid, inputvar in input_variables.items():
+            var_value = inputvar.split(";")
+            if int(varid) in values:
+                var_values[int(varid)] = values[int(varid)]
+            elif len(var_value) > 1:
+                var_values[int(varid)] = var_value[1]
+            else:
+                raise RenderTemplateError(f"No value given for INPUT_{varid} ({var_value[0]})")
+
+        execute_lines = [self.substitute(line, var_values) for line in execute_lines]
+        store = self.step_store(script_to_install)
+        if dry_run:
+            cached = self.cached_steps(loginnode, user, proxyjump, store)
+            self.preview(execute_lines, self.step_hashes(execute_lines), cached, force, echo=echo)
+        else:
+            self.run_batch(execute_lines, loginnode, user, proxyjump, echo=echo, store=store, force=force)
+
+        set_kernel_specs = {key.lower(): self.substitute(val, var_values) for key, val in set_kernel_specs.items()}
+        set_kernel_specs["loginnode"] = loginnode
+        set_kernel_specs["username"] = user
+        set_kernel_specs["proxyjump"] = proxyjump
+        return set_kernel_specs
+
+    def parse(self, script_to_install: Path) -> tuple[dict[str, str], dict[str, str], list[str]]:
+        """
+        Split a template into its input variables, kernel specs and lines to execute
+
+        A line to execute is a whole shell command: backslash continuations,
+        heredocs and multi-line constructs (if, for, while, case, { ... }) are
+        kept together, with their newlines, as one step.
+
+        """
+        input_variables = {}
+        set_kernel_specs = {}
+        execute_lines = []
+        pending: list[str] = []
+        with open(script_to_install, "r") as script:
+            for line in script.readlines():
+                line = line.replace("\n", "")
+                if pending:
+                    pending.append(line)
+                    if not shell_continues("\n".join(pending)):
+                        execute_lines.append("\n".join(pending))
+                        pending = []
+                    continue
+                if line == "" or line.startswith("#"):
+                    continue
+
+                # get all input variables
+                if line.startswith("INPUT_"):
+                    # get everything after INPUT_* = ???
+                    input_variables[str(line[6])] = "=".join(line.split("=")[1:])
+                # get all kernel information
+                elif line.split("=")[0] in KERNEL_SPECS:
+                    set_kernel_specs[str(line.split("=")[0])] = "=".join(line.split("=")[1:])
+                # and all other things: the script lines to execute
+                elif shell_continues(line):
+                    pending = [line]
+                else:
+                    execute_lines.append(line)
+        # an unterminated construct is left for bash to report
+        if pending:
+            execute_lines.append("\n".join(pending))
+        return input_variables, set_kernel_specs, execute_lines
+
+    def collect_values(self, input_variables: dict[str, str]) -> dict[int, str]:
+        """
+        Ask the user for the value of each input variable
+
+        """
+        var_values = {}
+        for varid, inputvar in input_variables.items():
+            try:
+                var_value = inputvar.split(";")
+                try:
+                    input_default = var_value[1]
+                    input_title = var_value[0]
+                    tag_value = input(f"{input_title} [{input_default}]: ")
+                    if tag_value == "":
+                        tag_value = input_default
+                except IndexError:
+                    input_title = var_value[0]
+                    tag_value = input(f"{input_title}: ")
+
+                var_values[int(varid)] = tag_value
+            except IndexError:
+                print(f'Warning: Skipping line "{inputvar}" due to parsing error!')
+        return var_values
+
+    @staticmethod
+    def substitute(line: str, var_values: dict[int, str]) -> str:
+        for replace_item, replace_value in var_values.items():
+            if "$" + str(replace_item) in line:
+                line = line.replace("$" + str(replace_item), replace_value)
+        return line
+
+    @staticmethod
+    def render_batch(
+        execute_lines: list[str],
+        nonce: str,
+        hashes: Optional[list[Optional[str]]] = None,
+        store: str = "",
+        force: bool = False,
+    ) -> str:
+        """
+        Render template lines as one bash script that reports the start and exit code of each line
+
+        Each line is a whole command (see parse), which may span several lines of the script.
+
+        Lines run in the same shell, so cd/export/source carry over as they do
+        in an interactive session. The script exits at the first failing line.
+
+        If hashes and a store are given, each successful line with a hash is
+        recorded as a marker file in the store, and lines whose marker exists
+        are skipped (unless force is set).
+
+        """
+        script = ["exec 2>&1"]
+        if hashes is not None and store:
+            script.append(f'__cs_steps="{store}"')
+            script.append('mkdir -p "$__cs_steps"')
+        for i, line in enumerate(execute_lines):
+            step_hash = hashes[i] if hashes is not None and store else None
+            if step_hash is not None and not force:
+                script.append(f'if [ -e "$__cs_steps/{step_hash}" ]; then')
+                script.append(f"echo '{STEP_MARKER} {nonce} {i} SKIP'")
+                script.append("else")
+            script.append(f"echo '{STEP_MARKER} {nonce} {i} BEGIN'")
+            script.append(line)
+            script.append("__cs_rc=$?")
+            script.append(f'echo "{STEP_MARKER} {nonce} {i} END $__cs_rc"')
+            script.append('[ "$__cs_rc" -eq 0 ] || exit "$__cs_rc"')
+            if step_hash is not None:
+                script.append(f'touch "$__cs_steps/{step_hash}"')
+            if step_hash is not None and not force:
+                script.append("fi")
+        script.append("exit 0")
+        return "\n".join(script) + "\n"
+
+    @staticmethod
+    def step_hashes(execute_lines: list[str]) -> list[Optional[str]]:
+        """
+        Hash each (substituted) template line, or None for lines that must always run
+
+        A line's hash covers its text, with the values substituted into it, and
+        every stateful line (cd, export, activate, ...) before it. Changing a line
+        re-runs that line, and changing where or how it runs re-runs it too.
+
+        """
+        hashes: list[Optional[str]] = []
+        context: list[str] = []
+        for line in execute_lines:
+            if STATEFUL_LINE.match(line):
+                context.append(line)
+                hashes.append(None)
+            else:
+                step = "\n".join(context + [line])
+                hashes.append(hashlib.sha256(step.encode()).hexdigest())
+        return hashes
+
+    @staticmethod
+    def step_store(template: Path) -> str:
+        return f"{STEP_STORE}/{re.sub(r'[^a-zA-Z0-9._-]', '_', template.stem)}"
+
+    @staticmethod
+    def ssh_command(loginnode: str, user: str, proxyjump: str, remote_cmd: str) -> list[str]:
+        ssh_cmd = ["ssh", "-T"]
+        if proxyjump:
+            ssh_cmd.extend(["-J", proxyjump])
+        ssh_cmd.extend([f"{user}@{loginnode}", remote_cmd])
+        return ssh_cmd
+
+    def cached_steps(self, loginnode: str, user: str, proxyjump: str, store: str) -> set[str]:
+        """
+        List the step hashes recorded on the remote host
+
+        """
+        ssh_cmd = self.ssh_command(loginnode, user, proxyjump, f'ls -1 "{store}" 2>/dev/null; true')
+        stdout = subprocess.run(ssh_cmd, stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=60, check=True).stdout
+        return set(stdout.split())
+
+    def preview(
+        self,
+        execute_lines: list[str],
+        hashes: list[Optional[str]],
+        cached: set[str],
+        force: bool = False,
+        echo: Callable[[str], None] = print,
+    ) -> None:
+        """
+        Print which lines a run would execute, and which it would skip
+
+        """
+        for line, step_hash in zip(execute_lines, hashes):
+            if step_hash is None:
+                echo(f"[DRY RUN/EXECUTE TEMPLATE] Would execute (shell state): {line}")
+            elif step_hash in cached and not force:
+                echo(f"[DRY RUN/EXECUTE TEMPLATE] Would skip (unchanged): {line}")
+            else:
+                echo(f"[DRY RUN/EXECUTE TEMPLATE] Would execute: {line}")
+
+    def run_batch(
+        self,
+        execute_lines: list[str],
+        loginnode: str,
+        user: str,
+        proxyjump: str = "",
+        echo: Callable[[str], None] = print,
+        store: str = "",
+        force: bool = False,
+    ) -> None:
+        """
+        Upload the template lines once and run them as a single remote process
+
+        Output is streamed back as it is produced. Raises TemplateStepFailed
+        for the first line that exits with a non-zero code. With a step store,
+        lines that already succeeded with the same hash are skipped.
+
+        """
+        nonce = secrets.token_hex(4)
+        hashes = self.step_hashes(execute_lines) if store else None
+        script = self.render_batch(execute_lines, nonce, hashes, store, force)
+        # the script is saved to a file first, so that lines which read stdin cannot consume it
+        remote_cmd = 'f=$(mktemp) && cat > "$f" && bash "$f" < /dev/null; rc=$?; rm -f "$f"; exit $rc'
+        ssh_cmd = self.ssh_command(loginnode, user, proxyjump, remote_cmd)
+
+        echo(f"Executing {len(execute_lines)} lines on {loginnode} in one batch...")
+        process = subprocess.Popen(
+            ssh_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1
+        )
+        assert process.stdin is not None and process.stdout is not None
+
+        def upload():
+            assert process.stdin is not None
+            try:
+                process.stdin.write(script)
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+        uploader = threading.Thread(target=upload, daemon=True)
+        uploader.start()
+
+        step = None
+        failed = None
+        skipped = 0
+        output: list[str] = []
+        for raw in process.stdout:
+            line = raw.rstrip("\n")
+            parts = line.split(" ")
+            if len(parts) >= 4 and parts[0] == STEP_MARKER and parts[1] == nonce:
+                i = int(parts[2])
+                if parts[3] == "BEGIN":
+                    step, output = i, []
+                    echo(f"Executing following line: {Color.F_Blue}{execute_lines[i]}{Color.F_Default}")
+                elif parts[3] == "SKIP":
+                    skipped += 1
+                    echo(f"Skipping unchanged line: {Color.F_DarkGray}{execute_lines[i]}{Color.F_Default}")
+                else:
+                    step = None
+                    if int(parts[4]) != 0:
+                        failed = (i, int(parts[4]))
+                continue
+            output.append(line)
+            echo(line)
+        returncode = process.wait()
+        uploader.join()
+
+        # a line that ended the shell itself (or a dropped connection) never reports END
+        if failed is None and step is not None:
+            failed = (step, returncode)
+        if failed is not None:
+            i, code = failed
+            echo(f"{Color.F_LightRed}\u2717 Line {i + 1} failed with exit code {code}: {execute_lines[i]}{Color.F_Default}")
+            raise TemplateStepFailed(i, execute_lines[i], code, "\n".join(output))
+        if returncode != 0:
+            raise SSHCommandError(f"Error: batch run on {loginnode} exited with code {returncode}")
+        echo(f"{Color.F_LightGreen}\u2713 Executed {len(execute_lines) - skipped} lines ({skipped} unchanged){Color.F_Default}")
+
     def edit(self, editor: str | None = None):
         assert self.template is not None
         self.template = self.template_directory / self.template.with_suffix(".sh")